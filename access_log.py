@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import threading
+
+# Where access records go: a file path, '-' for stderr, 'off' to disable.
+# Read from the environment so forked and spawned workers agree.
+DESTINATION_ENV = 'HTTP_ACCESS_LOG'
+DEFAULT_DESTINATION = '-'
+# Fraction of requests that get a record (0..1). Server errors and
+# requests that failed before a response are always logged.
+SAMPLE_ENV = 'HTTP_ACCESS_LOG_SAMPLE'
+DEFAULT_SAMPLE = 1.0
+# Also log the request headers. Bodies are never logged.
+HEADERS_ENV = 'HTTP_ACCESS_LOG_HEADERS'
+# The writer takes up to this many records per write, and waits this long
+# between writes when there were fewer than that queued.
+BATCH_SIZE = 512
+FLUSH_INTERVAL = 0.5
+# Records arriving while this many are still waiting are dropped (and
+# counted) rather than letting a stalled log grow memory without bound.
+MAX_BACKLOG = 100000
+
+DISABLED = ('', 'off', 'none', '0')
+
+
+class AccessLog:
+    """One compact record per request, written by a background thread.
+
+    The request path only builds a tuple and puts it on a SimpleQueue;
+    formatting and the write() happen on the writer thread, a batch at a
+    time, with one write per batch so processes sharing a file don't
+    interleave lines.
+    """
+
+    def __init__(self, destination=DEFAULT_DESTINATION, sample=DEFAULT_SAMPLE, headers=False):
+        self.destination = destination
+        self.sample = max(0.0, min(1.0, sample))
+        self.headers = headers
+        self.fd = None
+        self.reset()
+
+    @classmethod
+    def from_environment(cls):
+        destination = os.environ.get(DESTINATION_ENV, DEFAULT_DESTINATION)
+        if destination.strip().lower() in DISABLED:
+            return None
+        try:
+            sample = float(os.environ.get(SAMPLE_ENV, DEFAULT_SAMPLE))
+        except ValueError:
+            sample = DEFAULT_SAMPLE
+        headers = os.environ.get(HEADERS_ENV, '').strip().lower() in ('1', 'yes', 'true', 'on')
+        return cls(destination, sample, headers)
+
+    def reset(self):
+        # also after fork: the parent's writer thread doesn't exist here, and
+        # whatever it had queued (and counted) is the parent's
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.write_errors = 0
+
+    def record(self, address, request, status, received, sent, elapsed, route):
+        if self.sample < 1.0 and status and status < 500 and random.random() >= self.sample:
+            self.sampled_out += 1
+            return
+        if self.thread is None:
+            self.start()
+        if self.queue.qsize() >= MAX_BACKLOG:
+            self.dropped += 1
+            return
+        headers = dict(request['headers']) if self.headers else None
+        self.queue.put((time.time() - elapsed, address, request['method'], request['uri'],
+                        request['version'], status, received, sent, elapsed, route, headers))
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            count = self.flush(block=True)
+            if count < BATCH_SIZE:
+                time.sleep(FLUSH_INTERVAL)
+
+    def flush(self, block=False):
+        """Write out what is queued, one batch; returns how many records."""
+        batch = []
+        if block:
+            batch.append(self.queue.get())
+        while len(batch) < BATCH_SIZE:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if not batch:
+            return 0
+        data = ''.join(format_record(record) for record in batch).encode('utf-8', 'replace')
+        with self.lock:
+            try:
+                self.write(data)
+                self.written += len(batch)
+                self.batches += 1
+            except OSError as e:
+                self.write_errors += 1
+                logging.error(f"Error writing access log: {e}")
+        return len(batch)
+
+    def write(self, data):
+        if self.fd is None:
+            if self.destination == '-':
+                self.fd = sys.stderr.fileno()
+            else:
+                self.fd = os.open(self.destination, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def drain(self):
+        while self.flush():
+            pass
+
+    def stats(self):
+        return {
+            'destination': self.destination,
+            'sample': self.sample,
+            'queued': self.queue.qsize(),
+            'written': self.written,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'sampled_out': self.sampled_out,
+            'write_errors': self.write_errors,
+        }
+
+
+def format_record(record):
+    started, address, method, uri, version, status, received, sent, elapsed, route, headers = record
+    entry = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(started)) + f".{int(started % 1 * 1000):03d}Z",
+        'pid': os.getpid(),
+        'client': address[0] if isinstance(address, tuple) else address,
+        'method': method,
+        'uri': uri,
+        'version': version,
+        'status': status or 0,
+        'route': route,
+        'in': received,
+        'out': sent,
+        'ms': round(elapsed * 1000, 3),
+    }
+    if headers is not None:
+        entry['headers'] = headers
+    return json.dumps(entry, separators=(',', ':')) + '\n'
+
+
+LOG = AccessLog.from_environment()
+
+
+def configure(destination=DEFAULT_DESTINATION, sample=DEFAULT_SAMPLE, headers=False):
+    """Replace the log in this process; records already queued are written first."""
+    global LOG
+    if LOG is not None:
+        LOG.drain()
+    if destination.strip().lower() in DISABLED:
+        LOG = None
+    else:
+        LOG = AccessLog(destination, sample, headers)
+
+
+def record(address, request, status, received, sent, elapsed, route):
+    log = LOG
+    if log is not None:
+        log.record(address, request, status, received, sent, elapsed, route)
+
+
+def flush():
+    """Write everything queued now (short-lived processes, on exit)."""
+    if LOG is not None:
+        LOG.drain()
+
+
+def stats():
+    return LOG.stats() if LOG is not None else {'destination': 'off'}
+
+
+def _after_fork():
+    if LOG is not None:
+        LOG.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+atexit.register(flush)
@@ -0,0 +1,243 @@
+import time
+import bisect
+import socket
+import select
+import hashlib
+import logging
+import threading
+from collections import deque
+from http_parser import HttpParser, ParseError, StatusLine, NEED_DATA, CLOSED
+
+STRATEGIES = ('round_robin', 'least_connections', 'consistent_hash')
+# Active health checks: a GET of HEALTH_PATH on every backend this often.
+# The path must be one the backends serve; only a 2xx or 3xx passes.
+HEALTH_INTERVAL = 5.0
+HEALTH_TIMEOUT = 2.0
+HEALTH_PATH = '/stats'
+# Consecutive failures (checks or proxied requests) before a backend is
+# ejected, and how long it stays out before traffic may probe it again.
+MAX_FAILURES = 3
+EJECT_TIME = 30.0
+CONNECT_TIMEOUT = 3.0
+# Idle keep-alive connections kept per backend, and how long one may sit
+# idle; this stays under the servers' own KEEPALIVE_TIMEOUT so we don't
+# reuse a connection the backend is about to close.
+MAX_IDLE_PER_BACKEND = 16
+IDLE_CONNECTION_TIMEOUT = 10.0
+# Points per backend on the consistent-hash ring.
+HASH_REPLICAS = 100
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class Backend:
+    def __init__(self, address):
+        self.address = address
+        self.name = f"{address[0]}:{address[1]}"
+        self.healthy = True
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.active = 0
+        self.idle = deque()
+        self.requests = 0
+        self.connects = 0
+        self.reused = 0
+        self.errors = 0
+        self.ejections = 0
+
+    def available(self, now):
+        # an ejected backend gets traffic again once its time is up; the
+        # next failure sends it straight back out
+        return self.healthy or now >= self.ejected_until
+
+    def stats(self):
+        return {
+            'healthy': self.healthy,
+            'active': self.active,
+            'idle_connections': len(self.idle),
+            'requests': self.requests,
+            'connects': self.connects,
+            'reused': self.reused,
+            'errors': self.errors,
+            'ejections': self.ejections,
+        }
+
+
+class BackendPool:
+    """A set of backends with load balancing, health checks and ejection.
+
+    choose() picks a backend by the configured strategy among those not
+    ejected (or among all of them if every one is). connect()/release()
+    hand out keep-alive connections from a per-backend idle list, so HTTP
+    requests can reuse backend connections instead of opening one each.
+    """
+
+    def __init__(self, addresses, strategy='round_robin', health_interval=HEALTH_INTERVAL,
+                 health_path=HEALTH_PATH, max_failures=MAX_FAILURES, eject_time=EJECT_TIME,
+                 max_idle=MAX_IDLE_PER_BACKEND):
+        if not addresses:
+            raise ValueError("need at least one backend")
+        if strategy not in STRATEGIES:
+            raise ValueError(f"unknown strategy {strategy!r}, expected one of {STRATEGIES}")
+        self.backends = [Backend(address) for address in addresses]
+        self.strategy = strategy
+        self.health_interval = health_interval
+        self.health_path = health_path
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.next_index = 0
+        ring = sorted((hash_key(f"{b.name}#{i}"), n)
+                      for n, b in enumerate(self.backends) for i in range(HASH_REPLICAS))
+        self.ring_keys = [h for h, _ in ring]
+        self.ring_backends = [self.backends[n] for _, n in ring]
+        self.health_thread = None
+
+    def choose(self, key=None):
+        """Pick a backend and count it as active until done() is called."""
+        with self.lock:
+            now = time.monotonic()
+            candidates = [b for b in self.backends if b.available(now)] or self.backends
+            if self.strategy == 'consistent_hash' and key is not None:
+                backend = self._ring_lookup(key, candidates)
+            elif self.strategy == 'least_connections':
+                # rotate the start so ties don't all land on the first backend
+                start = self.next_index % len(candidates)
+                self.next_index += 1
+                rotated = candidates[start:] + candidates[:start]
+                backend = min(rotated, key=lambda b: b.active)
+            else:
+                backend = candidates[self.next_index % len(candidates)]
+                self.next_index += 1
+            backend.active += 1
+            backend.requests += 1
+            return backend
+
+    def _ring_lookup(self, key, candidates):
+        i = bisect.bisect(self.ring_keys, hash_key(key))
+        for step in range(len(self.ring_keys)):
+            backend = self.ring_backends[(i + step) % len(self.ring_keys)]
+            if backend in candidates:
+                return backend
+        return candidates[0]
+
+    def done(self, backend):
+        with self.lock:
+            backend.active -= 1
+
+    def connect(self, backend):
+        """Return ``(sock, reused)`` for a connection to ``backend``."""
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if not backend.idle:
+                    break
+                sock, idle_since = backend.idle.pop()
+            if now - idle_since < IDLE_CONNECTION_TIMEOUT and not self._is_stale(sock):
+                with self.lock:
+                    backend.reused += 1
+                return sock, True
+            sock.close()
+
+        try:
+            sock = socket.create_connection(backend.address, timeout=CONNECT_TIMEOUT)
+        except OSError:
+            self.report_failure(backend)
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            backend.connects += 1
+        return sock, False
+
+    def _is_stale(self, sock):
+        # an idle connection with something to read has been closed (or
+        # sent garbage) by the backend
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def release(self, backend, sock, reusable):
+        if reusable:
+            with self.lock:
+                if len(backend.idle) < self.max_idle:
+                    backend.idle.append((sock, time.monotonic()))
+                    return
+        sock.close()
+
+    def report_success(self, backend):
+        with self.lock:
+            backend.failures = 0
+            if not backend.healthy:
+                backend.healthy = True
+                logging.warning(f"Backend {backend.name} is back")
+
+    def report_failure(self, backend):
+        with self.lock:
+            backend.errors += 1
+            backend.failures += 1
+            if backend.failures >= self.max_failures and (backend.healthy or
+                                                          time.monotonic() >= backend.ejected_until):
+                backend.healthy = False
+                backend.ejected_until = time.monotonic() + self.eject_time
+                backend.ejections += 1
+                idle = list(backend.idle)
+                backend.idle.clear()
+                logging.warning(f"Backend {backend.name} ejected after {backend.failures} failures")
+            else:
+                idle = []
+        for sock, _ in idle:
+            sock.close()
+
+    def check(self, backend):
+        # GET on a fresh connection; the status line is all we read. A 4xx
+        # means the backend can't serve the probe path, so it fails too.
+        try:
+            with socket.create_connection(backend.address, timeout=HEALTH_TIMEOUT) as sock:
+                sock.sendall(f"GET {self.health_path} HTTP/1.1\r\nHost: {backend.name}\r\n"
+                             "Connection: close\r\n\r\n".encode('latin-1'))
+                parser = HttpParser('response')
+                parser.request_method = 'GET'
+                while True:
+                    event = parser.next_event()
+                    if event is NEED_DATA:
+                        parser.recv_into(sock, 4096)
+                        continue
+                    if event is CLOSED:
+                        raise ConnectionError("closed without a response")
+                    if isinstance(event, StatusLine):
+                        healthy = 200 <= event.status < 400
+                        if not healthy:
+                            logging.info(f"Health check of {backend.name} got {event.status}")
+                        break
+        except (OSError, ParseError) as e:
+            logging.info(f"Health check of {backend.name} failed: {e}")
+            healthy = False
+        if healthy:
+            self.report_success(backend)
+        else:
+            self.report_failure(backend)
+        return healthy
+
+    def start_health_checks(self):
+        if self.health_thread is not None or not self.health_interval:
+            return
+        self.health_thread = threading.Thread(target=self._health_loop, name='health-checks', daemon=True)
+        self.health_thread.start()
+
+    def _health_loop(self):
+        while True:
+            for backend in self.backends:
+                self.check(backend)
+            time.sleep(self.health_interval)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'strategy': self.strategy,
+                'backends': {b.name: b.stats() for b in self.backends},
+            }
@@ -1,91 +1,591 @@
+import io
 import sys
+import os
+import stat
+import json
+import time
 import socket
+import select
+import ssl
 import logging
-import os
-import base64
-
-from urllib.parse import urlencode
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, quote
+from http_parser import HttpParser, ParseError, StatusLine, HeadersComplete, Data, EndOfMessage, NEED_DATA, CLOSED
 
-server_address = ('172.16.16.101', 8889)
+server_address = ('localhost', 8889)
 FILE_TO_UPLOAD = 'client_image.jpg'
 FILE_TO_DELETE = 'client_delete.jpg'
 
+CONNECT_TIMEOUT = 10
+READ_CHUNK_SIZE = 64 * 1024
+# File bodies are read and sent this much at a time, so an upload needs
+# one buffer of this size whatever the size of the file.
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# File bodies at least this big (or of unknown size) go out with
+# "Expect: 100-continue", so a refused upload fails before the data is
+# sent; older servers that never answer get the body after EXPECT_TIMEOUT.
+EXPECT_CONTINUE_SIZE = 1024 * 1024
+EXPECT_TIMEOUT = 1.0
+# Idle keep-alive connections kept per client, and how long one may sit
+# idle; the servers close theirs after KEEPALIVE_TIMEOUT (15s).
+MAX_IDLE_CONNECTIONS = 16
+IDLE_CONNECTION_TIMEOUT = 10
+BATCH_WORKERS = 16
+
+BatchResult = namedtuple('BatchResult', 'item value error')
+
 
-def make_socket(destination_address='localhost', port=8889):
+class HttpError(Exception):
+    def __init__(self, response):
+        super().__init__(f"{response.status} {response.reason}".strip())
+        self.response = response
+
+
+def make_socket(destination_address='localhost', port=8889, timeout=CONNECT_TIMEOUT):
+    sock = socket.create_connection((destination_address, port), timeout=timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def file_size(f):
+    """Bytes left to read in file object ``f``, or None if unknown (pipes)."""
+    try:
+        st = os.fstat(f.fileno())
+        if stat.S_ISREG(st.st_mode):
+            return st.st_size - f.tell()
+    except (AttributeError, OSError, ValueError):
+        pass
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(10)
-        sock.connect((destination_address, port))
-        return sock
-    except Exception as ee:
-        logging.error(f"Error creating socket: {str(ee)}")
+        position = f.tell()
+        end = f.seek(0, io.SEEK_END)
+        f.seek(position)
+        return end - position
+    except (AttributeError, OSError, ValueError):
         return None
 
 
-def send_request(request_str):
-    alamat_server, port_server = server_address
-    sock = make_socket(alamat_server, port_server)
+def is_file(body):
+    return hasattr(body, 'read')
 
-    if sock is None:
-        return ""
 
-    logging.warning(f"Sending request:\n------\n{request_str.strip()}\n------")
-    try:
-        sock.sendall(request_str.encode('utf-8'))
-        response_bytes = b""
+def send_file(sock, f, size=None, progress=None):
+    """Send ``size`` bytes of ``f`` as-is, or all of it chunked if size is None.
+
+    Plain sockets with a real file underneath use sendfile(); otherwise one
+    reusable UPLOAD_CHUNK_SIZE buffer is filled and sent over and over.
+    """
+    if size is not None and not isinstance(sock, ssl.SSLSocket):
+        try:
+            f.fileno()
+        except (AttributeError, OSError, ValueError):
+            pass
+        else:
+            remaining = size
+            while remaining:
+                sent = sock.sendfile(f, f.tell(), min(UPLOAD_CHUNK_SIZE, remaining))
+                if not sent:
+                    raise ValueError("file ended before its declared size")
+                remaining -= sent
+                if progress is not None:
+                    progress.update(sent)
+            return
+
+    buffer = bytearray(UPLOAD_CHUNK_SIZE)
+    view = memoryview(buffer)
+    readinto = getattr(f, 'readinto', None)
+    remaining = size
+    while remaining is None or remaining:
+        want = UPLOAD_CHUNK_SIZE if remaining is None else min(UPLOAD_CHUNK_SIZE, remaining)
+        if readinto is not None:
+            n = readinto(view[:want])
+        else:
+            data = f.read(want)
+            n = len(data)
+            view[:n] = data
+        if not n:
+            if remaining is not None:
+                raise ValueError("file ended before its declared size")
+            break
+        if remaining is None:
+            sock.sendall(b"%x\r\n" % n)
+            sock.sendall(view[:n])
+            sock.sendall(b"\r\n")
+        else:
+            sock.sendall(view[:n])
+            remaining -= n
+        if progress is not None:
+            progress.update(n)
+    if size is None:
+        sock.sendall(b"0\r\n\r\n")
+
+
+class Transfer:
+    """Progress of one upload or download.
+
+    ``callback(transfer)`` is called after every chunk; ``done``, ``total``
+    (None if unknown), ``fraction`` and ``rate`` (bytes per second) describe
+    where it stands.
+    """
+
+    def __init__(self, name, total=None, callback=None):
+        self.name = name
+        self.total = total
+        self.callback = callback
+        self.done = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    def __str__(self):
+        return (f"{self.name}: {self.done} bytes in {self.elapsed:.2f}s "
+                f"({self.rate / 1e6:.2f} MB/s)")
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def fraction(self):
+        return self.done / self.total if self.total else None
+
+    def restart(self):
+        self.done = 0
+        self.started = time.monotonic()
+
+    def update(self, size):
+        self.done += size
+        if self.callback is not None:
+            self.callback(self)
+
+    def finish(self):
+        self.finished = time.monotonic()
+        logging.info(str(self))
+        return self
+
+
+def print_progress(transfer):
+    """Progress callback that keeps one status line on stderr up to date."""
+    if transfer.total:
+        done = f"{transfer.fraction * 100:5.1f}% of {transfer.total}"
+    else:
+        done = f"{transfer.done} bytes"
+    sys.stderr.write(f"\r{transfer.name}: {done}  {transfer.rate / 1e6:.2f} MB/s ")
+    if transfer.total is not None and transfer.done >= transfer.total:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.parser = HttpParser('response')
+        self.idle_since = None
+
+    def next_event(self, max_data=None):
+        while True:
+            event = self.parser.next_event(max_data)
+            if event is not NEED_DATA:
+                return event
+            self.parser.recv_into(self.sock, READ_CHUNK_SIZE)
+
+    def is_stale(self):
+        # an idle connection with something to read was closed by the server
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def close(self):
+        self.sock.close()
+
+
+class Response:
+    """An HTTP response whose body is read from the connection on demand.
+
+    The body arrives through iter_content() (or read()/save()); bytes are
+    never decoded unless ``text`` is asked for. Once the body has been read
+    to the end the connection goes back to the client's pool.
+    """
+
+    def __init__(self, client, conn, status_line, headers):
+        self.client = client
+        self.conn = conn
+        self.version = status_line.version
+        self.status = status_line.status
+        self.reason = status_line.reason
+        self.headers = headers
+        self.done = False
+        self._content = None
+        # the upload's Transfer, for responses from upload_fileobj()
+        self.transfer = None
+        tokens = {t.strip().lower() for t in headers.get('connection', '').split(',')}
+        self.reusable = (self.version == 'HTTP/1.1' and 'close' not in tokens
+                         and not conn.parser.close_delimited)
+
+    def __repr__(self):
+        return f"<Response {self.status} {self.reason}>".replace(' >', '>')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def ok(self):
+        return self.status < 400
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise HttpError(self)
+        return self
+
+    def iter_content(self, chunk_size=READ_CHUNK_SIZE):
+        # chunks are memoryviews into the connection's buffer, valid until
+        # the next one is taken; copy them to keep them
+        if self._content is not None:
+            yield self._content
+            return
+        try:
+            while not self.done:
+                event = self.conn.next_event(chunk_size)
+                if isinstance(event, Data):
+                    yield event.data
+                elif isinstance(event, EndOfMessage):
+                    self._finish(True)
+        except BaseException:
+            self._finish(False)
+            raise
+
+    def read(self):
+        if self._content is None:
+            content = bytearray()
+            for chunk in self.iter_content():
+                content += chunk
+            self._content = bytes(content)
+        return self._content
+
+    content = property(read)
+
+    @property
+    def text(self):
+        _, _, charset = self.headers.get('content-type', '').partition('charset=')
+        return self.read().decode(charset.strip() or 'utf-8', errors='replace')
+
+    def save(self, path, progress=None):
+        """Stream the body into ``path`` and return the finished Transfer.
+
+        Only one chunk is in memory at a time; the file appears under its
+        name once it is complete.
+        """
+        length = self.headers.get('content-length')
+        transfer = Transfer(path, int(length) if length and length.isdigit() else None, progress)
+        partial = path + '.part'
+        try:
+            with open(partial, 'wb') as f:
+                for chunk in self.iter_content():
+                    f.write(chunk)
+                    transfer.update(len(chunk))
+            os.replace(partial, path)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        return transfer.finish()
+
+    def close(self):
+        # an unread body makes the connection useless for the next request
+        if not self.done:
+            self._finish(False)
+
+    def _finish(self, complete):
+        self.done = True
+        conn, self.conn = self.conn, None
+        if conn is not None:
+            self.client._release(conn, complete and self.reusable)
+
+
+class HttpClient:
+    """Keep-alive HTTP/1.1 client for one server, safe to share across threads.
+
+    Connections are pooled and reused between requests; response bodies are
+    parsed for Content-Length, chunked and close-delimited framing. The
+    *_many helpers run requests concurrently over a thread pool.
+    """
+
+    def __init__(self, host='localhost', port=8889, timeout=CONNECT_TIMEOUT,
+                 max_idle=MAX_IDLE_CONNECTIONS, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.ssl_context = ssl_context
+        self.idle = deque()
+        self.lock = threading.Lock()
+        self.connects = 0
+        self.reused = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _connect(self):
+        sock = make_socket(self.host, self.port, self.timeout)
+        if self.ssl_context is not None:
+            sock = self.ssl_context.wrap_socket(sock, server_hostname=self.host)
+        with self.lock:
+            self.connects += 1
+        return Connection(sock)
+
+    def _acquire(self):
+        now = time.monotonic()
         while True:
-            chunk = sock.recv(2048)
-            if not chunk:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn = self.idle.pop()
+            if now - conn.idle_since < IDLE_CONNECTION_TIMEOUT and not conn.is_stale():
+                with self.lock:
+                    self.reused += 1
+                return conn, True
+            conn.close()
+        return self._connect(), False
+
+    def _release(self, conn, reusable):
+        if reusable:
+            conn.idle_since = time.monotonic()
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+        for conn in idle:
+            conn.close()
+
+    def request(self, method, path, headers=None, body=None, stream=False,
+                chunked=False, progress=None):
+        """Send one request and return its Response.
+
+        ``body`` is bytes, a binary file object or an iterable of bytes.
+        File objects are streamed in UPLOAD_CHUNK_SIZE pieces, with a
+        Content-Length when their size is known unless ``chunked`` is set;
+        iterables are always sent chunked. ``progress`` is a Transfer
+        updated as the body goes out. With ``stream=True`` the response
+        body is left on the connection for iter_content()/save();
+        otherwise it is read now.
+        """
+        body_start = None
+        if is_file(body):
+            try:
+                body_start = body.tell() if body.seekable() else None
+            except (AttributeError, OSError):
+                pass
+        retryable = body is None or isinstance(body, (bytes, bytearray)) or body_start is not None
+        for attempt in (1, 2):
+            conn, reused = self._acquire()
+            if attempt == 2 and body_start is not None:
+                body.seek(body_start)
+                if progress is not None:
+                    progress.restart()
+            try:
+                conn.parser.request_method = method
+                # a server refusing an "Expect: 100-continue" body answers early
+                event = self._send(conn, method, path, headers or {}, body, chunked, progress)
+                refused = event is not None
+                if event is None:
+                    event = conn.next_event()
+                if event is CLOSED:
+                    raise ConnectionError("server closed the connection")
                 break
-            response_bytes += chunk
-        
-        return response_bytes.decode('utf-8', errors='ignore')
+            except (OSError, ParseError):
+                conn.close()
+                # the server may have closed an idle connection under us
+                if reused and retryable and attempt == 1:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+
+        try:
+            # skip interim (1xx) responses
+            while True:
+                if isinstance(event, StatusLine):
+                    status_line = event
+                elif isinstance(event, HeadersComplete):
+                    if status_line.status >= 200:
+                        break
+                event = conn.next_event()
+        except BaseException:
+            conn.close()
+            raise
 
-    except Exception as ee:
-        logging.error(f"Error during data exchange: {str(ee)}")
-        return ''
-    finally:
-        sock.close()
+        response = Response(self, conn, status_line, event.headers)
+        if refused:
+            # the declared body was never sent, so the framing is lost
+            response.reusable = False
+        if not stream:
+            response.read()
+        return response
 
+    def _send(self, conn, method, path, headers, body, chunked=False, progress=None):
+        # Returns None once the request is out, or the first event of a
+        # response that arrived instead of "100 Continue".
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.host}:{self.port}"]
+        names = {name.lower() for name in headers}
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        size = None
+        if isinstance(body, (bytes, bytearray)):
+            size = len(body)
+        elif is_file(body) and not chunked:
+            size = file_size(body)
+        if body is not None and size is None:
+            chunked = True
+        if chunked:
+            lines.append("Transfer-Encoding: chunked")
+        elif size is not None:
+            lines.append(f"Content-Length: {size}")
+        elif method in ('POST', 'PUT') and 'content-length' not in names:
+            lines.append("Content-Length: 0")
+        expect = is_file(body) and (size is None or size >= EXPECT_CONTINUE_SIZE)
+        if expect:
+            lines.append("Expect: 100-continue")
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
 
-def build_upload_request(filepath):
-    """Membangun request HTTP POST untuk mengunggah file."""
-    if not os.path.isfile(filepath):
-        logging.error(f"File '{filepath}' not found for upload.")
+        if body is None or isinstance(body, (bytes, bytearray)):
+            conn.sock.sendall(head + bytes(body or b""))
+            if body and progress is not None:
+                progress.update(len(body))
+            return None
+        conn.sock.sendall(head)
+        if expect:
+            event = self._await_continue(conn)
+            if event is not None:
+                return event
+        if is_file(body):
+            send_file(conn.sock, body, None if chunked else size, progress)
+            return None
+        for chunk in body:
+            if chunk:
+                conn.sock.sendall(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                if progress is not None:
+                    progress.update(len(chunk))
+        conn.sock.sendall(b"0\r\n\r\n")
         return None
-    
-    with open(filepath, 'rb') as f:
-        filedata = f.read()
-    
-    filename = os.path.basename(filepath)
-    filedata_b64 = base64.b64encode(filedata).decode()
-    
-    payload = {'filename': filename, 'data': filedata_b64}
-    body = urlencode(payload)
-    # -----------------------
-
-    body_bytes = body.encode('utf-8')
-    content_length = len(body_bytes)
-
-    request = (
-        f'POST /upload HTTP/1.1\r\n'
-        f'Host: {server_address[0]}\r\n'
-        f'Content-Length: {content_length}\r\n'
-        f'Content-Type: application/x-www-form-urlencoded\r\n'
-        f'Connection: close\r\n'
-        f'\r\n'
-        f'{body}'
-    )
-    return request
+
+    def _await_continue(self, conn):
+        if not conn.parser.buffered:
+            readable, _, _ = select.select([conn.sock], [], [], EXPECT_TIMEOUT)
+            if not readable:
+                return None
+        event = conn.next_event()
+        if isinstance(event, StatusLine) and event.status == 100:
+            while not isinstance(event, EndOfMessage):
+                event = conn.next_event()
+            return None
+        return event
+
+    def get(self, path, headers=None, stream=False):
+        return self.request('GET', path, headers, stream=stream)
+
+    def put(self, path, body, headers=None):
+        return self.request('PUT', path, headers, body)
+
+    def post(self, path, body, headers=None):
+        return self.request('POST', path, headers, body)
+
+    def list(self, prefix='', limit=None):
+        """All file names on the server, following the listing's cursors."""
+        names = []
+        params = {'format': 'json'}
+        if prefix:
+            params['prefix'] = prefix
+        if limit:
+            params['limit'] = limit
+        while True:
+            page = self.get('/list?' + urlencode(params)).raise_for_status()
+            data = json.loads(page.content)
+            names.extend(entry['name'] for entry in data['files'])
+            if not data.get('next_cursor'):
+                return names
+            params['cursor'] = data['next_cursor']
+
+    def download(self, name, dest, progress=None):
+        """Stream file ``name`` to ``dest``; returns the finished Transfer."""
+        with self.get('/' + quote(name), stream=True) as response:
+            response.raise_for_status()
+            return response.save(dest, progress)
+
+    def upload(self, filepath, name=None, chunked=False, progress=None):
+        with open(filepath, 'rb') as f:
+            return self.upload_fileobj(f, name or os.path.basename(filepath), chunked, progress)
+
+    def upload_fileobj(self, fileobj, name, chunked=False, progress=None):
+        """Stream a binary file object to PUT /files/<name>.
+
+        The response carries the finished Transfer as ``response.transfer``.
+        """
+        transfer = Transfer(name, None if chunked else file_size(fileobj), progress)
+        response = self.request('PUT', '/files/' + quote(name),
+                                {'Content-Type': 'application/octet-stream'},
+                                fileobj, chunked=chunked, progress=transfer)
+        response.transfer = transfer.finish()
+        return response.raise_for_status()
+
+    def delete(self, name):
+        return self.get('/delete/' + quote(name)).raise_for_status()
+
+    def map(self, func, items, workers=BATCH_WORKERS):
+        """Run ``func(item)`` concurrently; returns BatchResults in input order."""
+        items = list(items)
+        # keep a connection per worker instead of churning through them
+        self.max_idle = max(self.max_idle, workers)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(func, item) for item in items]
+        results = []
+        for item, future in zip(items, futures):
+            try:
+                results.append(BatchResult(item, future.result(), None))
+            except Exception as e:
+                results.append(BatchResult(item, None, e))
+        return results
+
+    def get_many(self, names, dest_dir=None, workers=BATCH_WORKERS):
+        """GET many files; saved under ``dest_dir`` if given, else kept in memory."""
+        def fetch(name):
+            if dest_dir is None:
+                return self.get('/' + quote(name)).raise_for_status().content
+            return self.download(name, os.path.join(dest_dir, os.path.basename(name)))
+        return self.map(fetch, names, workers)
+
+    def upload_many(self, filepaths, workers=BATCH_WORKERS):
+        return self.map(self.upload, filepaths, workers)
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    try:
+        server_address = (sys.argv[1], int(sys.argv[2]))
+    except (IndexError, ValueError):
+        pass
+    client = HttpClient(*server_address)
 
     # 1. LIST: Meminta daftar file di server
     print("\n--- 1. LIST DIRECTORY (AWAL) ---")
-    list_request = f'GET /list HTTP/1.1\r\nHost: {server_address[0]}\r\nConnection: close\r\n\r\n'
-    print(send_request(list_request))
+    print(client.get('/list').text)
 
     # 2. UPLOAD: Mengunggah file
     print(f"\n--- 2. UPLOAD FILE '{FILE_TO_UPLOAD}' ---")
@@ -93,27 +593,24 @@ if __name__ == '__main__':
         with open(FILE_TO_UPLOAD, "w") as f:
             f.write("This is a dummy file for testing.")
         print(f"'{FILE_TO_UPLOAD}' not found, created a dummy file.")
-
-    upload_request = build_upload_request(FILE_TO_UPLOAD)
-    if upload_request:
-        print(send_request(upload_request))
+    response = client.upload(FILE_TO_UPLOAD, progress=print_progress)
+    print(response.text)
+    print(response.transfer)
 
     # 3. LIST: Memeriksa daftar file setelah upload
     print("\n--- 3. LIST SETELAH UPLOAD ---")
-    list_request_after = f'GET /list HTTP/1.1\r\nHost: {server_address[0]}\r\nConnection: close\r\n\r\n'
-    print(send_request(list_request_after))
+    print(client.get('/list').text)
 
-    # 4. GET (FAIL): Mencoba melihat file yang tidak ada
-    print("\n--- 4. LIHAT FILE (Contoh Gagal) ---")
-    get_fail_req = f'GET /client_image.jpg HTTP/1.1\r\nHost: {server_address[0]}\r\nConnection: close\r\n\r\n'
-    print(send_request(get_fail_req))
+    # 4. GET: Mengunduh file yang tadi diunggah langsung ke disk
+    print("\n--- 4. DOWNLOAD FILE ---")
+    print(client.download(FILE_TO_UPLOAD, 'downloaded_' + FILE_TO_UPLOAD, print_progress))
 
     # 5. DELETE: Menghapus file yang tadi diunggah
     print(f"\n--- 5. DELETE '{FILE_TO_DELETE}' ---")
-    delete_request = f'GET /delete/{FILE_TO_DELETE} HTTP/1.1\r\nHost: {server_address[0]}\r\nConnection: close\r\n\r\n'
-    print(send_request(delete_request))
+    print(client.get('/delete/' + FILE_TO_DELETE).text)
 
     # 6. LIST: Memeriksa daftar file setelah delete
     print("\n--- 6. LIST SETELAH DELETE ---")
-    list_request_final = f'GET /list HTTP/1.1\r\nHost: {server_address[0]}\r\nConnection: close\r\n\r\n'
-    print(send_request(list_request_final))
\ No newline at end of file
+    print(client.get('/list').text)
+    print(f"\n{client.connects} connection(s) for 6 requests")
+    client.close()
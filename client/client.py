@@ -4,6 +4,7 @@ import json
 import logging
 import ssl
 import os
+import io
 
 server_address = ('www.its.ac.id', 443)
 server_address = ('www.ietf.org',443)
@@ -41,7 +42,138 @@ def make_secure_socket(destination_address='localhost', port=10000):
 
 
 
-def send_command(command_str, is_secure=False):
+# body dibaca dan ditulis per blok sebesar ini, tidak pernah utuh di memori
+CHUNK_SIZE = 65536
+
+
+def recv_until(sock, data, marker):
+    # tambah data dari socket sampai marker muncul (atau koneksi ditutup)
+    while marker not in data:
+        chunk = sock.recv(CHUNK_SIZE)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def recv_more(sock, data):
+    # tambah satu blok dari socket ke buffer; False kalau koneksi sudah ditutup
+    chunk = sock.recv(CHUNK_SIZE)
+    if not chunk:
+        return False
+    data += chunk
+    return True
+
+
+def read_chunked(sock, data, out):
+    # buffer dibaca lewat offset pos, tidak dipotong tiap chunk; isi chunk
+    # langsung ditulis ke out begitu datang, bagian yang sudah terpakai
+    # dibuang sesekali
+    data = bytearray(data)
+    pos = 0
+    while True:
+        end = data.find(b"\r\n", pos)
+        while end < 0:
+            if not recv_more(sock, data):
+                raise ConnectionError("connection closed before the last chunk")
+            end = data.find(b"\r\n", pos)
+        size_line = bytes(data[pos:end])
+        try:
+            size = int(size_line.split(b";")[0].strip(), 16)
+            if size < 0:
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"invalid chunk size line {size_line!r}") from None
+        pos = end + 2
+        if size == 0:
+            # chunk terakhir; trailer (kalau ada) diabaikan
+            return
+        remaining = size
+        while remaining:
+            if pos == len(data):
+                del data[:]
+                pos = 0
+                if not recv_more(sock, data):
+                    raise ConnectionError(f"connection closed in the middle of a chunk "
+                                          f"({size - remaining} of {size} bytes)")
+            n = min(remaining, len(data) - pos)
+            out.write(data[pos:pos + n])
+            pos += n
+            remaining -= n
+        while len(data) - pos < 2:
+            if not recv_more(sock, data):
+                raise ConnectionError("connection closed before the CRLF after a chunk")
+        if data[pos:pos + 2] != b"\r\n":
+            raise ValueError("chunk data not followed by CRLF")
+        pos += 2
+        if pos >= CHUNK_SIZE:
+            del data[:pos]
+            pos = 0
+
+
+def read_response(sock, out):
+    """Read one HTTP response from sock, writing its body to ``out``.
+
+    The body is framed by Content-Length, chunked encoding, or, failing
+    both, by the server closing the connection, and is copied to the
+    binary file object ``out`` in blocks of at most CHUNK_SIZE bytes.
+    Chunked bodies are written de-chunked. Returns the head (status line
+    and headers, with the blank line) as bytes and the headers as a dict
+    of lower-cased byte names.
+    """
+    data = recv_until(sock, b"", b"\r\n\r\n")
+    head, _, body = data.partition(b"\r\n\r\n")
+    lines = head.split(b"\r\n")
+    status = lines[0].split()
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        headers[name.strip().lower()] = value.strip()
+    head += b"\r\n\r\n"
+
+    if len(status) > 1 and (status[1].startswith(b"1") or status[1] in (b"204", b"304")):
+        return head, headers
+    if b"chunked" in headers.get(b"transfer-encoding", b"").lower():
+        read_chunked(sock, body, out)
+    elif b"content-length" in headers:
+        length = int(headers[b"content-length"])
+        body = body[:length]
+        out.write(body)
+        received = len(body)
+        while received < length:
+            chunk = sock.recv(min(CHUNK_SIZE, length - received))
+            if not chunk:
+                raise ConnectionError(f"connection closed after {received} of {length} body bytes")
+            out.write(chunk)
+            received += len(chunk)
+    else:
+        out.write(body)
+        while True:
+            chunk = sock.recv(CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+    return head, headers
+
+
+def is_text(headers):
+    # hanya body teks (text/*, JSON, XML) tanpa kompresi yang aman di-decode
+    encoding = headers.get(b"content-encoding", b"identity").strip().lower()
+    if encoding not in (b"", b"identity"):
+        return False
+    content_type = headers.get(b"content-type", b"").split(b";")[0].strip().lower()
+    return (content_type.startswith(b"text/") or content_type.endswith(b"json")
+            or content_type.endswith(b"xml"))
+
+
+def send_command(command_str, is_secure=False, output=None):
+    """Send one request and read its response.
+
+    With ``output`` (a path or a binary file object) the body is streamed
+    there and only the head is returned, as str. Without it the whole
+    response is returned: as str for text bodies, as bytes otherwise, so
+    binary content is never mangled by decoding. False on any error.
+    """
     alamat_server = server_address[0]
     port_server = server_address[1]
     #    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -52,31 +184,41 @@ def send_command(command_str, is_secure=False):
         sock = make_socket(alamat_server, port_server)
 
     logging.warning(f"connecting to {server_address}")
+    # output berupa path: file dibuka di sini dan dihapus lagi kalau gagal
+    path = output if isinstance(output, (str, os.PathLike)) else None
+    out = None
     try:
+        if path is not None:
+            out = open(path, 'wb')
+        elif output is not None:
+            out = output
+        else:
+            out = io.BytesIO()
         logging.warning(f"sending message ")
         sock.sendall(command_str.encode())
         logging.warning(command_str)
-        # Look for the response, waiting until socket is done (no more data)
-        data_received = ""  # empty string
-        while True:
-            # socket does not receive all data at once, data comes in part, need to be concatenated at the end of process
-            data = sock.recv(2048)
-            if data:
-                # data is not empty, concat with previous content
-                data_received += data.decode()
-                if "\r\n\r\n" in data_received:
-                    break
-            else:
-                # no more data, stop the process by break
-                break
-        # at this point, data_received (string) will contain all data coming from the socket
-        # to be able to use the data_received as a dict, need to load it using json.loads()
-        hasil = data_received
+        # baca header lalu body sesuai Content-Length / chunked,
+        # jadi body tidak terpotong di \r\n\r\n pertama
+        head, headers = read_response(sock, out)
         logging.warning("data received from server:")
-        return hasil
+        if output is not None:
+            return head.decode('latin-1')
+        body = out.getvalue()
+        if is_text(headers):
+            return (head + body).decode(errors='replace')
+        return head + body
     except Exception as ee:
         logging.warning(f"error during data receiving {str(ee)}")
+        if path is not None and out is not None:
+            out.close()
+            out = None
+            os.remove(path)
         return False
+    finally:
+        if path is not None and out is not None:
+            out.close()
+        if sock is not None:
+            sock.close()
 
 #> GET / HTTP/1.1
 #> Host: www.its.ac.id
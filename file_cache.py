@@ -0,0 +1,123 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Total bytes of file content the cache may hold, and the largest single
+# file worth caching; bigger files are streamed from disk with sendfile.
+CACHE_MAX_BYTES = 32 * 1024 * 1024
+CACHE_MAX_FILE_SIZE = 1024 * 1024
+# How long (seconds) a cached entry is trusted before it is re-stat()ed.
+# Changes made through the server itself invalidate entries immediately.
+CACHE_REVALIDATE_INTERVAL = 1.0
+
+
+class CachedFile:
+    __slots__ = ('path', 'data', 'size', 'stat_key', 'content_type',
+                 'etag', 'mtime', 'headers', 'checked_at')
+
+    def __init__(self, path, st, data, content_type, etag, mtime, headers):
+        self.path = path
+        self.data = data
+        self.size = len(data)
+        self.stat_key = stat_key(st)
+        self.content_type = content_type
+        self.etag = etag
+        self.mtime = mtime
+        self.headers = headers
+        self.checked_at = time.monotonic()
+
+
+def stat_key(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class FileCache:
+    """Thread-safe LRU cache of small static files, bounded by total size."""
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, max_file_size=CACHE_MAX_FILE_SIZE,
+                 revalidate_interval=CACHE_REVALIDATE_INTERVAL):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.revalidate_interval = revalidate_interval
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def accepts(self, size):
+        return size <= self.max_file_size and size <= self.max_bytes
+
+    def lookup(self, path):
+        key = os.path.abspath(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+
+        now = time.monotonic()
+        if now - entry.checked_at >= self.revalidate_interval:
+            try:
+                st = os.stat(key)
+            except OSError:
+                st = None
+            if st is None or stat_key(st) != entry.stat_key:
+                with self.lock:
+                    self._remove(key, entry)
+                    self.misses += 1
+                return None
+            entry.checked_at = now
+
+        with self.lock:
+            self.hits += 1
+        return entry
+
+    def store(self, path, st, data, content_type, etag, mtime, headers):
+        if not self.accepts(len(data)):
+            return None
+        key = os.path.abspath(path)
+        entry = CachedFile(key, st, data, content_type, etag, mtime, headers)
+        with self.lock:
+            self._remove(key, self.entries.get(key))
+            self.entries[key] = entry
+            self.current_bytes += entry.size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= evicted.size
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, path):
+        key = os.path.abspath(path)
+        with self.lock:
+            self._remove(key, self.entries.get(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _remove(self, key, entry):
+        # caller holds self.lock; only drop the entry we actually looked at
+        if entry is not None and self.entries.get(key) is entry:
+            del self.entries[key]
+            self.current_bytes -= entry.size
+
+
+# Shared by every Http instance (and therefore every worker thread) in the process.
+file_cache = FileCache()
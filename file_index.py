@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import base64
+import bisect
+import threading
+
+# How often (seconds) the directory itself is re-stat()ed to pick up files
+# added or removed behind the server's back.
+INDEX_RESCAN_INTERVAL = 2.0
+SORT_KEYS = ('name', 'size', 'mtime')
+
+
+class IndexEntry:
+    __slots__ = ('name', 'size', 'mtime')
+
+    def __init__(self, name, size, mtime):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+
+    def as_dict(self):
+        return {'name': self.name, 'size': self.size, 'mtime': self.mtime}
+
+
+def encode_cursor(sort, key, name):
+    raw = json.dumps([sort, key, name]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, key, name = json.loads(raw)
+    except (ValueError, TypeError):
+        raise ValueError("invalid cursor")
+    if cursor_sort != sort:
+        raise ValueError("cursor belongs to a different sort order")
+    return key, name
+
+
+class FileIndex:
+    """In-memory index of the regular files in one directory.
+
+    Built once with os.scandir and then kept current by the server's own
+    uploads and deletes, plus a cheap directory mtime check that triggers a
+    rescan when something else changed it. Listing a page costs a binary
+    search plus the page itself, not a walk over the whole directory.
+    """
+
+    def __init__(self, directory, rescan_interval=INDEX_RESCAN_INTERVAL):
+        self.directory = directory
+        self.rescan_interval = rescan_interval
+        self.entries = {}
+        self.names = []
+        # sort key -> sorted list of (value, name), rebuilt lazily after changes
+        self.sorted_views = {}
+        self.dir_mtime = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def _scan(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries[entry.name] = IndexEntry(entry.name, st.st_size, int(st.st_mtime))
+        self.entries = entries
+        self.names = sorted(entries)
+        self.sorted_views = {}
+        self.dir_mtime = os.stat(self.directory).st_mtime_ns
+        self.checked_at = time.monotonic()
+
+    def _ensure_fresh(self):
+        # caller holds self.lock
+        if self.dir_mtime is None:
+            self._scan()
+            return
+        now = time.monotonic()
+        if now - self.checked_at < self.rescan_interval:
+            return
+        self.checked_at = now
+        try:
+            dir_mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            dir_mtime = None
+        if dir_mtime != self.dir_mtime:
+            self._scan()
+
+    def _note_own_change(self, change):
+        # Our own rename/unlink bumped the directory mtime. ``change`` is the
+        # directory's mtime just before and just after that write: adopt the
+        # new one only if the index was current before it, otherwise another
+        # process (or anything else) changed the directory too, and the next
+        # lookup must rescan rather than absorb that change.
+        if change is not None and change[0] == self.dir_mtime:
+            self.dir_mtime = change[1]
+        else:
+            self.checked_at = 0.0
+        self.sorted_views = {}
+
+    def get(self, name):
+        with self.lock:
+            self._ensure_fresh()
+            return self.entries.get(name)
+
+    def __len__(self):
+        with self.lock:
+            self._ensure_fresh()
+            return len(self.entries)
+
+    def update(self, name, change=None):
+        path = os.path.join(self.directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            self.remove(name, change)
+            return
+        with self.lock:
+            if self.dir_mtime is None:
+                self._scan()
+                return
+            if name not in self.entries:
+                bisect.insort(self.names, name)
+            self.entries[name] = IndexEntry(name, st.st_size, int(st.st_mtime))
+            self._note_own_change(change)
+
+    def remove(self, name, change=None):
+        with self.lock:
+            if self.dir_mtime is None:
+                self._scan()
+                return
+            if self.entries.pop(name, None) is not None:
+                i = bisect.bisect_left(self.names, name)
+                if i < len(self.names) and self.names[i] == name:
+                    del self.names[i]
+            self._note_own_change(change)
+
+    def _view(self, sort):
+        if sort == 'name':
+            return None
+        view = self.sorted_views.get(sort)
+        if view is None:
+            view = sorted((getattr(e, sort), e.name) for e in self.entries.values())
+            self.sorted_views[sort] = view
+        return view
+
+    def page(self, prefix='', sort='name', descending=False, limit=1000, cursor=None):
+        """Return ``(entries, next_cursor)`` for one page of the listing.
+
+        Raises ValueError for an unknown sort key or a malformed cursor.
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError(f"unknown sort key {sort!r}")
+        after = decode_cursor(cursor, sort) if cursor else None
+
+        with self.lock:
+            self._ensure_fresh()
+            if sort == 'name':
+                keys = self.names
+                lo, hi = 0, len(keys)
+                if prefix:
+                    lo = bisect.bisect_left(keys, prefix)
+                    hi = bisect.bisect_left(keys, prefix + '\U0010ffff', lo)
+                if after is not None:
+                    if descending:
+                        hi = min(hi, bisect.bisect_left(keys, after[1], lo, hi))
+                    else:
+                        lo = max(lo, bisect.bisect_right(keys, after[1], lo, hi))
+                positions = range(hi - 1, lo - 1, -1) if descending else range(lo, hi)
+                items = (self.entries[keys[i]] for i in positions)
+            else:
+                view = self._view(sort)
+                lo, hi = 0, len(view)
+                if after is not None:
+                    mark = (after[0], after[1])
+                    if descending:
+                        hi = bisect.bisect_left(view, mark)
+                    else:
+                        lo = bisect.bisect_right(view, mark)
+                positions = range(hi - 1, lo - 1, -1) if descending else range(lo, hi)
+                # with a prefix this filters as it goes; name order avoids that
+                items = (self.entries[view[i][1]] for i in positions
+                         if view[i][1].startswith(prefix))
+
+            result = []
+            for entry in items:
+                if len(result) == limit:
+                    last = result[-1]
+                    return result, encode_cursor(sort, getattr(last, sort), last.name)
+                result.append(entry)
+            return result, None
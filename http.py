@@ -1,106 +1,921 @@
 import sys
 import os
+import time
 import socket
 import logging
 import base64
+import json
+import gzip
+import hashlib
+import secrets
+import shutil
+import tempfile
+import zlib
+from email.utils import formatdate, parsedate_to_datetime
 from urllib.parse import parse_qs, unquote, urlencode
+import metrics
+import access_log
+from response_writer import status_line, head_prefix, connection_block, send_buffers
+from file_cache import file_cache
+from file_index import FileIndex
+from storage import ContentStore
+from http_parser import HttpParser, ParseError, RequestLine, HeadersComplete, Data, EndOfMessage, NEED_DATA, CLOSED
+
+# Idle time (seconds) a persistent connection may wait for its next request,
+# and how many requests one connection may carry before the server closes it.
+KEEPALIVE_TIMEOUT = 15
+KEEPALIVE_MAX_REQUESTS = 100
+# Once a request has started arriving, how long one read may wait for more
+# of its head or body. Slow uploads get this, not the idle timeout.
+REQUEST_READ_TIMEOUT = 60
+RECV_SIZE = 2048
+# Block size for streaming files when the socket can't sendfile(); peak
+# memory per response stays at one block regardless of file size.
+FILE_CHUNK_SIZE = 64 * 1024
+# Uploads are moved to disk in blocks of this size, so memory per upload
+# stays flat however large the file is.
+UPLOAD_CHUNK_SIZE = 64 * 1024
+# Unread request bodies up to this size are discarded to keep the connection
+# alive; anything bigger closes it instead.
+MAX_DRAIN_SIZE = 1024 * 1024
+MAX_PART_HEADER_SIZE = 16 * 1024
+# Uploaded files live here; GETs fall back to the working directory for the
+# server's own static pages.
+STORAGE_DIR = 'files'
+# Page size for /list when the client doesn't ask, and the most it may ask for.
+LIST_DEFAULT_LIMIT = 1000
+LIST_MAX_LIMIT = 10000
+# /list pages are streamed as a chunked response, one chunk per this many
+# bytes of listing, instead of being built into one body first.
+LIST_CHUNK_SIZE = 16 * 1024
+# Requests asking for more (non-overlapping) ranges than this get the whole
+# file instead of a multipart/byteranges reply.
+MAX_RANGES = 16
+# Send W/"..." validators instead of strong ones. Weak tags still allow 304s
+# but disable If-Range, which needs byte-for-byte equality.
+WEAK_ETAGS = False
+
+# extension -> (Content-Type, Cache-Control)
+CONTENT_TYPES = {
+    '.jpg': ('image/jpeg', 'public, max-age=86400'),
+    '.jpeg': ('image/jpeg', 'public, max-age=86400'),
+    '.png': ('image/png', 'public, max-age=86400'),
+    '.pdf': ('application/pdf', 'public, max-age=86400'),
+    '.txt': ('text/plain', 'no-cache'),
+    '.html': ('text/html', 'no-cache'),
+}
+DEFAULT_CONTENT_TYPE = ('application/octet-stream', 'no-cache')
+
+# Besides text/*, the types worth gzipping. JPEG, PNG and PDF are already
+# compressed and go out as they are.
+COMPRESSIBLE_TYPES = {
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'image/svg+xml',
+}
+# Bodies smaller than this aren't worth the CPU (or the gzip header).
+GZIP_MIN_SIZE = 1024
+GZIP_LEVEL = 6
+# Gzipped copies of static files, one per file version.
+GZIP_CACHE_DIR = '.gzcache'
+
+
+def content_type_for(filename):
+    return CONTENT_TYPES.get(os.path.splitext(filename)[1].lower(), DEFAULT_CONTENT_TYPE)
+
+
+def is_compressible(content_type):
+    mime = content_type.split(';', 1)[0].strip().lower()
+    return mime.startswith('text/') or mime in COMPRESSIBLE_TYPES
+
+
+def accepts_gzip(request_headers):
+    value = request_headers.get('accept-encoding')
+    if not value:
+        return False
+    qualities = {}
+    for item in value.split(','):
+        coding, _, params = item.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[coding.strip().lower()] = q
+    if 'gzip' in qualities:
+        return qualities['gzip'] > 0
+    return qualities.get('*', 0) > 0
+
+
+def gzip_sidecar_path(filepath, mtime_ns, size):
+    digest = hashlib.sha1(os.path.abspath(filepath).encode('utf-8', 'surrogateescape')).hexdigest()[:20]
+    return os.path.join(GZIP_CACHE_DIR, f"{digest}-{mtime_ns:x}-{size:x}.gz")
+
+
+def drop_gzip_sidecars(filepath, keep=None):
+    prefix = os.path.basename(gzip_sidecar_path(filepath, 0, 0)).split('-', 1)[0] + '-'
+    try:
+        names = os.listdir(GZIP_CACHE_DIR)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(GZIP_CACHE_DIR, name)
+        if name.startswith(prefix) and name.endswith('.gz') and path != keep:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            file_cache.invalidate(path)
+
+
+def http_date(timestamp):
+    return formatdate(timestamp, usegmt=True)
+
+
+def parse_http_date(value):
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def file_etag(st, weak=None, suffix=''):
+    tag = f'"{st.st_mtime_ns:x}-{st.st_size:x}{suffix}"'
+    if weak is None:
+        weak = WEAK_ETAGS
+    return 'W/' + tag if weak else tag
+
+
+def content_etag(digest, weak=None, suffix=''):
+    # files from the content store: the same bytes always get the same tag
+    tag = f'"{digest[:32]}{suffix}"'
+    if weak is None:
+        weak = WEAK_ETAGS
+    return 'W/' + tag if weak else tag
+
+
+def etag_matches(value, etag):
+    """Weak comparison of an If-None-Match header against ``etag``."""
+    if value.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in value.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def parse_range(value, size):
+    """Parse a ``Range: bytes=...`` header against a file of ``size`` bytes.
+
+    Returns a sorted list of inclusive ``(start, end)`` pairs with
+    overlapping ranges merged, an empty list when nothing is satisfiable
+    (416), or None when the header should be ignored and the full file sent.
+    """
+    unit, _, spec = value.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        first, dash, last = part.partition('-')
+        if not dash:
+            return None
+        try:
+            if first.strip() == '':
+                # suffix range: the last N bytes
+                length = int(last)
+                if length < 0:
+                    return None
+                if length == 0 or size == 0:
+                    continue
+                ranges.append((max(size - length, 0), size - 1))
+            else:
+                start = int(first)
+                if start < 0:
+                    return None
+                if last.strip():
+                    end = int(last)
+                    if end < start:
+                        return None
+                else:
+                    end = size - 1
+                if start >= size:
+                    continue
+                ranges.append((start, min(end, size - 1)))
+        except ValueError:
+            return None
+
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    if len(merged) > MAX_RANGES:
+        return None
+    return merged
+
+
+def parse_header_params(value):
+    """Split ``type; a=1; b="x"`` into ``('type', {'a': '1', 'b': 'x'})``."""
+    main, *params = value.split(';')
+    parsed = {}
+    for param in params:
+        key, eq, val = param.strip().partition('=')
+        if eq:
+            val = val.strip()
+            if len(val) >= 2 and val[0] == val[-1] == '"':
+                val = val[1:-1].replace('\\"', '"')
+            parsed[key.strip().lower()] = val
+    return main.strip().lower(), parsed
+
+
+def safe_filename(name):
+    if not name:
+        return None
+    name = os.path.basename(unquote(name).replace('\\', '/'))
+    if name in ('', '.', '..'):
+        return None
+    return name
+
+
+class BodyReader:
+    """Streams a request body out of the connection's parser.
+
+    Handlers decide whether a body is kept in memory or moved somewhere
+    else; nothing is read from the socket until they ask for it. Trailers
+    of a chunked body are available in ``trailers`` once it has ended.
+    """
+
+    def __init__(self, http, expect_continue=False):
+        self.http = http
+        self.expect_continue = expect_continue
+        self.continued = False
+        self.done = False
+        self.trailers = {}
+        # body bytes taken off the connection so far
+        self.received = 0
+
+    @property
+    def remaining(self):
+        # bytes still expected for a Content-Length body, 0 if unknown
+        return 0 if self.done or self.http.parser.chunked else self.http.parser.body_remaining
+
+    def send_continue(self):
+        if self.expect_continue and not self.continued:
+            self.continued = True
+            self.http.connection.sendall(status_line(100) + b"\r\n")
+
+    def read(self, size=-1):
+        if self.done:
+            return b""
+        self.send_continue()
+        if size < 0:
+            # chunks are views into the parser's buffer, only valid until
+            # the next one is read
+            body = bytearray()
+            for chunk in self.iter_chunks():
+                body += chunk
+            return bytes(body)
+
+        while True:
+            event = self.http.read_event(max_data=size)
+            if isinstance(event, Data):
+                self.received += len(event.data)
+                return event.data
+            if isinstance(event, EndOfMessage):
+                self.trailers = event.trailers
+                self.done = True
+                return b""
+
+    def iter_chunks(self, size=UPLOAD_CHUNK_SIZE):
+        while not self.done:
+            data = self.read(size)
+            if data:
+                yield data
+
+    def drain(self, limit=None):
+        # Returns False when more than ``limit`` bytes would have to be skipped.
+        drained = 0
+        for chunk in self.iter_chunks():
+            drained += len(chunk)
+            if limit is not None and drained > limit:
+                return False
+        return True
+
+
+class MultipartReader:
+    """Incremental multipart/form-data parser over a BodyReader.
+
+    Call next_part() for the headers of each part and iter_data() to stream
+    its content; unread content is skipped by the next next_part() call.
+    """
+
+    def __init__(self, body, boundary):
+        self.body = body
+        self.delimiter = b"\r\n--" + boundary.encode('latin-1')
+        # the first boundary has no leading CRLF; pretend it does
+        self.buffer = b"\r\n"
+        self.in_part = True
+        self.finished = False
+
+    def fill(self):
+        chunk = self.body.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            raise ValueError("multipart body ended before the closing boundary")
+        self.buffer += chunk
+
+    def iter_data(self):
+        keep = len(self.delimiter) - 1
+        while self.in_part:
+            index = self.buffer.find(self.delimiter)
+            if index >= 0:
+                if index:
+                    yield self.buffer[:index]
+                self.buffer = self.buffer[index + len(self.delimiter):]
+                self.in_part = False
+                return
+            if len(self.buffer) > keep:
+                yield self.buffer[:-keep]
+                self.buffer = self.buffer[-keep:]
+            self.fill()
+
+    def next_part(self):
+        if self.finished:
+            return None
+        for _ in self.iter_data():
+            pass
+
+        while len(self.buffer) < 2:
+            self.fill()
+        if self.buffer.startswith(b"--"):
+            self.finished = True
+            return None
+        while b"\r\n" not in self.buffer:
+            if len(self.buffer) > MAX_PART_HEADER_SIZE:
+                raise ValueError("malformed multipart boundary line")
+            self.fill()
+        self.buffer = self.buffer.split(b"\r\n", 1)[1]
+
+        if self.buffer.startswith(b"\r\n"):
+            head, self.buffer = b"", self.buffer[2:]
+        else:
+            while b"\r\n\r\n" not in self.buffer:
+                if len(self.buffer) > MAX_PART_HEADER_SIZE:
+                    raise ValueError("multipart part headers too large")
+                self.fill()
+            head, self.buffer = self.buffer.split(b"\r\n\r\n", 1)
+
+        headers = {}
+        for line in head.decode('utf-8', errors='replace').split("\r\n"):
+            key, colon, value = line.partition(':')
+            if colon:
+                headers[key.strip().lower()] = value.strip()
+        self.in_part = True
+        return headers
+
+
+file_index = FileIndex(STORAGE_DIR)
+store = ContentStore(STORAGE_DIR)
+
+# name -> callable returning a JSON-serialisable dict; served at /stats
+STATS_SOURCES = {'file_cache': file_cache.stats, 'access_log': access_log.stats, 'storage': store.stats}
+# pid that registered each source; forked workers inherit the parent's
+# sources but not the live objects behind them, so they leave them out
+STATS_OWNERS = {}
+
+# Request methods with a label of their own; anything else counts as OTHER.
+METRIC_METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'OPTIONS', 'PATCH'}
+metrics.describe('http_requests_total', 'counter', "Requests answered, by method, route and status.",
+                 ('method', 'route', 'status'))
+metrics.describe('http_request_duration_seconds', 'histogram', "Time to answer a request, by route.",
+                 ('route',), metrics.LATENCY_BUCKETS)
+metrics.describe('http_request_body_bytes_total', 'counter', "Request body bytes received, by route.",
+                 ('route',))
+metrics.describe('http_response_bytes_total', 'counter', "Response bytes sent, by route.", ('route',))
+metrics.describe('http_connections_active', 'gauge', "Client connections currently open.")
+metrics.describe('http_connections_total', 'counter', "Client connections accepted.")
+
+
+def register_stats(name, source):
+    STATS_SOURCES[name] = source
+    STATS_OWNERS[name] = os.getpid()
+
+
+def local_stats_sources():
+    pid = os.getpid()
+    return {name: source for name, source in list(STATS_SOURCES.items())
+            if STATS_OWNERS.get(name, pid) == pid}
+
+
+def stats_metrics():
+    # every /stats source shows up in /metrics as gauges
+    for name, source in local_stats_sources().items():
+        yield from metrics.stats_samples(name, source())
+
+
+metrics.register_collector(stats_metrics)
+
+
+def connection_opened():
+    metrics.inc('http_connections_total')
+    metrics.inc('http_connections_active')
+
+
+def connection_closed():
+    metrics.inc('http_connections_active', value=-1)
+
+
+def storage_path(filename):
+    return os.path.join(STORAGE_DIR, filename)
+
 
 class Http:
-    def __init__(self):
-        pass
+    def __init__(self, keepalive_timeout=KEEPALIVE_TIMEOUT, max_requests=KEEPALIVE_MAX_REQUESTS,
+                 limits=None, read_timeout=REQUEST_READ_TIMEOUT):
+        self.keepalive_timeout = keepalive_timeout
+        self.read_timeout = read_timeout
+        self.timeout = None
+        self.max_requests = max_requests
+        # HttpParser keyword arguments: max_line_size, max_header_size,
+        # max_header_count, max_body_size
+        self.limits = limits or {}
+        self.parser = HttpParser('request', **self.limits)
+        self.keep_alive = False
+        self.requests_handled = 0
+        self.request_version = 'HTTP/1.1'
+        self.chunked = False
+        self.accept_gzip = False
+        self.compressor = None
+        self.route = None
+        self.status = None
+        self.bytes_out = 0
+
+    def sendall(self, data):
+        self.connection.sendall(data)
+        self.bytes_out += len(data)
+
+    def sendv(self, buffers, more=False):
+        # head and body go out in one writev, neither copied into the other
+        self.bytes_out += send_buffers(self.connection, buffers, more)
+
+    def connection_headers(self):
+        return connection_block(self.keep_alive, int(self.keepalive_timeout),
+                                self.max_requests - self.requests_handled)
 
-    def send_response(self, code, body, content_type='text/plain; charset=utf-8'):
-        status_line = f"HTTP/1.1 {code}\r\n"
-        headers = f"Content-Type: {content_type}\r\n"
-        headers += f"Content-Length: {len(body)}\r\n"
-        headers += "Connection: close\r\n\r\n"
-        response = status_line.encode('utf-8') + headers.encode('utf-8') + body
+    def response_head(self, code, content_type, content_length, headers=None):
+        # only the length and per-response headers are formatted here; the
+        # status line, Content-Type and Connection lines are cached blocks
+        self.status = code
+        parts = [head_prefix(code, content_type)]
+        if content_length is not None:
+            parts.append(b"Content-Length: %d\r\n" % content_length)
+        for name, value in (headers or {}).items():
+            parts.append(f"{name}: {value}\r\n".encode('utf-8'))
+        parts.append(self.connection_headers())
+        return b"".join(parts)
+
+    def send_response(self, code, body, content_type='text/plain; charset=utf-8', headers=None):
+        # dynamic bodies are compressed on the fly; files use send_file
+        if (code == 200 and self.accept_gzip and len(body) >= GZIP_MIN_SIZE
+                and is_compressible(content_type)
+                and not (headers and 'Content-Encoding' in headers)):
+            body = gzip.compress(body, GZIP_LEVEL, mtime=0)
+            headers = dict(headers or {})
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
         try:
-            self.connection.sendall(response)
+            self.sendv([self.response_head(code, content_type, len(body), headers), body])
         except Exception as e:
+            self.keep_alive = False
             logging.error(f"Error sending response: {e}")
 
-    def get_request(self):
-        raw_request = b""
-        while b"\r\n\r\n" not in raw_request:
-            chunk = self.connection.recv(2048)
-            if not chunk:
-                break
-            raw_request += chunk
-        
-        if not raw_request:
-            return None
+    def send_not_modified(self, headers):
+        try:
+            self.sendall(self.response_head(304, None, None, headers))
+        except Exception as e:
+            self.keep_alive = False
+            logging.error(f"Error sending response: {e}")
 
-        header_part, body_part = raw_request.split(b"\r\n\r\n", 1)
-        headers_list = header_part.decode('utf-8', errors='ignore').split("\r\n")
-        
-        request_line = headers_list[0]
+    def send_file(self, code, f, content_type, offset=0, count=None, headers=None):
+        # f is an open binary file, or the bytes of a cached one
+        if count is None:
+            size = len(f) if isinstance(f, bytes) else os.fstat(f.fileno()).st_size
+            count = size - offset
         try:
-            method, uri, version = request_line.split()
-        except ValueError:
+            head = self.response_head(code, content_type, count, headers)
+            if isinstance(f, bytes):
+                self.sendv([head, memoryview(f)[offset:offset + count]])
+            else:
+                self.sendv([head], more=True)
+                self.write_file(f, offset, count)
+        except Exception as e:
+            # Headers are already on the wire, so the only safe way to
+            # signal the failure is to drop the connection.
+            self.keep_alive = False
+            logging.error(f"Error sending file: {e}")
+
+    def start_chunked(self, code, content_type, headers=None, trailers=()):
+        """Begin a response whose length isn't known up front.
+
+        Follow with write_chunk() calls and finish with end_chunked().
+        ``trailers`` names the trailer fields end_chunked() will send.
+        HTTP/1.0 clients can't decode chunks, so they get the body raw and
+        the connection closed at the end instead (and no trailers).
+        """
+        headers = dict(headers or {})
+        self.chunked = self.request_version != 'HTTP/1.0'
+        self.compressor = None
+        if code == 200 and self.accept_gzip and is_compressible(content_type):
+            self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            headers['Content-Encoding'] = 'gzip'
+            headers['Vary'] = 'Accept-Encoding'
+        if self.chunked:
+            headers['Transfer-Encoding'] = 'chunked'
+            if trailers:
+                headers['Trailer'] = ', '.join(trailers)
+        else:
+            self.keep_alive = False
+        try:
+            self.sendall(self.response_head(code, content_type, None, headers))
+            return True
+        except Exception as e:
+            self.keep_alive = False
+            logging.error(f"Error sending response: {e}")
+            return False
+
+    def write_chunk(self, data):
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        if not data:
+            return True
+        try:
+            if self.chunked:
+                # size line, data and CRLF in one writev; data isn't copied
+                self.sendv([b"%x\r\n" % len(data), data, b"\r\n"])
+            else:
+                self.sendall(data)
+            return True
+        except Exception as e:
+            self.keep_alive = False
+            logging.error(f"Error sending chunk: {e}")
+            return False
+
+    def end_chunked(self, trailers=None):
+        if self.compressor is not None:
+            tail = self.compressor.flush()
+            self.compressor = None
+            if not self.write_chunk(tail):
+                return False
+        if not self.chunked:
+            return True
+        self.chunked = False
+        tail = "0\r\n"
+        for name, value in (trailers or {}).items():
+            tail += f"{name}: {value}\r\n"
+        try:
+            self.sendall((tail + "\r\n").encode('utf-8'))
+            return True
+        except Exception as e:
+            self.keep_alive = False
+            logging.error(f"Error ending chunked response: {e}")
+            return False
+
+    def send_byteranges(self, f, ranges, size, content_type, headers=None):
+        boundary = secrets.token_hex(16)
+        parts = []
+        for start, end in ranges:
+            part_head = (
+                f"--{boundary}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+            ).encode('utf-8')
+            parts.append((part_head, start, end - start + 1))
+        closing = f"--{boundary}--\r\n".encode('utf-8')
+        total = sum(len(head) + count + 2 for head, _, count in parts) + len(closing)
+
+        try:
+            head = self.response_head(206, f"multipart/byteranges; boundary={boundary}", total, headers)
+            for part_head, offset, count in parts:
+                self.sendv([head, part_head], more=True)
+                self.write_file(f, offset, count)
+                head = b"\r\n"
+            self.sendv([head, closing])
+        except Exception as e:
+            self.keep_alive = False
+            logging.error(f"Error sending byte ranges: {e}")
+
+    def write_file(self, f, offset, count):
+        if isinstance(f, bytes):
+            self.sendall(memoryview(f)[offset:offset + count])
+            return
+
+        sendfile = getattr(self.connection, 'sendfile', None)
+        if sendfile is not None:
+            # socket.sendfile uses os.sendfile on plain sockets and falls
+            # back to bounded send() blocks itself (e.g. for TLS sockets).
+            sent = sendfile(f, offset, count)
+            self.bytes_out += sent
+            if sent != count:
+                raise ConnectionError(f"short sendfile: {sent} of {count} bytes")
+            return
+
+        buf = bytearray(min(FILE_CHUNK_SIZE, count) or 1)
+        view = memoryview(buf)
+        f.seek(offset)
+        remaining = count
+        while remaining:
+            n = f.readinto(view[:min(remaining, len(buf))])
+            if not n:
+                raise EOFError(f"file truncated with {remaining} bytes left to send")
+            self.sendall(view[:n])
+            remaining -= n
+
+    def read_event(self, max_data=None):
+        while True:
+            event = self.parser.next_event(max_data)
+            if event is not NEED_DATA:
+                return event
+            self.set_read_timeout()
+            if self.parser.in_body:
+                self.parser.recv_into(self.connection, UPLOAD_CHUNK_SIZE)
+            else:
+                self.parser.recv_into(self.connection, RECV_SIZE)
+
+    def set_read_timeout(self):
+        # the keep-alive timeout only covers waiting for the next request;
+        # a request already under way gets the (longer) read timeout
+        timeout = self.keepalive_timeout if self.parser.idle else self.read_timeout
+        if timeout != self.timeout:
+            self.timeout = timeout
+            try:
+                self.connection.settimeout(timeout)
+            except OSError:
+                pass
+
+    def get_request(self):
+        event = self.read_event()
+        if event is CLOSED:
             return None
+        if not isinstance(event, RequestLine):
+            raise ParseError(400, "unexpected request data")
+        method, uri, version = event
+
+        # Header events are only interesting to streaming consumers; the
+        # complete dict arrives with HeadersComplete.
+        while not isinstance(event, HeadersComplete):
+            event = self.read_event()
+        return self.build_request(method, uri, version, event.headers)
+
+    def build_request(self, method, uri, version, headers):
+        # The body stays on the socket; handlers consume it through the reader.
+        expect_continue = headers.get('expect', '').lower() == '100-continue'
+        path, _, query = uri.partition('?')
 
-        headers = {}
-        for line in headers_list[1:]:
-            if ": " in line:
-                key, value = line.split(": ", 1)
-                headers[key.lower()] = value
-
-        content_length = int(headers.get('content-length', 0))
-        while len(body_part) < content_length:
-            more = self.connection.recv(min(2048, content_length - len(body_part)))
-            if not more:
-                break
-            body_part += more
-            
         return {
             'method': method,
             'uri': uri,
+            'path': path,
+            'query': query,
             'version': version,
             'headers': headers,
-            'body': body_part
+            'body': BodyReader(self, expect_continue)
         }
 
+    def wants_keep_alive(self, request):
+        tokens = [t.strip().lower() for t in request['headers'].get('connection', '').split(',')]
+        if 'close' in tokens:
+            return False
+        if request['version'] == 'HTTP/1.1':
+            return True
+        return 'keep-alive' in tokens
+
     def process(self, connection, address):
         self.connection = connection
         self.address = address
-        
-        request = self.get_request()
-        if not request:
-            self.connection.close()
-            return
+        self.parser = HttpParser('request', **self.limits)
+        self.requests_handled = 0
+        self.timeout = None
+        connection_opened()
 
+        while True:
+            try:
+                request = self.get_request()
+            except ParseError as e:
+                self.keep_alive = False
+                self.send_response(e.status, e.message.encode())
+                break
+            except socket.timeout:
+                if not self.parser.idle:
+                    # stalled half-way through a request head
+                    self.keep_alive = False
+                    self.send_response(408, b'Request Timeout')
+                break
+            except ConnectionError:
+                break
+            except OSError as e:
+                logging.error(f"Error reading request from {address}: {e}")
+                break
+            if not request:
+                break
+            if not self.handle_request(request):
+                break
+
+        self.connection.close()
+        connection_closed()
+
+    def handle_request(self, request):
+        """Answer one parsed request; False means close the connection."""
+        started = time.monotonic()
+        self.requests_handled += 1
+        self.request_version = request['version']
+        self.keep_alive = (self.wants_keep_alive(request)
+                           and self.requests_handled < self.max_requests)
+        self.route = 'other'
+        self.status = None
+        self.bytes_out = 0
+        try:
+            self.dispatch(request)
+            if not self.keep_alive:
+                return False
+            return self.finish_body(request['body'])
+        finally:
+            elapsed = time.monotonic() - started
+            self.record_metrics(request, elapsed)
+            access_log.record(self.address, request, self.status, request['body'].received,
+                              self.bytes_out, elapsed, self.route)
+
+    def record_metrics(self, request, elapsed):
+        metrics.ensure_started()
+        method = request['method'] if request['method'] in METRIC_METHODS else 'OTHER'
+        route = self.route
+        metrics.inc('http_requests_total', (method, route, str(self.status or 0)))
+        metrics.observe('http_request_duration_seconds', elapsed, (route,))
+        if request['body'].received:
+            metrics.inc('http_request_body_bytes_total', (route,), request['body'].received)
+        metrics.inc('http_response_bytes_total', (route,), self.bytes_out)
+
+    def finish_body(self, body):
+        # Whatever the handler left unread must go before the next request
+        # can be parsed. Returns False when the connection has to be closed.
+        if body.done:
+            return True
+        if body.expect_continue and not body.continued:
+            return False
+        if body.remaining > MAX_DRAIN_SIZE:
+            return False
+        try:
+            return body.drain(MAX_DRAIN_SIZE)
+        except (OSError, ParseError):
+            return False
+
+    def needs_disk(self, request):
+        # whether dispatch() touches the filesystem; event-loop servers
+        # answer everything else without leaving the loop
+        method, uri = request['method'], request['path']
+        if method == 'GET':
+            return uri != '/stats'
+        return method in ('POST', 'PUT')
+
+    def dispatch(self, request):
         method = request['method']
-        uri = request['uri']
+        uri = request['path']
+        self.accept_gzip = accepts_gzip(request['headers'])
         
         if method == 'GET' and (uri == '/list' or uri == '/'):
-            self.handle_list()
+            self.route = 'list'
+            self.handle_list(request)
+        elif method == 'GET' and uri == '/stats':
+            self.route = 'stats'
+            self.handle_stats()
+        elif method == 'GET' and uri == '/metrics':
+            self.route = 'metrics'
+            self.handle_metrics()
         elif method == 'POST' and uri == '/upload':
+            self.route = 'upload'
             self.handle_upload(request)
+        elif method == 'PUT' and uri.startswith('/files/'):
+            self.route = 'files'
+            self.handle_raw_upload(request, uri[len('/files/'):])
         elif method == 'GET' and uri.startswith('/delete/'):
+            self.route = 'delete'
             self.handle_delete(uri)
         elif method == 'GET':
-            self.handle_get(uri)
+            self.route = 'get'
+            self.handle_get(uri, request['headers'])
         else:
             self.send_response(405, b'Method Not Allowed')
-        
-        self.connection.close()
 
-    def handle_list(self):
+    def handle_list(self, request):
+        query = parse_qs(request['query'])
+        prefix = query.get('prefix', [''])[0]
+        sort = query.get('sort', ['name'])[0]
+        descending = query.get('order', ['asc'])[0] == 'desc'
+        cursor = query.get('cursor', [None])[0]
+        fmt = query.get('format', [None])[0]
+        if fmt is None:
+            accept = request['headers'].get('accept', '')
+            fmt = 'json' if 'application/json' in accept else 'text'
+
         try:
-            files = os.listdir('.')
-            if not files:
-                body = "Current directory is empty."
-            else:
-                body = "\n".join(files)
-            self.send_response(200, body.encode('utf-8'), 'text/plain; charset=utf-8')
+            limit = int(query.get('limit', [LIST_DEFAULT_LIMIT])[0])
+            if limit < 1:
+                raise ValueError("limit must be positive")
+            limit = min(limit, LIST_MAX_LIMIT)
+            entries, next_cursor = file_index.page(prefix, sort, descending, limit, cursor)
+        except ValueError as e:
+            self.send_response(400, f"Bad Request: {e}".encode())
+            return
         except Exception as e:
             logging.error(f"Error listing files: {e}")
             self.send_response(500, f"Internal Server Error: {e}".encode())
+            return
+
+        headers = {}
+        if next_cursor:
+            headers['X-Next-Cursor'] = next_cursor
+            params = {k: v[0] for k, v in query.items() if k != 'cursor'}
+            params['cursor'] = next_cursor
+            headers['Link'] = f'</list?{urlencode(params)}>; rel="next"'
+
+        if fmt != 'json' and not entries and not cursor and not prefix:
+            self.send_response(200, b"Current directory is empty.", 'text/plain; charset=utf-8', headers)
+            return
+
+        # a page can hold LIST_MAX_LIMIT entries; it goes out as it is
+        # formatted, with the entry count as a trailer
+        if fmt == 'json':
+            content_type = 'application/json'
+            opening, separator = '{"files": [', ', '
+            items = (json.dumps(entry.as_dict()) for entry in entries)
+            closing = f'], "next_cursor": {json.dumps(next_cursor)}}}'
+        else:
+            content_type = 'text/plain; charset=utf-8'
+            opening, separator, closing = '', '\n', ''
+            items = (entry.name for entry in entries)
+
+        if not self.start_chunked(200, content_type, headers, trailers=('X-Entry-Count',)):
+            return
+        pending = [opening]
+        pending_size = len(opening)
+        for index, item in enumerate(items):
+            if index:
+                pending.append(separator)
+            pending.append(item)
+            pending_size += len(item) + len(separator)
+            if pending_size >= LIST_CHUNK_SIZE:
+                if not self.write_chunk(''.join(pending).encode('utf-8')):
+                    return
+                pending = []
+                pending_size = 0
+        pending.append(closing)
+        if self.write_chunk(''.join(pending).encode('utf-8')):
+            self.end_chunked({'X-Entry-Count': len(entries)})
+
+    def handle_stats(self):
+        stats = {name: source() for name, source in local_stats_sources().items()}
+        body = json.dumps(stats, indent=2).encode('utf-8')
+        self.send_response(200, body, 'application/json', {'Cache-Control': 'no-store'})
+
+    def handle_metrics(self):
+        body = metrics.render().encode('utf-8')
+        self.send_response(200, body, 'text/plain; version=0.0.4; charset=utf-8',
+                           {'Cache-Control': 'no-store'})
+
+    def save_stream(self, filename, chunks):
+        # The content store hashes while it writes, keeps one copy per
+        # content and renames the name into place only once complete, so
+        # readers never see a partial file.
+        size, _, change = store.save(filename, chunks)
+        file_cache.invalidate(storage_path(filename))
+        file_index.update(filename, change)
+        return size
 
     def handle_upload(self, request):
+        content_type = request['headers'].get('content-type', '')
+        mime, params = parse_header_params(content_type)
+        if mime == 'multipart/form-data':
+            self.handle_multipart_upload(request, params.get('boundary'))
+            return
+        if mime == 'application/octet-stream':
+            filename = (parse_qs(request['query']).get('filename', [None])[0]
+                        or request['headers'].get('x-filename'))
+            self.handle_raw_upload(request, filename)
+            return
+
         try:
-            body = request['body'].decode('utf-8')
+            body = request['body'].read().decode('utf-8')
             parsed_body = parse_qs(body)
             
             filename = parsed_body.get('filename', [None])[0]
@@ -110,19 +925,83 @@ class Http:
                 self.send_response(400, b'Bad Request: Missing filename or data')
                 return
 
-            filename = os.path.basename(unquote(filename))
+            filename = safe_filename(filename)
+            if not filename:
+                self.send_response(400, b'Bad Request: Missing filename or data')
+                return
 
-            filepath = filename
-            filedata = base64.b64decode(filedata_b64)
+            self.save_stream(filename, [base64.b64decode(filedata_b64)])
 
-            with open(filepath, 'wb') as f:
-                f.write(filedata)
-            
             logging.info(f"File '{filename}' uploaded successfully.")
             self.send_response(200, f"File '{filename}' uploaded successfully.".encode())
+        except ValueError as e:
+            self.send_bad_body(e)
+        except Exception as e:
+            logging.error(f"Error uploading file: {e}")
+            self.send_response(500, f"Internal Server Error: {e}".encode())
+
+    def send_bad_body(self, e):
+        # Whatever is left of the body can't be trusted, so the connection
+        # is closed after the error response.
+        self.keep_alive = False
+        if isinstance(e, ParseError):
+            self.send_response(e.status, e.message.encode())
+        else:
+            self.send_response(400, f"Bad Request: {e}".encode())
+
+    def handle_raw_upload(self, request, filename):
+        filename = safe_filename(filename)
+        if not filename:
+            self.send_response(400, b'Bad Request: Missing filename')
+            return
+
+        try:
+            size = self.save_stream(filename, request['body'].iter_chunks())
+        except ValueError as e:
+            self.send_bad_body(e)
+            return
         except Exception as e:
+            self.keep_alive = False
             logging.error(f"Error uploading file: {e}")
             self.send_response(500, f"Internal Server Error: {e}".encode())
+            return
+
+        logging.info(f"File '{filename}' uploaded successfully ({size} bytes).")
+        self.send_response(200, f"File '{filename}' uploaded successfully.".encode())
+
+    def handle_multipart_upload(self, request, boundary):
+        if not boundary:
+            self.send_response(400, b'Bad Request: Missing multipart boundary')
+            return
+
+        saved = []
+        try:
+            reader = MultipartReader(request['body'], boundary)
+            while True:
+                part = reader.next_part()
+                if part is None:
+                    break
+                _, params = parse_header_params(part.get('content-disposition', ''))
+                filename = safe_filename(params.get('filename'))
+                if filename:
+                    self.save_stream(filename, reader.iter_data())
+                    saved.append(filename)
+        except ValueError as e:
+            self.send_bad_body(e)
+            return
+        except Exception as e:
+            self.keep_alive = False
+            logging.error(f"Error uploading file: {e}")
+            self.send_response(500, f"Internal Server Error: {e}".encode())
+            return
+
+        if not saved:
+            self.send_response(400, b'Bad Request: No file part in form data')
+            return
+        for filename in saved:
+            logging.info(f"File '{filename}' uploaded successfully.")
+        body = "\n".join(f"File '{filename}' uploaded successfully." for filename in saved)
+        self.send_response(200, body.encode())
 
     def handle_delete(self, uri):
         try:
@@ -131,10 +1010,14 @@ class Http:
                 self.send_response(400, b'Bad Request: Filename not specified')
                 return
 
-            filepath = filename
+            filepath = storage_path(filename)
 
-            if os.path.isfile(filepath):
-                os.remove(filepath)
+            # drops the content itself once no other name refers to it
+            change = store.delete(filename)
+            if change is not None:
+                file_cache.invalidate(filepath)
+                file_index.remove(filename, change)
+                drop_gzip_sidecars(filepath)
                 logging.info(f"File '{filename}' deleted.")
                 self.send_response(200, f"File '{filename}' deleted.".encode())
             else:
@@ -143,29 +1026,177 @@ class Http:
             logging.error(f"Error deleting file: {e}")
             self.send_response(500, f"Internal Server Error: {e}".encode())
 
-    def handle_get(self, uri):
+    def not_modified(self, request_headers, etag, mtime):
+        # If-None-Match wins over If-Modified-Since when both are present
+        if_none_match = request_headers.get('if-none-match')
+        if if_none_match is not None:
+            return etag_matches(if_none_match, etag)
+        if_modified_since = request_headers.get('if-modified-since')
+        if if_modified_since is not None:
+            since = parse_http_date(if_modified_since)
+            return since is not None and mtime <= since
+        return False
+
+    def if_range_matches(self, value, etag, mtime):
+        value = value.strip()
+        if value.startswith('W/'):
+            return False
+        if value.startswith('"'):
+            return value == etag
+        return parse_http_date(value) == mtime
+
+    def handle_get(self, uri, request_headers=None):
+        request_headers = request_headers or {}
         filename = os.path.basename(unquote(uri.strip('/')))
         
-        filepath = filename
+        # uploaded files first, then the server's own static pages
+        filepath = storage_path(filename)
+        stored_name = filename
+        if not file_index.get(filename):
+            # the index can lag behind uploads made by other workers; the
+            # directory itself is the source of truth (dot-names are the
+            # content store's own)
+            if filename.startswith('.') or not os.path.isfile(filepath):
+                filepath = filename
+                stored_name = None
+
+        content_type, cache_control = content_type_for(filename)
+        extra_headers = None
+        if is_compressible(content_type):
+            extra_headers = {'Vary': 'Accept-Encoding'}
+            # ranges are always served from the identity encoding
+            if self.accept_gzip and 'range' not in request_headers:
+                if self.serve_gzip(filepath, request_headers, content_type, cache_control, stored_name):
+                    return
+
+        if not self.serve_file(filepath, request_headers, content_type, cache_control, extra_headers,
+                               stored_name=stored_name):
+            self.send_response(404, f"File '{filename}' not found.".encode())
+
+    def serve_file(self, filepath, request_headers, content_type, cache_control,
+                   extra_headers=None, etag_suffix='', stored_name=None, stored_ino=None):
+        # Returns False if there is no such file; every other outcome,
+        # errors included, has been answered. stored_name: the content
+        # store's name for the file (or for the original of a gzip sidecar,
+        # whose inode is stored_ino), which supplies the validators.
+        entry = file_cache.lookup(filepath)
+        if entry is not None:
+            self.send_representation(request_headers, entry.data, entry.size, entry.content_type,
+                                     entry.etag, entry.mtime, dict(entry.headers))
+            return True
 
-        if os.path.isfile(filepath):
+        if not os.path.isfile(filepath):
+            return False
+        try:
+            f = open(filepath, 'rb')
+        except Exception as e:
+            logging.error(f"Error reading file {filepath}: {e}")
+            self.send_response(500, f"Internal Server Error: {e}".encode())
+            return True
+
+        with f:
+            st = os.fstat(f.fileno())
+            etag = file_etag(st, suffix=etag_suffix)
+            mtime = int(st.st_mtime)
+            if stored_name is not None:
+                # names sharing content share the inode; its mtime is no
+                # validator for any one of them
+                validators = store.validators(stored_name, st.st_ino if stored_ino is None else stored_ino)
+                if validators is not None:
+                    digest, mtime = validators
+                    etag = content_etag(digest, suffix=etag_suffix)
+            headers = {
+                'Accept-Ranges': 'bytes',
+                'ETag': etag,
+                'Last-Modified': http_date(mtime),
+                'Cache-Control': cache_control,
+            }
+            headers.update(extra_headers or {})
+
+            source = f
+            if file_cache.accepts(st.st_size):
+                data = f.read()
+                if len(data) == st.st_size:
+                    file_cache.store(filepath, st, data, content_type, etag, mtime, dict(headers))
+                    source = data
+                else:
+                    f.seek(0)
+
+            self.send_representation(request_headers, source, st.st_size, content_type,
+                                     etag, mtime, headers)
+        return True
+
+    def serve_gzip(self, filepath, request_headers, content_type, cache_control, stored_name=None):
+        entry = file_cache.lookup(filepath)
+        if entry is not None:
+            ino, size, mtime_ns = entry.stat_key
+        else:
             try:
-                with open(filepath, 'rb') as f:
-                    content = f.read()
-                
-                content_type = 'application/octet-stream'
-                if filename.endswith(('.jpg', '.jpeg')):
-                    content_type = 'image/jpeg'
-                elif filename.endswith('.png'):
-                    content_type = 'image/png'
-                elif filename.endswith('.txt'):
-                    content_type = 'text/plain'
-                elif filename.endswith('.html'):
-                    content_type = 'text/html'
-                
-                self.send_response(200, content, content_type)
-            except Exception as e:
-                logging.error(f"Error reading file {filename}: {e}")
-                self.send_response(500, f"Internal Server Error: {e}".encode())
+                st = os.stat(filepath)
+            except OSError:
+                return False
+            ino, size, mtime_ns = st.st_ino, st.st_size, st.st_mtime_ns
+        if size < GZIP_MIN_SIZE:
+            return False
+
+        extra_headers = {'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'}
+        sidecar = gzip_sidecar_path(filepath, mtime_ns, size)
+        if self.serve_file(sidecar, request_headers, content_type, cache_control, extra_headers, '-gz',
+                           stored_name, ino):
+            return True
+        try:
+            sidecar = self.build_gzip_sidecar(filepath)
+        except OSError as e:
+            logging.error(f"Error compressing {filepath}: {e}")
+            return False
+        return self.serve_file(sidecar, request_headers, content_type, cache_control, extra_headers, '-gz',
+                               stored_name, ino)
+
+    def build_gzip_sidecar(self, filepath):
+        with open(filepath, 'rb') as f:
+            st = os.fstat(f.fileno())
+            sidecar = gzip_sidecar_path(filepath, st.st_mtime_ns, st.st_size)
+            if os.path.exists(sidecar):
+                return sidecar
+            os.makedirs(GZIP_CACHE_DIR, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix='.gz-', dir=GZIP_CACHE_DIR)
+            try:
+                with os.fdopen(fd, 'wb') as raw, \
+                        gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=GZIP_LEVEL, mtime=0) as gz:
+                    shutil.copyfileobj(f, gz, FILE_CHUNK_SIZE)
+                os.chmod(tmp_path, 0o644)
+                # same mtime as the original, so Last-Modified matches both encodings
+                os.utime(tmp_path, ns=(st.st_mtime_ns, st.st_mtime_ns))
+                os.replace(tmp_path, sidecar)
+            except BaseException:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+                raise
+        drop_gzip_sidecars(filepath, keep=sidecar)
+        return sidecar
+
+    def send_representation(self, request_headers, source, size, content_type, etag, mtime, headers):
+        if self.not_modified(request_headers, etag, mtime):
+            self.send_not_modified(headers)
+            return
+
+        ranges = None
+        if 'range' in request_headers:
+            if_range = request_headers.get('if-range')
+            if if_range is None or self.if_range_matches(if_range, etag, mtime):
+                ranges = parse_range(request_headers['range'], size)
+
+        if ranges is None:
+            self.send_file(200, source, content_type, count=size, headers=headers)
+        elif not ranges:
+            headers['Content-Range'] = f"bytes */{size}"
+            self.send_response(416, b'Range Not Satisfiable', headers=headers)
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+            self.send_file(206, source, content_type, offset=start,
+                           count=end - start + 1, headers=headers)
         else:
-            self.send_response(404, f"File '{filename}' not found.".encode())
\ No newline at end of file
+            self.send_byteranges(source, ranges, size, content_type, headers)
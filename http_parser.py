@@ -0,0 +1,362 @@
+from collections import namedtuple
+
+# Default limits. Heads that break them are answered with 414/431, bodies
+# with 413, anything malformed with 400.
+MAX_LINE_SIZE = 8 * 1024
+MAX_HEADER_SIZE = 64 * 1024
+MAX_HEADER_COUNT = 100
+MAX_CHUNK_LINE_SIZE = 4096
+MAX_TRAILER_SIZE = 16 * 1024
+RECV_SIZE = 64 * 1024
+
+TOKEN_CHARS = frozenset(b"!#$%&'*+-.^_`|~0123456789"
+                        b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ")
+HEX_DIGITS = frozenset(b"0123456789abcdefABCDEF")
+
+
+class ParseError(ValueError):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+RequestLine = namedtuple('RequestLine', 'method target version')
+StatusLine = namedtuple('StatusLine', 'version status reason')
+Header = namedtuple('Header', 'name value')
+HeadersComplete = namedtuple('HeadersComplete', 'headers')
+# ``data`` is a memoryview into the parser's buffer, valid until the next
+# feed() or recv_into(); copy it (bytes(data)) to keep it longer.
+Data = namedtuple('Data', 'data')
+EndOfMessage = namedtuple('EndOfMessage', 'trailers')
+
+
+class _Sentinel:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+# More bytes are needed before the next event can be produced.
+NEED_DATA = _Sentinel('NEED_DATA')
+# The peer closed the connection cleanly between two messages.
+CLOSED = _Sentinel('CLOSED')
+
+START, HEADERS, BODY, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILERS, BODY_EOF, DONE = range(9)
+
+
+class HttpParser:
+    """Incremental HTTP/1.x message parser.
+
+    Bytes go in through feed() or recv_into(); next_event() turns them into
+    RequestLine/StatusLine, Header, HeadersComplete, Data and EndOfMessage
+    events, or NEED_DATA when the buffer runs dry. Once a message has ended
+    the next call starts on the following one, so pipelined requests just
+    keep flowing. The same parser drives blocking sockets and event loops.
+
+    Input lives in a single bytearray with a read offset; consumed space is
+    reclaimed by compacting in place rather than re-concatenating. Body
+    data is handed out as memoryviews of that buffer, not copies; they are
+    released when more input arrives.
+    """
+
+    def __init__(self, kind='request', max_line_size=MAX_LINE_SIZE,
+                 max_header_size=MAX_HEADER_SIZE, max_header_count=MAX_HEADER_COUNT,
+                 max_body_size=None):
+        self.kind = kind
+        self.max_line_size = max_line_size
+        self.max_header_size = max_header_size
+        self.max_header_count = max_header_count
+        self.max_body_size = max_body_size
+        self.buffer = bytearray()
+        self.pos = 0
+        self.end = 0
+        self.eof = False
+        # Data views handed out since the last feed()/recv_into()
+        self.views = []
+        # for response parsing: the method of the request being answered
+        self.request_method = None
+        self.reset()
+
+    def reset(self):
+        self.state = START
+        self.headers = {}
+        self.header_count = 0
+        self.header_bytes = 0
+        self.body_remaining = 0
+        self.body_seen = 0
+        self.chunked = False
+        self.trailers = {}
+        self.method = None
+        self.status = None
+
+    @property
+    def buffered(self):
+        return self.end - self.pos
+
+    @property
+    def idle(self):
+        # between messages: nothing of the next one has arrived yet
+        return self.state in (START, DONE) and not self.buffered
+
+    @property
+    def in_body(self):
+        return self.state in (BODY, CHUNK_DATA, BODY_EOF)
+
+    @property
+    def close_delimited(self):
+        # a response body that only ends when the connection closes
+        return self.state == BODY_EOF
+
+    def release_views(self):
+        # the buffer is about to be overwritten (and can't be resized while
+        # views of it exist); handed-out body data ends here
+        for view in self.views:
+            view.release()
+        self.views.clear()
+
+    def reserve(self, size):
+        self.release_views()
+        if len(self.buffer) - self.end >= size:
+            return
+        if self.pos:
+            live = self.end - self.pos
+            self.buffer[:live] = self.buffer[self.pos:self.end]
+            self.pos = 0
+            self.end = live
+        missing = size - (len(self.buffer) - self.end)
+        if missing > 0:
+            self.buffer.extend(bytes(missing))
+
+    def feed(self, data):
+        if not data:
+            self.eof = True
+            return
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def feed_eof(self):
+        self.eof = True
+
+    def recv_into(self, sock, size=RECV_SIZE):
+        self.reserve(size)
+        with memoryview(self.buffer) as view, view[self.end:self.end + size] as window:
+            n = sock.recv_into(window)
+        if n == 0:
+            self.eof = True
+        self.end += n
+        return n
+
+    def read_line(self, limit, status):
+        index = self.buffer.find(b"\n", self.pos, self.end)
+        if index < 0:
+            if self.buffered > limit:
+                raise ParseError(status, "line too long")
+            if self.eof:
+                raise ParseError(400, "connection closed mid-message")
+            return None
+        if index - self.pos > limit + 1:
+            raise ParseError(status, "line too long")
+        line_end = index
+        if line_end > self.pos and self.buffer[line_end - 1] == 0x0D:
+            line_end -= 1
+        line = bytes(self.buffer[self.pos:line_end])
+        self.pos = index + 1
+        return line
+
+    def next_event(self, max_data=None):
+        if self.state == DONE:
+            self.reset()
+        if self.state == START:
+            return self.parse_start_line()
+        if self.state == HEADERS:
+            return self.parse_header_line()
+        if self.state in (BODY, CHUNK_DATA):
+            return self.parse_data(max_data)
+        if self.state == CHUNK_SIZE:
+            return self.parse_chunk_size(max_data)
+        if self.state == CHUNK_END:
+            line = self.read_line(2, 400)
+            if line is None:
+                return NEED_DATA
+            if line:
+                raise ParseError(400, "missing CRLF after chunk data")
+            self.state = CHUNK_SIZE
+            return self.parse_chunk_size(max_data)
+        if self.state == TRAILERS:
+            return self.parse_trailers()
+        if self.state == BODY_EOF:
+            if self.buffered:
+                return self.emit_data(self.buffered if max_data is None else min(max_data, self.buffered))
+            if self.eof:
+                return self.finish()
+            return NEED_DATA
+        raise RuntimeError(f"parser in unknown state {self.state}")
+
+    def parse_start_line(self):
+        while True:
+            if self.eof and not self.buffered:
+                return CLOSED
+            line = self.read_line(self.max_line_size, 414 if self.kind == 'request' else 400)
+            if line is None:
+                return NEED_DATA
+            # tolerate stray blank lines between pipelined messages
+            if line:
+                break
+
+        parts = line.split(None, 2)
+        if self.kind == 'request':
+            if len(parts) != 3 or not all(c in TOKEN_CHARS for c in parts[0]):
+                raise ParseError(400, "malformed request line")
+            method, target, version = parts
+            self.check_version(version)
+            self.method = method.decode('ascii')
+            event = RequestLine(self.method, target.decode('utf-8', errors='replace'),
+                                version.decode('ascii'))
+        else:
+            if len(parts) < 2 or not parts[1].isdigit() or len(parts[1]) != 3:
+                raise ParseError(400, "malformed status line")
+            self.check_version(parts[0])
+            self.status = int(parts[1])
+            reason = parts[2].decode('latin-1') if len(parts) > 2 else ''
+            event = StatusLine(parts[0].decode('ascii'), self.status, reason)
+        self.state = HEADERS
+        return event
+
+    def check_version(self, version):
+        if not version.startswith(b"HTTP/"):
+            raise ParseError(400, "malformed HTTP version")
+        if version not in (b"HTTP/1.0", b"HTTP/1.1"):
+            raise ParseError(505, "HTTP Version Not Supported")
+
+    def parse_header_line(self):
+        line = self.read_line(min(self.max_line_size, self.max_header_size), 431)
+        if line is None:
+            return NEED_DATA
+        self.header_bytes += len(line) + 2
+        if self.header_bytes > self.max_header_size:
+            raise ParseError(431, "request header fields too large")
+        if not line:
+            self.start_body()
+            return HeadersComplete(self.headers)
+        if line[0] in b" \t":
+            raise ParseError(400, "obsolete header line folding")
+
+        name, colon, value = line.partition(b":")
+        if not colon or not name or not all(c in TOKEN_CHARS for c in name):
+            raise ParseError(400, "malformed header line")
+        self.header_count += 1
+        if self.header_count > self.max_header_count:
+            raise ParseError(431, "too many header fields")
+
+        name = name.decode('ascii').lower()
+        value = value.strip(b" \t").decode('latin-1')
+        if name in self.headers:
+            self.headers[name] += ", " + value
+        else:
+            self.headers[name] = value
+        return Header(name, value)
+
+    def start_body(self):
+        headers = self.headers
+        transfer_encoding = headers.get('transfer-encoding')
+        if self.kind == 'response' and (
+                self.request_method == 'HEAD' or self.status in (204, 304) or self.status < 200):
+            self.body_remaining = 0
+            self.state = BODY
+        elif transfer_encoding is not None:
+            if 'content-length' in headers:
+                # a request framed both ways is how smuggling starts: the
+                # next hop may trust the other header
+                if self.kind == 'request':
+                    raise ParseError(400, "both Transfer-Encoding and Content-Length")
+                del headers['content-length']
+            codings = [c.strip().lower() for c in transfer_encoding.split(',')]
+            if codings[-1] == 'chunked':
+                self.chunked = True
+                self.state = CHUNK_SIZE
+            elif self.kind == 'request':
+                raise ParseError(400, "unsupported transfer coding")
+            else:
+                self.state = BODY_EOF
+        elif 'content-length' in headers:
+            values = {v.strip() for v in headers['content-length'].split(',')}
+            if len(values) != 1:
+                raise ParseError(400, "conflicting Content-Length values")
+            value = values.pop()
+            if not value.isdigit():
+                raise ParseError(400, "invalid Content-Length")
+            self.body_remaining = int(value)
+            if self.max_body_size is not None and self.body_remaining > self.max_body_size:
+                raise ParseError(413, "Payload Too Large")
+            self.state = BODY
+        elif self.kind == 'request':
+            self.body_remaining = 0
+            self.state = BODY
+        else:
+            self.state = BODY_EOF
+
+    def parse_data(self, max_data):
+        if self.state == BODY and self.body_remaining == 0:
+            return self.finish()
+        if not self.buffered:
+            if self.eof:
+                raise ParseError(400, "connection closed mid-body")
+            return NEED_DATA
+        size = min(self.buffered, self.body_remaining)
+        if max_data is not None:
+            size = min(size, max_data)
+        event = self.emit_data(size)
+        self.body_remaining -= size
+        if self.state == CHUNK_DATA and self.body_remaining == 0:
+            self.state = CHUNK_END
+        return event
+
+    def emit_data(self, size):
+        with memoryview(self.buffer) as view:
+            data = view[self.pos:self.pos + size]
+        self.views.append(data)
+        self.pos += size
+        if self.pos == self.end:
+            self.pos = self.end = 0
+        return Data(data)
+
+    def parse_chunk_size(self, max_data):
+        line = self.read_line(MAX_CHUNK_LINE_SIZE, 400)
+        if line is None:
+            return NEED_DATA
+        size_text = line.split(b";", 1)[0].strip()
+        if not size_text or len(size_text) > 16 or not all(c in HEX_DIGITS for c in size_text):
+            raise ParseError(400, f"invalid chunk size {size_text[:32]!r}")
+        size = int(size_text, 16)
+        if size == 0:
+            self.state = TRAILERS
+            return self.parse_trailers()
+        self.body_seen += size
+        if self.max_body_size is not None and self.body_seen > self.max_body_size:
+            raise ParseError(413, "Payload Too Large")
+        self.body_remaining = size
+        self.state = CHUNK_DATA
+        return self.parse_data(max_data)
+
+    def parse_trailers(self):
+        while True:
+            line = self.read_line(MAX_TRAILER_SIZE, 431)
+            if line is None:
+                return NEED_DATA
+            if not line:
+                return self.finish()
+            self.header_bytes += len(line) + 2
+            if self.header_bytes > self.max_header_size + MAX_TRAILER_SIZE:
+                raise ParseError(431, "trailer fields too large")
+            name, colon, value = line.partition(b":")
+            if colon:
+                self.trailers[name.strip().decode('ascii', errors='replace').lower()] = \
+                    value.strip().decode('latin-1')
+
+    def finish(self):
+        self.state = DONE
+        return EndOfMessage(self.trailers)
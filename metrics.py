@@ -0,0 +1,386 @@
+import os
+import json
+import bisect
+import time
+import fcntl
+import logging
+import threading
+
+# Upper bounds (seconds) of the request latency histogram buckets.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Multi-process servers: each process writes a snapshot of its metrics into
+# this directory this often, and /metrics in any process sums them all.
+MULTIPROCESS_DIR = '.metrics'
+MULTIPROCESS_ENV = 'HTTP_METRICS_DIR'
+SNAPSHOT_INTERVAL = 1.0
+# Per-thread shards of exited threads are folded together once there are
+# more than this many.
+MAX_SHARDS = 256
+
+
+class Shard:
+    """One thread's metric values. Only its own thread writes to it, so
+    updates take no lock; readers copy the dicts (atomic under the GIL)."""
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.values = {}
+        self.histograms = {}
+
+    def merge(self, other):
+        for key, value in dict(other.values).items():
+            self.values[key] = self.values.get(key, 0) + value
+        for key, counts in dict(other.histograms).items():
+            mine = self.histograms.get(key)
+            if mine is None:
+                self.histograms[key] = list(counts)
+            else:
+                for i, count in enumerate(counts):
+                    mine[i] += count
+
+
+class Registry:
+    """Counters, gauges and histograms with fixed label names.
+
+    Writes go to a per-thread Shard and never contend; collect() sums the
+    shards. Gauges here are up/down counters (active connections); values
+    that already exist elsewhere are pulled in by collectors at scrape time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.shards = []
+        self.retired = Shard()
+        self.families = {}
+        self.collectors = []
+        self.pid = os.getpid()
+
+    def describe(self, name, kind, help_text, labels=(), buckets=None):
+        self.families[name] = (kind, help_text, tuple(labels), buckets)
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = Shard(threading.current_thread())
+            with self.lock:
+                if len(self.shards) >= MAX_SHARDS:
+                    self._fold_dead_shards()
+                self.shards.append(shard)
+        return shard
+
+    def _fold_dead_shards(self):
+        # caller holds self.lock
+        alive = []
+        for shard in self.shards:
+            if shard.thread.is_alive():
+                alive.append(shard)
+            else:
+                self.retired.merge(shard)
+        self.shards = alive
+
+    def inc(self, name, labels=(), value=1):
+        values = self._shard().values
+        key = (name, labels)
+        values[key] = values.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        buckets = self.families[name][3]
+        histograms = self._shard().histograms
+        key = (name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            # one count per bucket, +Inf, then sum and count
+            counts = histograms[key] = [0] * (len(buckets) + 3)
+        counts[bisect.bisect_left(buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    def register_collector(self, collector):
+        """``collector()`` yields ``(name, ((label, value), ...), number)``
+        gauge samples, read whenever the metrics are collected."""
+        self.collectors.append(collector)
+
+    def reset(self):
+        # after fork: the parent's threads (and their shards) don't exist here
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = []
+        self.retired = Shard()
+        self.pid = os.getpid()
+
+    def collect(self):
+        """This process's metrics as a JSON-friendly snapshot."""
+        with self.lock:
+            self._fold_dead_shards()
+            total = Shard()
+            total.merge(self.retired)
+            for shard in self.shards:
+                total.merge(shard)
+
+        values = {}
+        histograms = {}
+        for (name, labels), value in total.values.items():
+            names = self.families[name][2]
+            values.setdefault(name, []).append([list(zip(names, labels)), value])
+        for (name, labels), counts in total.histograms.items():
+            names = self.families[name][2]
+            histograms.setdefault(name, []).append([list(zip(names, labels)), counts])
+        gauges = {}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    gauges.setdefault(name, []).append([list(labels), value])
+            except Exception as e:
+                logging.error(f"Metrics collector failed: {e}")
+        return {'pid': self.pid, 'time': time.time(), 'values': values,
+                'histograms': histograms, 'gauges': gauges}
+
+
+REGISTRY = Registry()
+describe = REGISTRY.describe
+inc = REGISTRY.inc
+observe = REGISTRY.observe
+register_collector = REGISTRY.register_collector
+
+
+class Multiprocess:
+    """Per-pid snapshot files in a shared directory.
+
+    Every process rewrites its own file each SNAPSHOT_INTERVAL. Files of
+    processes that have exited are folded into retired.json, so their
+    counters keep counting after the process is gone; their gauges are
+    dropped.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.thread = None
+        self.thread_pid = None
+
+    def snapshot_path(self, pid):
+        return os.path.join(self.path, f"{pid}.json")
+
+    def write(self, snapshot):
+        target = self.snapshot_path(snapshot['pid'])
+        partial = f"{target}.{threading.get_ident()}.tmp"
+        with open(partial, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(partial, target)
+
+    def flush(self):
+        try:
+            self.write(REGISTRY.collect())
+        except OSError as e:
+            logging.error(f"Error writing metrics snapshot: {e}")
+
+    def start(self):
+        # one writer thread per process, restarted in forked children
+        if self.thread_pid == os.getpid():
+            return
+        self.thread_pid = os.getpid()
+        self.thread = threading.Thread(target=self._run, name='metrics-snapshot', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            self.flush()
+            time.sleep(SNAPSHOT_INTERVAL)
+
+    def gather(self, own):
+        """Snapshots of every process, this one's fresh, the rest from disk."""
+        with open(os.path.join(self.path, 'lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            retired_path = os.path.join(self.path, 'retired.json')
+            retired = load_snapshot(retired_path) or empty_snapshot()
+            snapshots = [own]
+            changed = False
+            for entry in os.listdir(self.path):
+                pid, _, ext = entry.partition('.')
+                if ext != 'json' or not pid.isdigit() or int(pid) == own['pid']:
+                    continue
+                snapshot = load_snapshot(os.path.join(self.path, entry))
+                if snapshot is None:
+                    continue
+                if pid_alive(int(pid)):
+                    snapshots.append(snapshot)
+                    continue
+                # a dead process has no connections open or work queued
+                snapshot['gauges'] = {}
+                snapshot['values'] = {name: samples for name, samples in snapshot['values'].items()
+                                      if REGISTRY.families.get(name, ('counter',))[0] != 'gauge'}
+                retired = merge_snapshots([retired, snapshot])
+                os.remove(os.path.join(self.path, entry))
+                changed = True
+            if changed:
+                partial = retired_path + '.tmp'
+                with open(partial, 'w') as f:
+                    json.dump(retired, f)
+                os.replace(partial, retired_path)
+        snapshots.append(retired)
+        return snapshots
+
+
+MULTIPROCESS = None
+
+
+def enable_multiprocess(portnumber):
+    """Aggregate across processes via snapshot files under MULTIPROCESS_DIR.
+
+    Call once in the parent before workers start; the server's directory
+    is cleared, and children (forked or spawned) find it through the
+    environment.
+    """
+    path = os.path.join(MULTIPROCESS_DIR, str(portnumber))
+    global MULTIPROCESS
+    os.makedirs(path, exist_ok=True)
+    for entry in os.listdir(path):
+        if entry.endswith(('.json', '.tmp')):
+            os.remove(os.path.join(path, entry))
+    os.environ[MULTIPROCESS_ENV] = os.path.abspath(path)
+    MULTIPROCESS = Multiprocess(os.path.abspath(path))
+    MULTIPROCESS.start()
+
+
+def flush():
+    """Write this process's snapshot now (short-lived processes, on exit)."""
+    if MULTIPROCESS is not None:
+        MULTIPROCESS.flush()
+
+
+def ensure_started():
+    # cheap check on the hot path: children start their own writer thread
+    if MULTIPROCESS is not None and MULTIPROCESS.thread_pid != os.getpid():
+        MULTIPROCESS.start()
+
+
+def _after_fork():
+    REGISTRY.reset()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+if os.environ.get(MULTIPROCESS_ENV):
+    MULTIPROCESS = Multiprocess(os.environ[MULTIPROCESS_ENV])
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def load_snapshot(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def empty_snapshot():
+    return {'values': {}, 'histograms': {}, 'gauges': {}}
+
+
+def merge_snapshots(snapshots):
+    merged = empty_snapshot()
+    for section in ('values', 'histograms', 'gauges'):
+        totals = {}
+        for snapshot in snapshots:
+            for name, samples in snapshot.get(section, {}).items():
+                family = totals.setdefault(name, {})
+                for labels, value in samples:
+                    key = tuple(tuple(pair) for pair in labels)
+                    if isinstance(value, list):
+                        current = family.get(key)
+                        family[key] = value if current is None else [a + b for a, b in zip(current, value)]
+                    else:
+                        family[key] = family.get(key, 0) + value
+        merged[section] = {name: [[list(map(list, key)), value] for key, value in family.items()]
+                           for name, family in totals.items()}
+    return merged
+
+
+def stats_samples(prefix, stats, labels=()):
+    """Flatten a /stats source dict into gauge samples.
+
+    Numbers become ``<prefix>_<key>``; a dict of numbers becomes one family
+    with a ``key`` label; a dict of dicts (e.g. per-backend stats) labels
+    each inner dict with its key and recurses.
+    """
+    for key, value in stats.items():
+        name = f"{prefix}_{sanitize(str(key))}"
+        if isinstance(value, bool):
+            yield name, labels, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, labels, value
+        elif isinstance(value, dict) and value:
+            if all(isinstance(v, dict) for v in value.values()):
+                for sub_key, sub_stats in value.items():
+                    yield from stats_samples(name, sub_stats, labels + (('key', str(sub_key)),))
+            else:
+                for sub_key, sub_value in value.items():
+                    if isinstance(sub_value, (int, float)):
+                        yield name, labels + (('key', str(sub_key)),), float(sub_value)
+
+
+def sanitize(name):
+    return ''.join(c if c.isalnum() or c == '_' else '_' for c in name)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value != value:
+            return 'NaN'
+        if value in (float('inf'), float('-inf')):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format (0.0.4)."""
+    own = REGISTRY.collect()
+    if MULTIPROCESS is not None:
+        snapshot = merge_snapshots(MULTIPROCESS.gather(own))
+    else:
+        snapshot = own
+
+    lines = []
+    for name, samples in sorted(snapshot['values'].items()):
+        kind, help_text, _, _ = REGISTRY.families.get(name, ('untyped', '', (), None))
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    for name, samples in sorted(snapshot['histograms'].items()):
+        _, help_text, _, buckets = REGISTRY.families[name]
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, counts in samples:
+            cumulative = 0
+            for bound, count in zip(buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else format_value(bound)
+                lines.append(f"{name}_bucket{format_labels(labels, ('le', le))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {format_value(counts[-2])}")
+            lines.append(f"{name}_count{format_labels(labels)} {counts[-1]}")
+    for name, samples in sorted(snapshot['gauges'].items()):
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in samples:
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    return '\n'.join(lines) + '\n'
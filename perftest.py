@@ -0,0 +1,586 @@
+"""Benchmark harness for the server variants.
+
+Each variant is started in a scratch directory with generated fixture
+files, warmed up, and then driven with closed-loop (fixed concurrency)
+and open-loop (fixed arrival rate) load. Results go to a JSON file and a
+comparison table; with --baseline the run is compared against an earlier
+JSON file and regressions past --threshold make the exit status non-zero.
+
+    python perftest.py --servers thread_pool,async --duration 10
+    python perftest.py --baseline perf-results.json --output perf-new.json
+"""
+import os
+import sys
+import ssl
+import math
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from client import HttpClient
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# script, whether it speaks TLS, extra argv after the port
+VARIANTS = {
+    'thread': ('server_thread_http.py', False, []),
+    'thread_pool': ('server_thread_pool_http.py', False, []),
+    'process': ('server_process_http.py', False, []),
+    'process_pool': ('server_process_pool_http.py', False, []),
+    'prefork': ('server_prefork_http.py', False, []),
+    'asyncio': ('server_asyncio_stream_http.py', False, []),
+    'async': ('server_async_http.py', False, []),
+    'tls': ('server_thread_http_secure.py', True, []),
+}
+SCENARIOS = ('get_small', 'get_small_close', 'mixed', 'large_get', 'large_upload', 'open_loop')
+BASE_PORT = 18080
+STARTUP_TIMEOUT = 15.0
+REQUEST_TIMEOUT = 30.0
+# How often server CPU and RSS are sampled from /proc.
+SAMPLE_INTERVAL = 0.25
+PERCENTILES = (50, 95, 99, 99.9)
+SMALL_SIZE = 1024
+MEDIUM_SIZE = 100 * 1024
+UPLOAD_SIZE = 16 * 1024
+# Operation weights for the mixed scenarios.
+MIX = (('get', 70), ('list', 10), ('upload', 15), ('delete', 5))
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    k = max(0, math.ceil(q / 100 * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+
+def make_fixtures(workdir, large_size):
+    with open(os.path.join(workdir, 'small.txt'), 'wb') as f:
+        f.write((b"perftest " * (SMALL_SIZE // 9 + 1))[:SMALL_SIZE])
+    with open(os.path.join(workdir, 'medium.bin'), 'wb') as f:
+        f.write(os.urandom(MEDIUM_SIZE))
+    with open(os.path.join(workdir, 'large.bin'), 'wb') as f:
+        block = os.urandom(1024 * 1024)
+        for _ in range(large_size // len(block)):
+            f.write(block)
+        f.write(block[:large_size % len(block)])
+    # the TLS server loads its certificate from ./certs
+    certs = os.path.join(HERE, 'certs')
+    if os.path.isdir(certs):
+        os.symlink(certs, os.path.join(workdir, 'certs'))
+
+
+class ProcessTree:
+    """CPU time and RSS of a process and all of its descendants, from /proc."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self.rss_samples = []
+        self.running = False
+        self.thread = None
+
+    def pids(self):
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rpartition(')')[2].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+        found = [self.pid]
+        for pid in found:
+            found.extend(children.get(pid, ()))
+        return found
+
+    def cpu_seconds(self):
+        # utime+stime of live processes, plus cutime+cstime for the ones
+        # already reaped (forked per-connection handlers)
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f'/proc/{pid}/stat') as f:
+                    fields = f.read().rpartition(')')[2].split()
+            except OSError:
+                continue
+            total += sum(int(v) for v in fields[11:15])
+        return total / CLK_TCK
+
+    def rss_bytes(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open(f'/proc/{pid}/statm') as f:
+                    total += int(f.read().split()[1]) * PAGE_SIZE
+            except (OSError, ValueError, IndexError):
+                continue
+        return total
+
+    def start(self):
+        self.running = True
+        self.peak_rss = 0
+        self.rss_samples = []
+        self.cpu_start = self.cpu_seconds()
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        while self.running:
+            rss = self.rss_bytes()
+            self.rss_samples.append(rss)
+            self.peak_rss = max(self.peak_rss, rss)
+            time.sleep(SAMPLE_INTERVAL)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        elapsed = time.monotonic() - self.started
+        cpu = self.cpu_seconds() - self.cpu_start
+        return {
+            'cpu_seconds': cpu,
+            'cpu_percent': 100 * cpu / elapsed if elapsed else 0.0,
+            'rss_peak_mb': self.peak_rss / 1e6,
+            'rss_avg_mb': sum(self.rss_samples) / len(self.rss_samples) / 1e6 if self.rss_samples else 0.0,
+            'processes': len(self.pids()),
+        }
+
+
+class ServerProcess:
+    def __init__(self, name, port, workdir):
+        self.name = name
+        self.port = port
+        self.workdir = workdir
+        script, self.tls, extra = VARIANTS[name]
+        self.argv = [sys.executable, os.path.join(HERE, script), str(port)] + extra
+        self.log = None
+        self.proc = None
+
+    def __enter__(self):
+        self.log = open(os.path.join(self.workdir, f'{self.name}.log'), 'wb')
+        env = dict(os.environ, PYTHONPATH=HERE + os.pathsep + os.environ.get('PYTHONPATH', ''))
+        # own session, so the whole tree (forked workers included) can be stopped
+        self.proc = subprocess.Popen(self.argv, cwd=self.workdir, env=env, stdin=subprocess.DEVNULL,
+                                     stdout=self.log, stderr=subprocess.STDOUT, start_new_session=True)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"{self.name} exited with status {self.proc.returncode}, "
+                                   f"see {self.log.name}")
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return self
+            except OSError:
+                time.sleep(0.1)
+        self.__exit__()
+        raise RuntimeError(f"{self.name} did not start listening on port {self.port}")
+
+    def __exit__(self, *exc):
+        for sig, wait in ((signal.SIGTERM, 5), (signal.SIGKILL, 5)):
+            try:
+                os.killpg(self.proc.pid, sig)
+            except ProcessLookupError:
+                break
+            try:
+                self.proc.wait(wait)
+                break
+            except subprocess.TimeoutExpired:
+                continue
+        # the process group may outlive its leader (pool workers)
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.log.close()
+
+    def client(self, max_idle=1):
+        context = None
+        if self.tls:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        return HttpClient('127.0.0.1', self.port, timeout=REQUEST_TIMEOUT, max_idle=max_idle,
+                          ssl_context=context)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.error_kinds = {}
+        self.bytes = 0
+        self.ops = {}
+
+    def ok(self, op, latency, size):
+        self.latencies.append(latency)
+        self.bytes += size
+        self.ops[op] = self.ops.get(op, 0) + 1
+
+    def error(self, op, latency, kind):
+        self.latencies.append(latency)
+        self.errors += 1
+        self.error_kinds[kind] = self.error_kinds.get(kind, 0) + 1
+        self.ops[op] = self.ops.get(op, 0) + 1
+
+    def merge(self, others):
+        for other in others:
+            self.latencies.extend(other.latencies)
+            self.errors += other.errors
+            self.bytes += other.bytes
+            for kind, count in other.error_kinds.items():
+                self.error_kinds[kind] = self.error_kinds.get(kind, 0) + count
+            for op, count in other.ops.items():
+                self.ops[op] = self.ops.get(op, 0) + count
+        return self
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        total = len(latencies)
+        result = {
+            'requests': total,
+            'errors': self.errors,
+            'error_rate': self.errors / total if total else 0.0,
+            'error_kinds': self.error_kinds,
+            'ops': self.ops,
+            'duration': elapsed,
+            'throughput_rps': total / elapsed if elapsed else 0.0,
+            'throughput_mbps': self.bytes / elapsed / 1e6 if elapsed else 0.0,
+            'latency_ms': {
+                'mean': 1000 * sum(latencies) / total if total else None,
+                'max': 1000 * latencies[-1] if total else None,
+            },
+        }
+        for q in PERCENTILES:
+            value = percentile(latencies, q)
+            result['latency_ms'][f'p{q:g}'.replace('.', '')] = None if value is None else 1000 * value
+        return result
+
+
+class Workload:
+    """One worker's view of a scenario: picks and runs operations."""
+
+    def __init__(self, scenario, client, worker_id, large_size, workdir):
+        self.scenario = scenario
+        self.client = client
+        self.worker_id = worker_id
+        self.large_size = large_size
+        self.large_path = os.path.join(workdir, 'large.bin')
+        self.uploaded = []
+        self.counter = 0
+        self.random = random.Random(worker_id)
+        self.payload = os.urandom(UPLOAD_SIZE)
+
+    def pick(self):
+        if self.scenario in ('mixed', 'open_loop'):
+            roll = self.random.uniform(0, sum(w for _, w in MIX))
+            for op, weight in MIX:
+                roll -= weight
+                if roll <= 0:
+                    break
+            if op == 'delete' and not self.uploaded:
+                op = 'upload'
+            return op
+        return self.scenario
+
+    def run(self, op):
+        """Perform one operation; returns bytes transferred. Raises on failure."""
+        client = self.client
+        if op == 'get_small':
+            return check(client.get('/small.txt'), SMALL_SIZE)
+        if op == 'get_small_close':
+            return check(client.get('/small.txt', {'Connection': 'close'}), SMALL_SIZE)
+        if op == 'get':
+            name = self.random.choice(('/small.txt', '/medium.bin'))
+            return check(client.get(name), SMALL_SIZE if name == '/small.txt' else MEDIUM_SIZE)
+        if op == 'list':
+            return check(client.get('/list?limit=50'))
+        if op == 'upload':
+            self.counter += 1
+            name = f"perf-{self.worker_id}-{self.counter}.bin"
+            size = check(client.put('/files/' + name, self.payload))
+            self.uploaded.append(name)
+            return size + len(self.payload)
+        if op == 'delete':
+            return check(client.get('/delete/' + self.uploaded.pop()))
+        if op == 'large_get':
+            with client.get('/large.bin', stream=True) as response:
+                received = sum(len(chunk) for chunk in response.iter_content())
+            return check(response, self.large_size, received)
+        if op == 'large_upload':
+            name = f"perf-large-{self.worker_id}.bin"
+            with open(self.large_path, 'rb') as f:
+                response = client.upload_fileobj(f, name)
+            if name not in self.uploaded:
+                self.uploaded.append(name)
+            return check(response) + self.large_size
+        raise ValueError(f"unknown operation {op!r}")
+
+    def cleanup(self):
+        for name in self.uploaded:
+            try:
+                self.client.get('/delete/' + name)
+            except Exception:
+                pass
+        self.uploaded = []
+
+
+class BadResponse(Exception):
+    pass
+
+
+def check(response, expected_size=None, received=None):
+    if response.status >= 400:
+        raise BadResponse(f"status {response.status}")
+    size = len(response.content) if received is None else received
+    if expected_size is not None and size != expected_size:
+        raise BadResponse("short body")
+    return size
+
+
+def error_kind(e):
+    return str(e) if isinstance(e, BadResponse) else type(e).__name__
+
+
+def closed_loop(server, scenario, concurrency, duration, large_size):
+    """``concurrency`` workers, each sending its next request as soon as
+    the previous one is answered."""
+    stop = time.monotonic() + duration
+    recorders = []
+
+    def worker(worker_id):
+        recorder = Recorder()
+        recorders.append(recorder)
+        client = server.client()
+        workload = Workload(scenario, client, worker_id, large_size, server.workdir)
+        try:
+            while time.monotonic() < stop:
+                op = workload.pick()
+                started = time.monotonic()
+                try:
+                    size = workload.run(op)
+                    recorder.ok(op, time.monotonic() - started, size)
+                except Exception as e:
+                    recorder.error(op, time.monotonic() - started, error_kind(e))
+        finally:
+            workload.cleanup()
+            client.close()
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return Recorder().merge(recorders), time.monotonic() - started
+
+
+def open_loop(server, rate, duration, large_size, max_outstanding):
+    """Requests arrive at ``rate`` per second (Poisson) whatever the server
+    does. Latency is measured from the scheduled arrival time, so a server
+    falling behind shows up as queueing delay instead of a lower send rate."""
+    recorder = Recorder()
+    client = server.client(max_idle=max_outstanding)
+    workloads = {}
+    lock = threading.Lock()
+    rng = random.Random(0)
+
+    def job(scheduled):
+        worker_id = threading.get_ident()
+        with lock:
+            workload = workloads.get(worker_id)
+            if workload is None:
+                workload = workloads[worker_id] = Workload('open_loop', client, len(workloads), large_size,
+                                                                server.workdir)
+        op = workload.pick()
+        try:
+            size = workload.run(op)
+            with lock:
+                recorder.ok(op, time.monotonic() - scheduled, size)
+        except Exception as e:
+            with lock:
+                recorder.error(op, time.monotonic() - scheduled, error_kind(e))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max_outstanding) as executor:
+        scheduled = started
+        while True:
+            scheduled += rng.expovariate(rate)
+            if scheduled - started >= duration:
+                break
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(job, scheduled)
+    elapsed = time.monotonic() - started
+    for workload in workloads.values():
+        workload.cleanup()
+    client.close()
+    return recorder, elapsed
+
+
+def run_scenario(server, scenario, args):
+    if scenario == 'open_loop':
+        return open_loop(server, args.rate, args.duration, args.large_size, args.max_outstanding)
+    concurrency = args.large_concurrency if scenario.startswith('large') else args.concurrency
+    return closed_loop(server, scenario, concurrency, args.duration, args.large_size)
+
+
+def benchmark(name, port, args):
+    workdir = tempfile.mkdtemp(prefix=f'perftest-{name}-')
+    results = {}
+    try:
+        make_fixtures(workdir, args.large_size)
+        with ServerProcess(name, port, workdir) as server:
+            tree = ProcessTree(server.proc.pid)
+            for scenario in args.scenarios:
+                if args.warmup:
+                    run_scenario(server, scenario, argparse.Namespace(**{**vars(args), 'duration': args.warmup}))
+                tree.start()
+                recorder, elapsed = run_scenario(server, scenario, args)
+                usage = tree.stop()
+                results[scenario] = {**recorder.summary(elapsed), **usage}
+                logging.warning(f"{name}/{scenario}: {results[scenario]['throughput_rps']:.0f} req/s, "
+                                f"p99 {fmt(results[scenario]['latency_ms']['p99'])} ms, "
+                                f"{results[scenario]['errors']} errors")
+    except Exception as e:
+        logging.error(f"Benchmark of {name} failed: {e}")
+        results['error'] = str(e)
+    finally:
+        if args.keep_workdir:
+            logging.warning(f"Kept {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def fmt(value, digits=1):
+    return '-' if value is None else f"{value:.{digits}f}"
+
+
+COLUMNS = (
+    ('req/s', lambda r: r['throughput_rps'], 0),
+    ('MB/s', lambda r: r['throughput_mbps'], 1),
+    ('p50', lambda r: r['latency_ms']['p50'], 2),
+    ('p95', lambda r: r['latency_ms']['p95'], 2),
+    ('p99', lambda r: r['latency_ms']['p99'], 2),
+    ('p999', lambda r: r['latency_ms']['p999'], 2),
+    ('err%', lambda r: 100 * r['error_rate'], 2),
+    ('cpu%', lambda r: r['cpu_percent'], 0),
+    ('rssMB', lambda r: r['rss_peak_mb'], 1),
+)
+# Metrics where a higher value is the better one, for regression checks.
+HIGHER_IS_BETTER = {'req/s', 'MB/s'}
+REGRESSION_COLUMNS = ('req/s', 'p99', 'err%')
+
+
+def table(results, baseline=None, threshold=None):
+    """Comparison table; with a baseline, deltas and regressions too."""
+    headers = ['server', 'scenario'] + [name for name, _, _ in COLUMNS]
+    rows = []
+    regressions = []
+    for server, scenarios in results['servers'].items():
+        if 'error' in scenarios:
+            rows.append([server, 'FAILED: ' + scenarios['error']])
+            continue
+        for scenario, result in scenarios.items():
+            row = [server, scenario]
+            old = (baseline or {}).get('servers', {}).get(server, {}).get(scenario)
+            for name, getter, digits in COLUMNS:
+                value = getter(result)
+                cell = fmt(value, digits)
+                if old is not None and value is not None and getter(old) is not None:
+                    before = getter(old)
+                    delta = 100 * (value - before) / before if before else 0.0
+                    cell += f" ({delta:+.0f}%)"
+                    worse = -delta if name in HIGHER_IS_BETTER else delta
+                    if name in REGRESSION_COLUMNS and worse > threshold and (name != 'err%' or value > 0.1):
+                        regressions.append(f"{server}/{scenario} {name}: {fmt(before, digits)} -> {cell}")
+                row.append(cell)
+            rows.append(row)
+
+    widths = [max(len(str(row[i])) for row in [headers] + rows if i < len(row))
+              for i in range(len(headers))]
+    lines = ['  '.join(h.ljust(w) for h, w in zip(headers, widths))]
+    lines.append('  '.join('-' * w for w in widths))
+    for row in rows:
+        lines.append('  '.join(str(c).ljust(w) for c, w in zip(row, widths)))
+    return '\n'.join(lines), regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the HTTP server variants.")
+    parser.add_argument('--servers', default=','.join(VARIANTS),
+                        help=f"comma-separated variants (default: all of {', '.join(VARIANTS)})")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help=f"comma-separated scenarios (default: all of {', '.join(SCENARIOS)})")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds per scenario")
+    parser.add_argument('--warmup', type=float, default=2.0, help="warm-up seconds before each scenario")
+    parser.add_argument('--concurrency', type=int, default=16, help="closed-loop workers")
+    parser.add_argument('--large-concurrency', type=int, default=4, help="workers for large_* scenarios")
+    parser.add_argument('--rate', type=float, default=200.0, help="open-loop arrivals per second")
+    parser.add_argument('--max-outstanding', type=int, default=256,
+                        help="open-loop cap on requests in flight")
+    parser.add_argument('--large-size', type=int, default=20, help="large file size in MB")
+    parser.add_argument('--port', type=int, default=BASE_PORT, help="first port to use")
+    parser.add_argument('--output', default='perf-results.json', help="JSON results file")
+    parser.add_argument('--baseline', help="earlier JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=10.0,
+                        help="percent change counted as a regression")
+    parser.add_argument('--keep-workdir', action='store_true', help="keep scratch dirs and server logs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+
+    args.servers = [s for s in args.servers.split(',') if s]
+    args.scenarios = [s for s in args.scenarios.split(',') if s]
+    args.large_size *= 1024 * 1024
+    for name in args.servers:
+        if name not in VARIANTS:
+            parser.error(f"unknown server {name!r}")
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}")
+
+    results = {
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('baseline', 'output')},
+        'servers': {},
+    }
+    for i, name in enumerate(args.servers):
+        results['servers'][name] = benchmark(name, args.port + i, args)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    text, regressions = table(results, baseline, args.threshold)
+    print(text)
+    print(f"\nResults written to {args.output}")
+    if regressions:
+        print(f"\nRegressions past {args.threshold:g}%:")
+        for line in regressions:
+            print("  " + line)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,3 +3,6 @@
 
 ab -n 100 -c 50 http://localhost:8887/testing.txt
 
+
+#semua varian server, beban campuran, JSON + tabel perbandingan:
+#python perftest.py --help
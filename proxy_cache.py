@@ -0,0 +1,429 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from urllib.parse import unquote
+from email.utils import parsedate_to_datetime
+
+# Bytes of response bodies kept in memory; least recently used entries spill
+# to disk when this fills up, and the disk tier evicts for good.
+PROXY_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+PROXY_CACHE_DISK_BYTES = 1024 * 1024 * 1024
+# Bodies bigger than this go straight to the disk tier; bodies bigger than
+# PROXY_CACHE_MAX_OBJECT are not cached at all.
+PROXY_CACHE_MEMORY_MAX_OBJECT = 1024 * 1024
+PROXY_CACHE_MAX_OBJECT = 256 * 1024 * 1024
+PROXY_CACHE_DIR = '.proxycache'
+# Responses with a validator but no explicit lifetime are fresh for 10% of
+# their age since Last-Modified, at most this long (seconds).
+HEURISTIC_MAX_LIFETIME = 300
+# How long (seconds) a request waits for another request's fetch of the
+# same URL before going to the backend itself.
+COALESCE_TIMEOUT = 30
+CACHEABLE_STATUS = frozenset([200, 203, 301, 404, 410])
+# Per-connection headers: never stored, never replayed.
+UNSTORED_HEADERS = frozenset(['connection', 'keep-alive', 'proxy-connection', 'te', 'trailer',
+                              'transfer-encoding', 'upgrade', 'age', 'content-length'])
+
+
+def parse_cache_control(value):
+    directives = {}
+    for item in value.split(','):
+        name, eq, arg = item.strip().partition('=')
+        if name:
+            directives[name.lower()] = arg.strip('"') if eq else True
+    return directives
+
+
+def parse_seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def target_filename(target):
+    """The file a request target names, as the backend's GET handler maps it."""
+    return os.path.basename(unquote(target.partition('?')[0].strip('/')))
+
+
+def freshness_lifetime(headers, cache_control):
+    """Seconds a response stays fresh, 0 when it must be revalidated."""
+    if 'no-cache' in cache_control:
+        return 0
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cache_control:
+            return parse_seconds(cache_control[directive]) or 0
+    date = parse_date(headers.get('date')) or time.time()
+    expires = headers.get('expires')
+    if expires is not None:
+        expires_at = parse_date(expires)
+        return max(0, int(expires_at - date)) if expires_at is not None else 0
+    last_modified = parse_date(headers.get('last-modified'))
+    if last_modified is not None:
+        return min(HEURISTIC_MAX_LIFETIME, max(0, int((date - last_modified) / 10)))
+    return 0
+
+
+class CachedResponse:
+    __slots__ = ('key', 'vary', 'status', 'reason', 'headers', 'size', 'data', 'path',
+                 'stored_at', 'initial_age', 'fresh_until', 'etag', 'last_modified', 'tier')
+
+    def __init__(self, key, vary, status, reason, headers, size, data, path):
+        self.key = key
+        self.vary = vary
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.size = size
+        self.data = data
+        self.path = path
+        self.tier = None
+        self.refresh(headers)
+
+    def refresh(self, headers):
+        cache_control = parse_cache_control(headers.get('cache-control', ''))
+        self.stored_at = time.monotonic()
+        self.initial_age = parse_seconds(headers.get('age')) or 0
+        self.fresh_until = self.stored_at + freshness_lifetime(headers, cache_control) - self.initial_age
+        self.etag = headers.get('etag')
+        self.last_modified = headers.get('last-modified')
+
+    @property
+    def age(self):
+        return self.initial_age + int(time.monotonic() - self.stored_at)
+
+    def is_fresh(self):
+        return time.monotonic() < self.fresh_until
+
+    def matches(self, request_headers):
+        return all(request_headers.get(name, '') == value for name, value in self.vary)
+
+
+class Fetch:
+    """Marks a URL that some request is currently fetching from the backend."""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+class ProxyCache:
+    """Two-tier HTTP response cache for the proxy's GET traffic.
+
+    Entries are keyed by request target and, within that, by the values of
+    the request headers named in the response's Vary. Small bodies live in
+    an LRU memory tier that spills to a disk tier; large ones go to disk
+    directly. Freshness follows Cache-Control/Expires (with a capped
+    Last-Modified heuristic); stale entries with a validator are revalidated
+    with a conditional request rather than re-fetched.
+    """
+
+    def __init__(self, directory=PROXY_CACHE_DIR, memory_bytes=PROXY_CACHE_MEMORY_BYTES,
+                 disk_bytes=PROXY_CACHE_DISK_BYTES, memory_max_object=PROXY_CACHE_MEMORY_MAX_OBJECT,
+                 max_object=PROXY_CACHE_MAX_OBJECT):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.memory_max_object = memory_max_object
+        self.max_object = max_object
+        # the disk tier only indexes what this process wrote; start empty
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
+        self.variants = {}
+        self.memory = OrderedDict()
+        self.disk = OrderedDict()
+        self.memory_used = 0
+        self.disk_used = 0
+        self.fetches = {}
+        # bumped by every invalidation; a fill that started before one may
+        # carry the old content and is not stored
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.counters = dict.fromkeys(
+            ('requests', 'hits', 'revalidated', 'misses', 'coalesced', 'uncacheable', 'stores',
+             'spills', 'evictions', 'invalidations', 'bytes_from_cache', 'bytes_from_backend'), 0)
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def lookup(self, key, request_headers):
+        with self.lock:
+            for entry in self.variants.get(key, ()):
+                if entry.matches(request_headers):
+                    tier = self.memory if entry.tier == 'memory' else self.disk
+                    if id(entry) in tier:
+                        tier.move_to_end(id(entry))
+                    return entry
+        return None
+
+    def begin_fetch(self, key):
+        """Return ``(leader, fetch)``; followers wait on ``fetch.done``."""
+        with self.lock:
+            fetch = self.fetches.get(key)
+            if fetch is not None:
+                return False, fetch
+            fetch = self.fetches[key] = Fetch()
+            return True, fetch
+
+    def end_fetch(self, key, fetch):
+        with self.lock:
+            if self.fetches.get(key) is fetch:
+                del self.fetches[key]
+        fetch.done.set()
+
+    def fill(self, key, request_headers, entry=None):
+        return CacheFill(self, key, request_headers, entry)
+
+    def store(self, entry, generation=None):
+        spill = []
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                unlink(entry.path)
+                return
+            old = [e for e in self.variants.get(entry.key, ()) if e.vary == entry.vary]
+            for e in old:
+                self._remove(e)
+            self.variants.setdefault(entry.key, []).append(entry)
+            if entry.data is not None:
+                self._add(entry, 'memory')
+                spill = self._shrink_memory()
+            else:
+                self._add(entry, 'disk')
+                self._shrink_disk()
+            self.counters['stores'] += 1
+        self._spill(spill)
+
+    def invalidate(self, filenames):
+        """Drop every entry, all Vary variants and both tiers, whose target
+        names one of ``filenames`` (after an upload or delete of them)."""
+        with self.lock:
+            self.generation += 1
+            keys = [key for key in self.variants if target_filename(key) in filenames]
+            for key in keys:
+                for entry in list(self.variants.get(key, ())):
+                    self._remove(entry)
+                    self.counters['invalidations'] += 1
+
+    def refreshed(self, entry, headers):
+        # a 304 from the backend: new headers and a new lifetime, same body
+        merged = dict(entry.headers)
+        for name, value in headers.items():
+            if name not in UNSTORED_HEADERS:
+                merged[name] = value
+        with self.lock:
+            entry.headers = merged
+            entry.refresh(merged)
+
+    def _add(self, entry, tier):
+        # caller holds self.lock
+        entry.tier = tier
+        if tier == 'memory':
+            self.memory[id(entry)] = entry
+            self.memory_used += entry.size
+        else:
+            self.disk[id(entry)] = entry
+            self.disk_used += entry.size
+
+    def _remove(self, entry):
+        # caller holds self.lock
+        tier = entry.tier
+        self._drop_variant(entry)
+        if tier == 'memory' and self.memory.pop(id(entry), None) is not None:
+            self.memory_used -= entry.size
+        elif tier == 'disk' and self.disk.pop(id(entry), None) is not None:
+            self.disk_used -= entry.size
+            unlink(entry.path)
+
+    def _shrink_memory(self):
+        # caller holds self.lock; returns entries to move to disk
+        spill = []
+        while self.memory_used > self.memory_bytes and self.memory:
+            _, entry = self.memory.popitem(last=False)
+            self.memory_used -= entry.size
+            entry.tier = 'spilling'
+            spill.append(entry)
+        return spill
+
+    def _shrink_disk(self):
+        # caller holds self.lock
+        while self.disk_used > self.disk_bytes and self.disk:
+            _, entry = self.disk.popitem(last=False)
+            self.disk_used -= entry.size
+            self._drop_variant(entry)
+            unlink(entry.path)
+            self.counters['evictions'] += 1
+
+    def _spill(self, entries):
+        # file writes happen outside the lock; readers keep using entry.data
+        for entry in entries:
+            path = None
+            if entry.size <= self.disk_bytes:
+                path = self.new_path()
+                try:
+                    with open(path, 'wb') as f:
+                        f.write(entry.data)
+                except OSError:
+                    unlink(path)
+                    path = None
+            with self.lock:
+                if entry.tier != 'spilling' or path is None:
+                    # replaced or removed meanwhile, or not writable
+                    if entry.tier == 'spilling':
+                        self._drop_variant(entry)
+                        self.counters['evictions'] += 1
+                    unlink(path)
+                    continue
+                entry.path = path
+                entry.data = None
+                self._add(entry, 'disk')
+                self.counters['spills'] += 1
+                self._shrink_disk()
+
+    def _drop_variant(self, entry):
+        # caller holds self.lock
+        entry.tier = None
+        variants = self.variants.get(entry.key)
+        if variants and entry in variants:
+            variants.remove(entry)
+            if not variants:
+                del self.variants[entry.key]
+
+    def new_path(self):
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.body')
+        os.close(fd)
+        return path
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({
+                'memory_entries': len(self.memory),
+                'memory_bytes': self.memory_used,
+                'disk_entries': len(self.disk),
+                'disk_bytes': self.disk_used,
+            })
+        served = stats['hits'] + stats['revalidated'] + stats['coalesced']
+        stats['hit_ratio'] = served / stats['requests'] if stats['requests'] else 0.0
+        total = stats['bytes_from_cache'] + stats['bytes_from_backend']
+        stats['byte_savings'] = stats['bytes_from_cache'] / total if total else 0.0
+        return stats
+
+
+def unlink(path):
+    if path:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class CacheFill:
+    """Watches one backend response on its way to the client.
+
+    head() decides whether the response is stored (and, for a 304 answering
+    our revalidation, that the client gets the cached body instead); data()
+    and end() collect and publish the body. abort() discards a partial one.
+    """
+
+    def __init__(self, cache, key, request_headers, entry=None):
+        self.cache = cache
+        self.key = key
+        self.request_headers = request_headers
+        self.entry = entry
+        self.generation = cache.generation
+        self.revalidated = False
+        self.capturing = False
+        self.buffer = None
+        self.file = None
+        self.path = None
+        self.size = 0
+
+    def head(self, status, reason, headers):
+        """Return False when the response should not be relayed as is."""
+        if status == 304 and self.entry is not None:
+            self.cache.refreshed(self.entry, headers)
+            self.revalidated = True
+            return False
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.capturing = self.cacheable(status, headers)
+        if self.capturing:
+            self.buffer = bytearray()
+        else:
+            self.cache.count('uncacheable')
+        return True
+
+    def cacheable(self, status, headers):
+        if status not in CACHEABLE_STATUS:
+            return False
+        response_cc = parse_cache_control(headers.get('cache-control', ''))
+        request_cc = parse_cache_control(self.request_headers.get('cache-control', ''))
+        if 'no-store' in response_cc or 'private' in response_cc or 'no-store' in request_cc:
+            return False
+        if 'authorization' in self.request_headers and not (
+                'public' in response_cc or 's-maxage' in response_cc):
+            return False
+        if headers.get('vary', '').strip() == '*':
+            return False
+        length = parse_seconds(headers.get('content-length'))
+        if length is not None and length > self.cache.max_object:
+            return False
+        # worth storing only if it can be reused or revalidated
+        return (freshness_lifetime(headers, response_cc) > 0
+                or 'etag' in headers or 'last-modified' in headers)
+
+    def data(self, chunk):
+        self.cache.count('bytes_from_backend', len(chunk))
+        if not self.capturing:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.max_object:
+            self.abort()
+            return
+        if self.file is None and self.size > self.cache.memory_max_object:
+            self.path = self.cache.new_path()
+            self.file = open(self.path, 'wb')
+            self.file.write(self.buffer)
+            self.buffer = None
+        if self.file is not None:
+            self.file.write(chunk)
+        else:
+            self.buffer += chunk
+
+    def end(self):
+        if not self.capturing:
+            return
+        self.capturing = False
+        data = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        else:
+            data = bytes(self.buffer)
+            self.buffer = None
+        vary_names = [v.strip().lower() for v in self.headers.get('vary', '').split(',') if v.strip()]
+        vary = tuple((name, self.request_headers.get(name, '')) for name in vary_names)
+        headers = {k: v for k, v in self.headers.items() if k not in UNSTORED_HEADERS}
+        entry = CachedResponse(self.key, vary, self.status, self.reason, headers, self.size, data, self.path)
+        self.path = None
+        self.cache.store(entry, self.generation)
+
+    def abort(self):
+        self.capturing = False
+        self.buffer = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        unlink(self.path)
+        self.path = None
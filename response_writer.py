@@ -0,0 +1,141 @@
+import os
+import ssl
+import socket
+
+# Reason phrases for the status lines we send; anything else goes out with
+# the code alone, which HTTP/1.1 allows.
+REASONS = {
+    100: 'Continue',
+    200: 'OK',
+    201: 'Created',
+    204: 'No Content',
+    206: 'Partial Content',
+    301: 'Moved Permanently',
+    302: 'Found',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    408: 'Request Timeout',
+    409: 'Conflict',
+    411: 'Length Required',
+    412: 'Precondition Failed',
+    413: 'Content Too Large',
+    414: 'URI Too Long',
+    416: 'Range Not Satisfiable',
+    417: 'Expectation Failed',
+    429: 'Too Many Requests',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+    501: 'Not Implemented',
+    502: 'Bad Gateway',
+    503: 'Service Unavailable',
+    504: 'Gateway Timeout',
+    505: 'HTTP Version Not Supported',
+}
+# Header blocks are cached per (status, content type) and per keep-alive
+# state; past this many entries new combinations are built but not kept
+# (e.g. multipart boundaries, which are unique per response).
+MAX_CACHED_BLOCKS = 1024
+# Buffers handed to one sendmsg() call.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+# Sockets that can't scatter-gather (TLS) get the pieces joined into one
+# write when they add up to no more than this, one sendall each otherwise.
+JOIN_LIMIT = 64 * 1024
+# Linux: hold a partial segment back because more data follows at once.
+MSG_MORE = getattr(socket, 'MSG_MORE', 0)
+
+STATUS_LINES = {code: f"HTTP/1.1 {code} {reason}\r\n".encode('ascii') for code, reason in REASONS.items()}
+HEAD_PREFIXES = {}
+CONNECTION_BLOCKS = {}
+
+
+def status_line(code):
+    line = STATUS_LINES.get(code)
+    if line is None:
+        line = f"HTTP/1.1 {code} {REASONS.get(code, '')}".rstrip().encode('ascii') + b"\r\n"
+        if len(STATUS_LINES) < MAX_CACHED_BLOCKS:
+            STATUS_LINES[code] = line
+    return line
+
+
+def head_prefix(code, content_type):
+    """Status line plus Content-Type, encoded once per combination."""
+    key = (code, content_type)
+    block = HEAD_PREFIXES.get(key)
+    if block is None:
+        block = status_line(code)
+        if content_type is not None:
+            block += f"Content-Type: {content_type}\r\n".encode('utf-8')
+        if len(HEAD_PREFIXES) < MAX_CACHED_BLOCKS:
+            HEAD_PREFIXES[key] = block
+    return block
+
+
+def connection_block(keep_alive, timeout, remaining):
+    """Connection headers and the blank line that ends the head."""
+    key = (keep_alive, timeout, remaining) if keep_alive else False
+    block = CONNECTION_BLOCKS.get(key)
+    if block is None:
+        if keep_alive:
+            block = (f"Connection: keep-alive\r\n"
+                     f"Keep-Alive: timeout={timeout}, max={remaining}\r\n\r\n").encode('ascii')
+        else:
+            block = b"Connection: close\r\n\r\n"
+        if len(CONNECTION_BLOCKS) < MAX_CACHED_BLOCKS:
+            CONNECTION_BLOCKS[key] = block
+    return block
+
+
+def send_buffers(connection, buffers, more=False):
+    """Send the buffers in order without joining them; returns the byte count.
+
+    Plain sockets get one sendmsg() (writev) per IOV_MAX buffers. Socket
+    stand-ins that queue output take them through writelines(); TLS
+    sockets, which have no sendmsg, get small responses as one write.
+    ``more`` says another write follows immediately (a sendfile body).
+    """
+    views = [memoryview(b) for b in buffers if len(b)]
+    total = sum(view.nbytes for view in views)
+    if isinstance(connection, socket.socket) and not isinstance(connection, ssl.SSLSocket):
+        sendmsg_all(connection, views, MSG_MORE if more else 0)
+        return total
+    writelines = getattr(connection, 'writelines', None)
+    if writelines is not None:
+        writelines(views)
+    elif total <= JOIN_LIMIT and len(views) > 1:
+        connection.sendall(b''.join(views))
+    else:
+        for view in views:
+            connection.sendall(view)
+    return total
+
+
+def sendmsg_all(sock, views, flags=0):
+    # a short write can end anywhere: drop what went out, trim the buffer
+    # it stopped in, and go again with the rest
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + IOV_MAX], (), flags)
+        while sent:
+            size = views[index].nbytes
+            if sent < size:
+                views[index] = views[index][sent:]
+                break
+            sent -= size
+            index += 1
+
+
+def consume(views, sent):
+    """Drop ``sent`` bytes from the front of a deque of memoryviews."""
+    while sent:
+        size = views[0].nbytes
+        if sent < size:
+            views[0] = views[0][sent:]
+            return
+        sent -= size
+        views.popleft()
@@ -1,51 +1,446 @@
-import socket
-import time
+import os
 import sys
-import asyncore
+import time
+import socket
 import logging
-from http import HttpServer
+import selectors
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http import Http, STORAGE_DIR, RECV_SIZE, FILE_CHUNK_SIZE, UPLOAD_CHUNK_SIZE, register_stats, connection_opened, connection_closed
+from http_parser import ParseError, RequestLine, HeadersComplete, NEED_DATA, CLOSED
+from worker_pool import ExecutorLoad
+from response_writer import IOV_MAX, consume
+
+#thread untuk pekerjaan disk yang blocking (open/stat/read, simpan upload, gzip)
+DISK_WORKERS = 16
+#body request lebih besar dari ini ditolak dengan 413
+MAX_BODY_SIZE = 8 * 1024 * 1024 * 1024
+#data body yang boleh menumpuk menunggu handler sebelum socket berhenti dibaca
+MAX_PENDING = 256 * 1024
+#seberapa sering (detik) koneksi idle diperiksa
+IDLE_SWEEP_INTERVAL = 1.0
+
+
+class WriteQueue:
+	"""Socket stand-in given to Http while it answers a request.
+
+	Nothing is written inside the handler: bytes and file segments are
+	queued and the event loop sends them as the socket becomes writable.
+	Request-body reads are served from bytes the event loop received while
+	the handler was running.
+	"""
+
+	def __init__(self, client):
+		self.client = client
+		self.items = deque()
+		self.size = 0
+		self.leftover = b""
+
+	def settimeout(self, timeout):
+		pass
+
+	def sendall(self, data):
+		# cached file data is immutable and can be queued without a copy
+		if isinstance(data, memoryview) and isinstance(data.obj, bytes):
+			view = data
+		else:
+			view = memoryview(bytes(data))
+		if len(view):
+			self.items.append(view)
+			self.size += len(view)
 
-httpserver = HttpServer()
-rcv = ""
+	def writelines(self, views):
+		#header dan body masuk antrean terpisah; handle_write mengirimnya sekaligus
+		for view in views:
+			self.sendall(view)
+
+	def sendfile(self, f, offset=0, count=None):
+		if count is None:
+			count = os.fstat(f.fileno()).st_size - offset
+		if count:
+			# the handler closes its file when it returns; keep our own fd
+			self.items.append([os.dup(f.fileno()), offset, count])
+			self.size += count
+		return count
+
+	def recv_into(self, buffer, nbytes=0):
+		data = self.leftover or self.client.next_pending()
+		if data is None:
+			return 0
+		n = min(nbytes or len(buffer), len(data))
+		buffer[:n] = data[:n]
+		self.leftover = data[n:]
+		return n
+
+	def close(self):
+		pass
+
+	def discard(self):
+		for item in self.items:
+			if isinstance(item, list):
+				os.close(item[0])
+		self.items.clear()
+		self.size = 0
+
+
+class ProcessTheClient:
+	"""Per-connection state for the event loop.
+
+	Reads are fed to the connection's HttpParser until a request head is
+	complete. Requests that need neither a body nor the disk are answered
+	right away on the loop; the rest run their Http handler on a disk
+	worker, which reads the body (uploads stream straight into the content
+	store) from bytes the loop passes on, and queues the response. The
+	queued response is flushed with non-blocking send()/sendfile().
+	Pipelined requests wait until the previous response is out.
+	"""
+
+	def __init__(self, server, sock, address):
+		self.server = server
+		self.sock = sock
+		self.address = address
+		self.http = Http(limits={'max_body_size': MAX_BODY_SIZE})
+		self.http.address = address
+		self.parser = self.http.parser
+		self.output = WriteQueue(self)
+		self.http.connection = self.output
+		self.request = None
+		self.busy = False
+		self.reading_paused = False
+		self.pending = deque()
+		self.pending_bytes = 0
+		self.pending_cond = threading.Condition()
+		self.close_after_write = False
+		self.events = selectors.EVENT_READ
+		self.last_active = time.monotonic()
+		connection_opened()
 
-class ProcessTheClient(asyncore.dispatcher_with_send):
 	def handle_read(self):
-		global rcv
-		data = self.recv(1024)
-		if data:
-			d = data.decode()
-			rcv = rcv + d
-			if rcv[-2:] == '\r\n':
-				# end of command, proses string
-				logging.warning("data dari client: {}".format(rcv))
-				hasil = httpserver.proses(rcv)
-				#hasil sudah dalam bentuk bytes
-				hasil = hasil + "\r\n\r\n".encode()
-				#agar bisa dioperasikan dengan string \r\n\r\n maka harus diencode dulu => bytes
-				logging.warning("balas ke  client: {}".format(hasil))
-				self.send(hasil) #hasil sudah dalam bentuk bytes, kirimkan balik ke client
-				rcv = ""
-				self.close()
-
-		#self.send('HTTP/1.1 200 OK \r\n\r\n'.encode())
-			#self.send("{}" . format(httpserver.proses(d)))
-		self.close()
-
-class Server(asyncore.dispatcher):
-	def __init__(self,portnumber):
-		asyncore.dispatcher.__init__(self)
-		self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.set_reuse_addr()
-		self.bind(('',portnumber))
-		self.listen(1)
-		logging.warning("running on port {}" . format(portnumber))
+		if self.busy:
+			self.read_for_handler()
+			return
+		try:
+			size = UPLOAD_CHUNK_SIZE if self.parser.in_body else RECV_SIZE
+			self.parser.recv_into(self.sock, size)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			self.close()
+			return
+		self.last_active = time.monotonic()
+		self.process_events()
+
+	def read_for_handler(self):
+		# the handler owns the parser; queue for WriteQueue.recv_into
+		try:
+			data = self.sock.recv(UPLOAD_CHUNK_SIZE)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			data = b""
+		self.last_active = time.monotonic()
+		with self.pending_cond:
+			self.pending.append(data or None)
+			self.pending_bytes += len(data)
+			self.pending_cond.notify()
+		#EOF atau antrean penuh: berhenti membaca sampai handler mengejar
+		if not data or self.pending_bytes > MAX_PENDING:
+			self.reading_paused = True
+			self.update_interest()
+
+	def next_pending(self):
+		# called from the disk worker while a request body is read
+		with self.pending_cond:
+			while not self.pending:
+				if self.sock is None:
+					return None
+				if not self.pending_cond.wait(self.http.read_timeout):
+					raise socket.timeout("timed out waiting for request body")
+			data = self.pending[0]
+			if data is None:
+				return None
+			self.pending.popleft()
+			self.pending_bytes -= len(data)
+			if self.reading_paused and self.pending_bytes < MAX_PENDING // 2:
+				self.server.call_soon_threadsafe(self.resume_reading)
+			return data
+
+	def resume_reading(self):
+		if self.busy and self.reading_paused and self.pending_bytes < MAX_PENDING // 2:
+			if self.pending and self.pending[-1] is None:
+				return
+			self.reading_paused = False
+			self.update_interest()
+
+	def process_events(self):
+		try:
+			while not self.busy and not self.output.size and not self.close_after_write:
+				event = self.parser.next_event(UPLOAD_CHUNK_SIZE)
+				if event is NEED_DATA:
+					break
+				if event is CLOSED:
+					self.close()
+					return
+				if isinstance(event, RequestLine):
+					self.request = event
+				elif isinstance(event, HeadersComplete):
+					self.start_request(event.headers)
+		except ParseError as e:
+			# limits (413 for a declared body over MAX_BODY_SIZE, 431, ...)
+			# are checked by the parser before the head is complete
+			self.request = None
+			self.http.keep_alive = False
+			self.http.send_response(e.status, e.message.encode())
+			self.close_after_write = True
+		self.update_interest()
+
+	def start_request(self, headers):
+		method, uri, version = self.request
+		self.request = None
+		request = self.http.build_request(method, uri, version, headers)
+		#setelah header request chunked, parser masih di CHUNK_SIZE (belum in_body)
+		has_body = self.parser.chunked or self.parser.body_remaining > 0
+		if has_body and request['body'].expect_continue:
+			# the body is fed by the loop, so say so now rather than from the handler
+			request['body'].continued = True
+			self.sock_send_now(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+		if not has_body and not self.http.needs_disk(request):
+			#tanpa body dan tanpa disk: dijawab langsung di event loop
+			self.finish_request(self.run_handler(request))
+			return
+
+		self.busy = True
+		self.server.load.started()
+		future = self.server.executor.submit(self.run_handler, request)
+		future.add_done_callback(lambda future: self.server.call_soon_threadsafe(self.request_done, future))
+
+	def run_handler(self, request):
+		try:
+			return self.http.handle_request(request)
+		except Exception as e:
+			logging.error("error handling request from {}: {}" . format(self.address, e))
+			return False
+
+	def request_done(self, future):
+		self.busy = False
+		self.server.load.finished()
+		if self.sock is None:
+			# closed while the handler ran; its output has nowhere to go
+			self.output.discard()
+			return
+		self.finish_request(future.result())
+		#kirim responsnya, lalu lanjut ke request pipelined berikutnya
+		self.process_events()
+
+	def finish_request(self, keep_open):
+		# bytes that arrived while the handler ran belong to the parser again
+		with self.pending_cond:
+			chunks = [self.output.leftover] + list(self.pending)
+			self.output.leftover = b""
+			self.pending.clear()
+			self.pending_bytes = 0
+		self.reading_paused = False
+		if not keep_open:
+			self.close_after_write = True
+			return
+		for chunk in chunks:
+			if chunk is None:
+				self.parser.feed_eof()
+			elif chunk:
+				self.parser.feed(chunk)
+
+	def sock_send_now(self, data):
+		# small interim responses; whatever doesn't fit goes through the queue
+		if self.output.size:
+			self.output.sendall(data)
+			return
+		try:
+			sent = self.sock.send(data)
+		except (BlockingIOError, InterruptedError):
+			sent = 0
+		if sent < len(data):
+			self.output.sendall(data[sent:])
+
+	def handle_write(self):
+		if self.busy:
+			# the handler is still filling the queue
+			return
+		items = self.output.items
+		try:
+			while items:
+				item = items[0]
+				if isinstance(item, memoryview):
+					#semua buffer berurutan dikirim dengan satu sendmsg (writev)
+					batch = []
+					for view in items:
+						if not isinstance(view, memoryview) or len(batch) == IOV_MAX:
+							break
+						batch.append(view)
+					sent = self.sock.sendmsg(batch)
+					self.output.size -= sent
+					consume(items, sent)
+					if sent < sum(len(view) for view in batch):
+						break
+				else:
+					fd, offset, count = item
+					sent = os.sendfile(self.sock.fileno(), fd, offset, min(count, FILE_CHUNK_SIZE * 16))
+					if sent == 0:
+						raise ConnectionError("file truncated while sending")
+					self.output.size -= sent
+					item[1] += sent
+					item[2] -= sent
+					if item[2]:
+						break
+					os.close(fd)
+					items.popleft()
+		except (BlockingIOError, InterruptedError):
+			pass
+		except OSError as e:
+			logging.error("error sending to {}: {}" . format(self.address, e))
+			self.close()
+			return
+		self.last_active = time.monotonic()
+
+		if items:
+			return
+		if self.close_after_write:
+			self.close()
+			return
+		# response is out; carry on with anything pipelined behind it
+		self.process_events()
+
+	def update_interest(self):
+		if self.sock is None:
+			return
+		if self.busy:
+			#handler masih jalan: hanya baca body untuknya (kecuali sedang ditahan)
+			events = 0 if self.reading_paused else selectors.EVENT_READ
+		elif self.close_after_write and not self.output.size:
+			self.close()
+			return
+		else:
+			events = selectors.EVENT_WRITE if self.output.size else selectors.EVENT_READ
+		if events != self.events:
+			if not events:
+				self.server.selector.unregister(self.sock)
+			elif not self.events:
+				self.server.selector.register(self.sock, events, self)
+			else:
+				self.server.selector.modify(self.sock, events, self)
+			self.events = events
+		if self.output.size and not self.busy:
+			# most responses fit the socket buffer; don't wait for a select round
+			self.handle_write()
+
+	def close(self):
+		if self.sock is None:
+			return
+		if self.events:
+			self.server.selector.unregister(self.sock)
+		self.server.clients.pop(self.sock.fileno(), None)
+		self.sock.close()
+		self.sock = None
+		if not self.busy:
+			self.output.discard()
+		with self.pending_cond:
+			# a handler waiting for body bytes sees the end of them
+			self.pending_cond.notify_all()
+		connection_closed()
+
+
+class Server:
+	def __init__(self, portnumber, workers=DISK_WORKERS):
+		self.portnumber = portnumber
+		self.selector = selectors.DefaultSelector()
+		self.clients = {}
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+		self.load = ExecutorLoad(workers)
+		register_stats('executor', self.load.stats)
+		#worker disk membangunkan event loop lewat socketpair ini
+		self.callbacks = deque()
+		self.wake_r, self.wake_w = socket.socketpair()
+		self.wake_r.setblocking(False)
+		self.wake_w.setblocking(False)
+		self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+		self.my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		self.my_socket.bind(('', portnumber))
+		self.my_socket.listen(1024)
+		self.my_socket.setblocking(False)
+		self.selector.register(self.my_socket, selectors.EVENT_READ, None)
+		logging.warning("running on port {} ({})" . format(portnumber, type(self.selector).__name__))
+
+	def call_soon_threadsafe(self, callback, *args):
+		self.callbacks.append((callback, args))
+		try:
+			self.wake_w.send(b"\0")
+		except (BlockingIOError, InterruptedError):
+			# the loop already has a wake-up pending
+			pass
+
+	def run_callbacks(self):
+		try:
+			while self.wake_r.recv(4096):
+				pass
+		except (BlockingIOError, InterruptedError):
+			pass
+		while self.callbacks:
+			callback, args = self.callbacks.popleft()
+			callback(*args)
 
 	def handle_accept(self):
-		pair = self.accept()
-		if pair is not None:
-			sock, addr = pair
-			logging.warning("connection from {}" . format(repr(addr)))
-			handler = ProcessTheClient(sock)
+		#terima semua koneksi yang sudah antri
+		while True:
+			try:
+				sock, addr = self.my_socket.accept()
+			except (BlockingIOError, InterruptedError):
+				return
+			except OSError as e:
+				logging.error("accept failed: {}" . format(e))
+				return
+			sock.setblocking(False)
+			sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			client = ProcessTheClient(self, sock, addr)
+			self.clients[sock.fileno()] = client
+			self.selector.register(sock, selectors.EVENT_READ, client)
+
+	def sweep_idle(self):
+		now = time.monotonic()
+		for client in list(self.clients.values()):
+			if client.busy:
+				# the handler enforces its own read timeout on the body
+				continue
+			#timeout keep-alive hanya untuk koneksi yang menunggu request berikutnya
+			if client.parser.idle and not client.output.size:
+				timeout = client.http.keepalive_timeout
+			else:
+				timeout = client.http.read_timeout
+			if now - client.last_active > timeout:
+				client.close()
+
+	def serve_forever(self):
+		if not os.path.exists(STORAGE_DIR):
+			os.makedirs(STORAGE_DIR)
+		next_sweep = time.monotonic() + IDLE_SWEEP_INTERVAL
+		while True:
+			for key, mask in self.selector.select(IDLE_SWEEP_INTERVAL):
+				client = key.data
+				if key.fileobj is self.wake_r:
+					self.run_callbacks()
+					continue
+				if client is None:
+					self.handle_accept()
+					continue
+				if mask & selectors.EVENT_WRITE:
+					client.handle_write()
+				if mask & selectors.EVENT_READ and client.sock is not None:
+					client.handle_read()
+			if time.monotonic() >= next_sweep:
+				self.sweep_idle()
+				next_sweep = time.monotonic() + IDLE_SWEEP_INTERVAL
+
 
 def main():
 	portnumber=8887
@@ -54,8 +449,10 @@ def main():
 	except:
 		pass
 	svr = Server(portnumber)
-	asyncore.loop()
+	try:
+		svr.serve_forever()
+	except KeyboardInterrupt:
+		logging.warning("server stopped")
 
 if __name__=="__main__":
 	main()
-
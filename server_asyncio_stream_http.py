@@ -1,46 +1,336 @@
-from socket import *
-import socket
-import time
+import os
 import sys
+import socket
 import logging
-import multiprocessing
-from concurrent.futures import ProcessPoolExecutor
 import asyncio
-from http import HttpServer
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http import Http, register_stats, connection_opened, connection_closed
+from worker_pool import ExecutorLoad
+from http_parser import ParseError, RequestLine, HeadersComplete, NEED_DATA, CLOSED
+
+#thread untuk pekerjaan disk yang blocking (open/stat/read, simpan upload, gzip)
+DISK_WORKERS = 32
+#batas buffer tulis transport; di atas HIGH pengiriman menunggu sampai turun ke LOW
+WRITE_HIGH_WATER = 256 * 1024
+WRITE_LOW_WATER = 64 * 1024
+#data masuk yang boleh menumpuk selama handler masih berjalan sebelum pause_reading
+MAX_PENDING = 256 * 1024
+
+
+class LoopConnection:
+	"""Socket stand-in given to Http while it answers a request.
+
+	Writes never block the caller: bytes and file segments are queued and
+	the protocol's writer task sends them on the event loop, awaiting the
+	transport's drain and using loop.sendfile for files. Request-body reads
+	are served from bytes the protocol queued while the handler was running.
+	"""
+
+	def __init__(self, protocol):
+		self.protocol = protocol
+		self.loop = protocol.loop
+		self.items = deque()
+		self.leftover = b""
+
+	def settimeout(self, timeout):
+		pass
+
+	def push(self, item):
+		if self.protocol.closed:
+			raise ConnectionResetError("connection closed")
+		self.items.append(item)
+		#handler bisa jalan di executor; writer dibangunkan lewat event loop
+		self.loop.call_soon_threadsafe(self.protocol.start_writer)
+
+	def sendall(self, data):
+		# cached file data is immutable and can be queued without a copy
+		if not (isinstance(data, memoryview) and isinstance(data.obj, bytes)):
+			data = bytes(data)
+		if len(data):
+			self.push(data)
+
+	def writelines(self, views):
+		#header dan body masuk satu per satu; transport.writelines mengirimnya bersama
+		data = [view if isinstance(view, memoryview) and isinstance(view.obj, bytes) else bytes(view)
+				for view in views]
+		self.push(data)
+
+	def sendfile(self, f, offset=0, count=None):
+		if count is None:
+			count = os.fstat(f.fileno()).st_size - offset
+		if count:
+			# the handler closes its file when it returns; keep our own fd
+			self.push((os.dup(f.fileno()), offset, count))
+		return count
+
+	def recv_into(self, buffer, nbytes=0):
+		data = self.leftover or self.protocol.next_pending()
+		if data is None:
+			return 0
+		n = min(nbytes or len(buffer), len(data))
+		buffer[:n] = data[:n]
+		self.leftover = data[n:]
+		return n
+
+	def close(self):
+		self.loop.call_soon_threadsafe(self.protocol.transport.close)
+
+	def discard(self):
+		while self.items:
+			item = self.items.popleft()
+			if isinstance(item, tuple):
+				os.close(item[0])
 
-httpserver = HttpServer()
 
 class ProcessTheClient(asyncio.Protocol):
-		def connection_made(self, transport):
-			peername = transport.get_extra_info('peername')
-			print('Connection from {}'.format(peername))
-			self.transport = transport
-			self.rcv = ""
-		def data_received(self, data: bytes) -> None:
-			try:
-				d = data.decode()
-				self.rcv=self.rcv+d
-				if self.rcv[-2:]=='\r\n':
-					hasil = httpserver.proses(self.rcv)
-					hasil=hasil+"\r\n\r\n".encode()
-					self.transport.write(hasil)
+	"""One keep-alive connection.
+
+	Request heads are parsed and routed on the event loop. Requests that
+	need no disk are answered right there; the rest run their Http handler
+	in the bounded executor, which only does the disk work: the response is
+	queued and written by the loop, so no thread ever waits on a slow
+	reader. An idle connection holds no thread, only this object.
+	"""
+
+	def __init__(self, executor, load=None):
+		self.executor = executor
+		self.load = load
+		self.loop = asyncio.get_running_loop()
+		self.http = Http()
+		self.parser = self.http.parser
+		self.request_line = None
+		self.busy = False
+		self.closed = False
+		self.reading_paused = False
+		self.idle_handle = None
+		self.writer = None
+		self.pending = deque()
+		self.pending_bytes = 0
+		self.pending_cond = threading.Condition()
+
+	def connection_made(self, transport):
+		self.transport = transport
+		transport.set_write_buffer_limits(high=WRITE_HIGH_WATER, low=WRITE_LOW_WATER)
+		self.can_write = asyncio.Event()
+		self.can_write.set()
+		self.output = LoopConnection(self)
+		self.http.connection = self.output
+		self.http.address = transport.get_extra_info('peername')
+		self.reset_idle_timer()
+		connection_opened()
+
+	def connection_lost(self, exc):
+		self.closed = True
+		connection_closed()
+		self.can_write.set()
+		if self.idle_handle is not None:
+			self.idle_handle.cancel()
+		if self.writer is None or self.writer.done():
+			self.output.discard()
+		with self.pending_cond:
+			self.pending_cond.notify_all()
+
+	def pause_writing(self):
+		self.can_write.clear()
+
+	def resume_writing(self):
+		self.can_write.set()
+
+	def data_received(self, data):
+		if self.busy:
+			# the handler owns the parser; queue for LoopConnection.recv_into
+			with self.pending_cond:
+				self.pending.append(data)
+				self.pending_bytes += len(data)
+				self.pending_cond.notify()
+			if self.pending_bytes > MAX_PENDING and not self.reading_paused:
+				self.reading_paused = True
+				self.transport.pause_reading()
+			return
+		self.parser.feed(data)
+		self.reset_idle_timer()
+		self.parse_requests()
+
+	def eof_received(self):
+		if self.busy:
+			with self.pending_cond:
+				self.pending.append(None)
+				self.pending_cond.notify()
+		else:
+			self.parser.feed_eof()
+			self.parse_requests()
+		#tetap buka sisi tulis sampai respons terkirim
+		return True
+
+	def parse_requests(self):
+		try:
+			while not self.busy and not self.closed:
+				event = self.parser.next_event()
+				if event is NEED_DATA:
+					return
+				if event is CLOSED:
 					self.transport.close()
-					self.rcv=""
-			except OSError as e:
-				pass
+					return
+				if isinstance(event, RequestLine):
+					self.request_line = event
+				elif isinstance(event, HeadersComplete):
+					self.start_request(event.headers)
+		except ParseError as e:
+			self.send_error(e)
+
+	def start_request(self, headers):
+		method, uri, version = self.request_line
+		request = self.http.build_request(method, uri, version, headers)
+		self.busy = True
+		if self.idle_handle is not None:
+			self.idle_handle.cancel()
+		has_body = self.parser.chunked or self.parser.body_remaining > 0
+		if has_body and request['body'].expect_continue:
+			# the body is fed by the loop, so say so now rather than from the handler
+			request['body'].send_continue()
+		self.loop.create_task(self.run_request(request, has_body))
+
+	async def run_request(self, request, has_body):
+		try:
+			if has_body or self.http.needs_disk(request):
+				if self.load is not None:
+					self.load.started()
+				try:
+					keep_open = await self.loop.run_in_executor(self.executor, self.http.handle_request, request)
+				finally:
+					if self.load is not None:
+						self.load.finished()
+			else:
+				#tanpa body dan tanpa disk: dijawab langsung di event loop
+				keep_open = self.http.handle_request(request)
+			#respons dikirim habis dulu sebelum request berikutnya diproses
+			self.start_writer()
+			await self.writer
+			if self.closed or self.transport.is_closing():
+				keep_open = False
+		except (ConnectionError, socket.timeout, ParseError):
+			keep_open = False
+		except Exception as e:
+			logging.error("error handling request from {}: {}" . format(self.http.address, e))
+			keep_open = False
+		self.request_done(keep_open)
+
+	def request_done(self, keep_open):
+		self.busy = False
+		if self.closed:
+			return
+		if not keep_open:
+			self.transport.close()
+			return
 
+		# bytes that arrived while the handler ran belong to the parser again
+		with self.pending_cond:
+			chunks = [self.output.leftover] + list(self.pending)
+			self.output.leftover = b""
+			self.pending.clear()
+			self.pending_bytes = 0
+		for chunk in chunks:
+			if chunk is None:
+				self.parser.feed_eof()
+			elif chunk:
+				self.parser.feed(chunk)
+		if self.reading_paused:
+			self.reading_paused = False
+			self.transport.resume_reading()
+		self.reset_idle_timer()
+		self.parse_requests()
 
+	def next_pending(self):
+		# called from the executor thread while a request body is read
+		with self.pending_cond:
+			while not self.pending:
+				if self.closed:
+					return None
+				if not self.pending_cond.wait(self.http.read_timeout):
+					raise socket.timeout("timed out waiting for request body")
+			data = self.pending[0]
+			if data is None:
+				return None
+			self.pending.popleft()
+			self.pending_bytes -= len(data)
+			if self.reading_paused and self.pending_bytes < MAX_PENDING // 2:
+				self.loop.call_soon_threadsafe(self.resume_reading_if_paused)
+			return data
 
-async def Server():
+	def resume_reading_if_paused(self):
+		if self.reading_paused and not self.closed:
+			self.reading_paused = False
+			self.transport.resume_reading()
+
+	def start_writer(self):
+		if self.writer is None or self.writer.done():
+			self.writer = self.loop.create_task(self.write_output())
+
+	async def write_output(self):
+		items = self.output.items
+		try:
+			while items:
+				if self.closed or self.transport.is_closing():
+					raise ConnectionResetError("connection closed")
+				item = items.popleft()
+				if isinstance(item, tuple):
+					fd, offset, count = item
+					with os.fdopen(fd, 'rb') as f:
+						await self.loop.sendfile(self.transport, f, offset, count)
+					continue
+				if isinstance(item, list):
+					self.transport.writelines(item)
+				else:
+					self.transport.write(item)
+				await self.can_write.wait()
+		except Exception as e:
+			if not isinstance(e, ConnectionError):
+				logging.error("error sending to {}: {}" . format(self.http.address, e))
+			self.output.discard()
+			if not self.transport.is_closing():
+				self.transport.close()
+
+	def send_error(self, e):
+		self.http.keep_alive = False
+		body = e.message.encode()
+		self.transport.writelines([self.http.response_head(e.status, 'text/plain; charset=utf-8', len(body)), body])
+		self.transport.close()
+
+	def reset_idle_timer(self):
+		if self.idle_handle is not None:
+			self.idle_handle.cancel()
+		#timeout keep-alive hanya selama menunggu request berikutnya
+		timeout = self.http.keepalive_timeout if self.parser.idle else self.http.read_timeout
+		self.idle_handle = self.loop.call_later(timeout, self.on_idle)
+
+	def on_idle(self):
+		if not self.busy:
+			self.transport.close()
+
+
+async def Server(portnumber=8886, workers=DISK_WORKERS):
 	loop = asyncio.get_running_loop()
+	executor = ThreadPoolExecutor(max_workers=workers)
+	load = ExecutorLoad(workers)
+	register_stats('executor', load.stats)
 
 	server = await loop.create_server(
-		lambda: ProcessTheClient(),
-		'0.0.0.0', 8886)
+		lambda: ProcessTheClient(executor, load),
+		'0.0.0.0', portnumber, backlog=1024, reuse_address=True)
+	logging.warning("running on port {}" . format(portnumber))
 
 	async with server:
-		await server.serve_forever()
+		try:
+			await server.serve_forever()
+		finally:
+			executor.shutdown(wait=False)
 
 if __name__=="__main__":
-	asyncio.run(Server())
-
+	portnumber=8886
+	try:
+		portnumber=int(sys.argv[1])
+	except:
+		pass
+	asyncio.run(Server(portnumber))
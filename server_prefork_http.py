@@ -0,0 +1,183 @@
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import logging
+import metrics
+import access_log
+from concurrent.futures import ThreadPoolExecutor
+from http import Http, STORAGE_DIR, register_stats
+from worker_pool import ExecutorLoad
+
+UPLOAD_DIR = STORAGE_DIR
+# Threads per worker process (the thread engine's pool, or the asyncio
+# engine's disk executor).
+WORKER_THREADS = 16
+# A worker that dies sooner than this after starting is respawned only
+# after the same delay, so a crash loop doesn't spin the supervisor.
+RESPAWN_DELAY = 1.0
+
+
+def make_listener(portnumber, reuseport):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('0.0.0.0', portnumber))
+    sock.listen(1024)
+    return sock
+
+
+def handle_client(connection, address, load=None):
+    try:
+        Http().process(connection, address)
+    except Exception as e:
+        logging.error(f"Error handling client {address}: {e}")
+    finally:
+        connection.close()
+        if load is not None:
+            load.finished()
+
+
+def run_thread_worker(listener, threads):
+    executor = ThreadPoolExecutor(max_workers=threads)
+    load = ExecutorLoad(threads)
+    register_stats('executor', load.stats)
+    while True:
+        connection, address = listener.accept()
+        load.started()
+        executor.submit(handle_client, connection, address, load)
+
+
+def run_asyncio_worker(listener, threads):
+    from server_asyncio_stream_http import ProcessTheClient
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=threads)
+        load = ExecutorLoad(threads)
+        register_stats('executor', load.stats)
+        server = await loop.create_server(lambda: ProcessTheClient(executor, load), sock=listener)
+        async with server:
+            await server.serve_forever()
+
+    asyncio.run(serve())
+
+
+ENGINES = {
+    'threads': run_thread_worker,
+    'asyncio': run_asyncio_worker,
+}
+
+
+class Server:
+    """Pre-forked server: N worker processes, each serving the Http core.
+
+    With SO_REUSEPORT every worker binds its own listener and the kernel
+    spreads incoming connections across them, so there is no shared accept
+    queue and no fd passing. Without it the workers inherit one listener
+    created before the fork. The parent only supervises: it respawns
+    workers that exit and takes them all down on SIGINT/SIGTERM.
+    """
+
+    def __init__(self, portnumber, workers=None, threads=WORKER_THREADS, engine='threads',
+                 reuseport=None):
+        if engine not in ENGINES:
+            raise ValueError(f"unknown engine {engine!r}, expected one of {sorted(ENGINES)}")
+        self.portnumber = portnumber
+        self.workers = workers or os.cpu_count() or 1
+        self.threads = threads
+        self.engine = engine
+        self.reuseport = hasattr(socket, 'SO_REUSEPORT') if reuseport is None else reuseport
+        self.listener = None
+        self.children = {}
+        self.running = False
+
+    def start(self):
+        if not os.path.exists(UPLOAD_DIR):
+            os.makedirs(UPLOAD_DIR)
+            logging.info(f"Created directory: {UPLOAD_DIR}")
+
+        if not self.reuseport:
+            self.listener = make_listener(self.portnumber, False)
+        # /metrics in any worker reports the sum over all of them
+        metrics.enable_multiprocess(self.portnumber)
+
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for slot in range(self.workers):
+            self.spawn(slot)
+        logging.warning(f"Server (Pre-fork, {self.workers} x {self.engine}, "
+                        f"{'SO_REUSEPORT' if self.reuseport else 'shared listener'}) "
+                        f"listening on port {self.portnumber}")
+        self.supervise()
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = (slot, time.monotonic())
+            return
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        code = 0
+        try:
+            listener = self.listener or make_listener(self.portnumber, True)
+            ENGINES[self.engine](listener, self.threads)
+        except KeyboardInterrupt:
+            pass
+        except BaseException as e:
+            logging.error(f"Worker {slot} (pid {os.getpid()}) crashed: {e}")
+            code = 1
+        finally:
+            # os._exit skips atexit; write out what is still queued
+            access_log.flush()
+            os._exit(code)
+
+    def supervise(self):
+        while self.running or self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            slot, started = self.children.pop(pid, (None, 0))
+            if slot is None or not self.running:
+                continue
+            logging.warning(f"Worker {slot} (pid {pid}) exited with status {status}, respawning")
+            if time.monotonic() - started < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+            if self.running:
+                self.spawn(slot)
+        self.shutdown()
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def shutdown(self):
+        if self.listener is not None:
+            self.listener.close()
+        logging.warning("Server workers stopped.")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
+
+    portnumber = 8889
+    workers = None
+    engine = 'threads'
+    try:
+        portnumber = int(sys.argv[1])
+        workers = int(sys.argv[2])
+        engine = sys.argv[3]
+    except (IndexError, ValueError):
+        pass
+    server = Server(portnumber, workers, engine=engine)
+    server.start()
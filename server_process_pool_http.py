@@ -1,11 +1,14 @@
 from socket import *
 import socket
+import sys
 import logging
 import os
-from http import Http
+import metrics
+from http import Http, STORAGE_DIR, register_stats
+from worker_pool import ExecutorLoad
 from concurrent.futures import ProcessPoolExecutor
 
-UPLOAD_DIR = "files"
+UPLOAD_DIR = STORAGE_DIR
 
 def handle_client_process(connection, address):
     """
@@ -27,11 +30,15 @@ class Server:
         self.my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.load = ExecutorLoad(max_workers)
+        register_stats('pool', self.load.stats)
 
     def start(self):
         if not os.path.exists(UPLOAD_DIR):
             os.makedirs(UPLOAD_DIR)
             logging.info(f"Created directory: {UPLOAD_DIR}")
+        # workers write metric snapshots; /metrics in any of them sums all
+        metrics.enable_multiprocess(self.portnumber)
             
         self.my_socket.bind(('0.0.0.0', self.portnumber))
         self.my_socket.listen(5)
@@ -40,9 +47,10 @@ class Server:
         while True:
             try:
                 connection, address = self.my_socket.accept()
-                logging.warning(f"Connection from {address}")
                 
-                self.executor.submit(handle_client_process, connection, address)
+                self.load.started()
+                future = self.executor.submit(handle_client_process, connection, address)
+                future.add_done_callback(self.load.finished)
 
             except KeyboardInterrupt:
                 logging.warning("Server shutting down.")
@@ -61,7 +69,12 @@ class Server:
 if __name__ == '__main__':
     logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
     
-    server = Server(8889)
+    portnumber = 8889
+    try:
+        portnumber = int(sys.argv[1])
+    except (IndexError, ValueError):
+        pass
+    server = Server(portnumber)
     try:
         server.start()
     except KeyboardInterrupt:
@@ -4,9 +4,7 @@ import threading
 import time
 import sys
 import logging
-from http import HttpServer
-
-httpserver = HttpServer()
+from http import Http
 
 
 class ProcessTheClient(threading.Thread):
@@ -16,48 +14,30 @@ class ProcessTheClient(threading.Thread):
 		threading.Thread.__init__(self)
 
 	def run(self):
-		rcv=""
-		while True:
-			try:
-				data = self.connection.recv(32)
-				if data:
-					#merubah input dari socket (berupa bytes) ke dalam string
-					#agar bisa mendeteksi \r\n
-					d = data.decode()
-					rcv=rcv+d
-					if rcv[-2:]=='\r\n':
-						#end of command, proses string
-						logging.warning("data dari client: {}" . format(rcv))
-						hasil = httpserver.proses(rcv)
-						#hasil akan berupa bytes
-						#untuk bisa ditambahi dengan string, maka string harus di encode
-						hasil=hasil+"\r\n\r\n".encode()
-						logging.warning("balas ke  client: {}" . format(hasil))
-						#hasil sudah dalam bentuk bytes
-						self.connection.sendall(hasil)
-						rcv=""
-						self.connection.close()
-				else:
-					break
-			except OSError as e:
-				pass
-		self.connection.close()
+		#satu koneksi bisa membawa banyak request (keep-alive),
+		#loop request ada di dalam Http.process
+		try:
+			Http().process(self.connection, self.address)
+		except Exception as e:
+			logging.error("error handling client {}: {}" . format(self.address, e))
+		finally:
+			self.connection.close()
 
 
 
 class Server(threading.Thread):
-	def __init__(self):
+	def __init__(self,portnumber=8889):
+		self.portnumber = portnumber
 		self.the_clients = []
 		self.my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		threading.Thread.__init__(self)
 
 	def run(self):
-		self.my_socket.bind(('0.0.0.0', 8889))
+		self.my_socket.bind(('0.0.0.0', self.portnumber))
 		self.my_socket.listen(1)
 		while True:
 			self.connection, self.client_address = self.my_socket.accept()
-			logging.warning("connection from {}".format(self.client_address))
 
 			clt = ProcessTheClient(self.connection, self.client_address)
 			clt.start()
@@ -66,7 +46,12 @@ class Server(threading.Thread):
 
 
 def main():
-	svr = Server()
+	portnumber=8889
+	try:
+		portnumber=int(sys.argv[1])
+	except:
+		pass
+	svr = Server(portnumber)
 	svr.start()
 
 if __name__=="__main__":
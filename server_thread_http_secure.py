@@ -6,86 +6,210 @@ import time
 import sys
 import logging
 import ssl
-
-
-
-
-from http import HttpServer
-
-httpserver = HttpServer()
-
-
-class ProcessTheClient(threading.Thread):
-	def __init__(self, connection, address):
-		self.connection = connection
-		self.address = address
-		threading.Thread.__init__(self)
-
-	def run(self):
-		rcv=""
-		while True:
-			try:
-				data = self.connection.recv(32)
-				if data:
-					#merubah input dari socket (berupa bytes) ke dalam string
-					#agar bisa mendeteksi \r\n
-					d = data.decode()
-					rcv=rcv+d
-					if rcv[-2:]=='\r\n':
-						#end of command, proses string
-						logging.warning("data dari client: {}" . format(rcv))
-						hasil = httpserver.proses(rcv)
-						#hasil akan berupa bytes
-						#untuk bisa ditambahi dengan string, maka string harus di encode
-						hasil=hasil+"\r\n\r\n".encode()
-						logging.warning("balas ke  client: {}" . format(hasil))
-						#hasil sudah dalam bentuk bytes
-						self.connection.sendall(hasil)
-						rcv=""
-						self.connection.close()
-				else:
+import selectors
+
+
+
+
+from http import Http, register_stats
+from worker_pool import WorkerPool, POOL_MIN_WORKERS, POOL_MAX_WORKERS, POOL_QUEUE_SIZE
+
+#batas waktu (detik) untuk menyelesaikan seluruh TLS handshake, bukan per recv
+HANDSHAKE_TIMEOUT = 5
+#jumlah session ticket TLS 1.3 yang dikirim per handshake penuh
+TLS_NUM_TICKETS = 2
+TLS_MIN_VERSION = ssl.TLSVersion.TLSv1_2
+#None = default OpenSSL
+TLS_CIPHERS = None
+TLS_ECDH_CURVE = None
+ALPN_PROTOCOLS = ['http/1.1']
+#batas atas (detik) bucket histogram latensi handshake
+HANDSHAKE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+def make_context(certfile, keyfile, ciphers=TLS_CIPHERS, ecdh_curve=TLS_ECDH_CURVE,
+				 alpn_protocols=ALPN_PROTOCOLS, num_tickets=TLS_NUM_TICKETS,
+				 min_version=TLS_MIN_VERSION):
+	context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+	context.load_cert_chain(certfile=certfile, keyfile=keyfile)
+	context.minimum_version = min_version
+	# resumption: TLS 1.3 tickets, TLS 1.2 tickets plus the server-side
+	# session cache OpenSSL keeps per context
+	context.options &= ~ssl.OP_NO_TICKET
+	context.num_tickets = num_tickets
+	if ciphers:
+		context.set_ciphers(ciphers)
+	if ecdh_curve:
+		context.set_ecdh_curve(ecdh_curve)
+	if alpn_protocols:
+		context.set_alpn_protocols(alpn_protocols)
+	return context
+
+
+class HandshakeStats:
+	def __init__(self, context):
+		self.context = context
+		self.lock = threading.Lock()
+		self.completed = 0
+		self.resumed = 0
+		self.failed = 0
+		self.timeouts = 0
+		self.shed = 0
+		self.seconds_sum = 0.0
+		self.seconds_max = 0.0
+		self.bucket_counts = [0] * (len(HANDSHAKE_BUCKETS) + 1)
+		self.versions = {}
+		self.alpn = {}
+
+	def record(self, conn, seconds):
+		with self.lock:
+			self.completed += 1
+			if conn.session_reused:
+				self.resumed += 1
+			self.seconds_sum += seconds
+			self.seconds_max = max(self.seconds_max, seconds)
+			for i, bound in enumerate(HANDSHAKE_BUCKETS):
+				if seconds <= bound:
+					self.bucket_counts[i] += 1
 					break
-			except OSError as e:
-				pass
-		self.connection.close()
-
+			else:
+				self.bucket_counts[-1] += 1
+			version = conn.version()
+			self.versions[version] = self.versions.get(version, 0) + 1
+			protocol = conn.selected_alpn_protocol() or 'none'
+			self.alpn[protocol] = self.alpn.get(protocol, 0) + 1
+
+	def count(self, name):
+		with self.lock:
+			setattr(self, name, getattr(self, name) + 1)
+
+	def stats(self):
+		with self.lock:
+			buckets = {}
+			total = 0
+			for bound, count in zip(HANDSHAKE_BUCKETS + ('+Inf',), self.bucket_counts):
+				total += count
+				buckets[str(bound)] = total
+			return {
+				'handshakes': self.completed,
+				'resumed': self.resumed,
+				'resumption_rate': self.resumed / self.completed if self.completed else 0.0,
+				'failed': self.failed,
+				'timeouts': self.timeouts,
+				'shed': self.shed,
+				'handshake_avg': self.seconds_sum / self.completed if self.completed else 0.0,
+				'handshake_max': self.seconds_max,
+				'handshake_sum': self.seconds_sum,
+				'handshake_buckets': buckets,
+				'versions': dict(self.versions),
+				'alpn': dict(self.alpn),
+				'session_cache': self.context.session_stats(),
+			}
 
 
 class Server(threading.Thread):
-	def __init__(self,hostname='testing.net'):
-		self.the_clients = []
-#------------------------------
+	def __init__(self,hostname='testing.net',portnumber=8443,min_workers=POOL_MIN_WORKERS,
+				 max_workers=POOL_MAX_WORKERS,queue_size=POOL_QUEUE_SIZE,**tls_options):
 		self.hostname = hostname
+		self.portnumber = portnumber
+#------------------------------
 		cert_location = os.getcwd() + '/certs/'
-		self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-		self.context.load_cert_chain(certfile=cert_location + 'domain.crt',
-									 keyfile=cert_location + 'domain.key')
+		self.context = make_context(cert_location + 'domain.crt', cert_location + 'domain.key', **tls_options)
+		self.handshakes = HandshakeStats(self.context)
+		register_stats('tls', self.handshakes.stats)
 #---------------------------------
+		#handshake dan request dijalankan di worker pool, bukan di thread accept
+		self.pool = WorkerPool(self.handle_client, min_workers, max_workers, queue_size, name='tls',
+							   discard=self.drop_client)
+		register_stats('pool', self.pool.stats)
 		self.my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 		threading.Thread.__init__(self)
 
 	def run(self):
-		self.my_socket.bind(('0.0.0.0', 8443))
-		self.my_socket.listen(1)
+		self.my_socket.bind(('0.0.0.0', self.portnumber))
+		self.my_socket.listen(128)
+		logging.warning("running on port {}" . format(self.portnumber))
 		while True:
-			self.connection, self.client_address = self.my_socket.accept()
-			try:
-				self.secure_connection = self.context.wrap_socket(self.connection, server_side=True)
-				logging.warning("connection from {}".format(self.client_address))
-				clt = ProcessTheClient(self.secure_connection, self.client_address)
-				clt.start()
-				self.the_clients.append(clt)
-			except ssl.SSLError as essl:
-				print(str(essl))
+			connection, client_address = self.my_socket.accept()
+			if not self.pool.submit(connection, client_address):
+				#belum ada TLS, jadi tidak bisa membalas 503; cukup tutup
+				self.handshakes.count('shed')
+				connection.close()
+
+	def drop_client(self, connection, address):
+		#masih antri saat pool dihentikan
+		connection.close()
+
+	def handle_client(self, connection, address):
+		try:
+			secure_connection = self.handshake(connection, address)
+			if secure_connection is None:
+				return
+			connection = secure_connection
+			#satu koneksi bisa membawa banyak request (keep-alive),
+			#loop request ada di dalam Http.process
+			Http().process(connection, address)
+		except Exception as e:
+			logging.error("error handling client {}: {}" . format(address, e))
+		finally:
+			connection.close()
+
+	def handshake(self, connection, address):
+		started = time.monotonic()
+		secure_connection = self.context.wrap_socket(connection, server_side=True,
+													 do_handshake_on_connect=False)
+		try:
+			self.handshake_until(secure_connection, started + HANDSHAKE_TIMEOUT)
+		except socket.timeout:
+			self.handshakes.count('timeouts')
+			logging.warning("TLS handshake with {} timed out" . format(address))
+			secure_connection.close()
+			return None
+		except (ssl.SSLError, OSError) as essl:
+			self.handshakes.count('failed')
+			logging.warning("TLS handshake with {} failed: {}" . format(address, essl))
+			secure_connection.close()
+			return None
+		self.handshakes.record(secure_connection, time.monotonic() - started)
+		return secure_connection
+
+	def handshake_until(self, secure_connection, deadline):
+		#socket timeout berlaku per recv, jadi klien yang mengirim byte
+		#sedikit-sedikit bisa menahan worker selamanya; handshake dijalankan
+		#non-blocking dan ditunggu dengan sisa waktu sampai deadline
+		secure_connection.setblocking(False)
+		with selectors.DefaultSelector() as selector:
+			while True:
+				try:
+					secure_connection.do_handshake()
+					break
+				except ssl.SSLWantReadError:
+					events = selectors.EVENT_READ
+				except ssl.SSLWantWriteError:
+					events = selectors.EVENT_WRITE
+				remaining = deadline - time.monotonic()
+				if remaining <= 0:
+					raise socket.timeout("TLS handshake deadline exceeded")
+				selector.register(secure_connection, events)
+				ready = selector.select(remaining)
+				selector.unregister(secure_connection)
+				if not ready:
+					raise socket.timeout("TLS handshake deadline exceeded")
+		#Http.process memasang timeout-nya sendiri
+		secure_connection.setblocking(True)
 
 
 
 
 def main():
-	svr = Server()
+	portnumber=8443
+	try:
+		portnumber=int(sys.argv[1])
+	except:
+		pass
+	svr = Server(portnumber=portnumber)
 	svr.start()
 
 if __name__=="__main__":
 	main()
-
@@ -1,19 +1,38 @@
 from socket import *
 import socket
+import sys
 import threading
 import logging
 import os
-from concurrent.futures import ThreadPoolExecutor
-from http import Http
+from http import Http, STORAGE_DIR, register_stats
+from worker_pool import WorkerPool, POOL_MIN_WORKERS, POOL_MAX_WORKERS, POOL_QUEUE_SIZE
 
-UPLOAD_DIR = "files"
+UPLOAD_DIR = STORAGE_DIR
+# Seconds a shed client is told to wait before retrying.
+RETRY_AFTER = 1
+
+
+def shed_response():
+    http_handler = Http()
+    http_handler.keep_alive = False
+    body = b'Server busy, try again later.'
+    head = http_handler.response_head(503, 'text/plain; charset=utf-8', len(body),
+                                      {'Retry-After': str(RETRY_AFTER)})
+    return head + body
+
+
+# built once; shedding happens exactly when the server can least afford work
+SHED_RESPONSE = shed_response()
 
 class Server:
-    def __init__(self, portnumber):
+    def __init__(self, portnumber, min_workers=POOL_MIN_WORKERS, max_workers=POOL_MAX_WORKERS,
+                 queue_size=POOL_QUEUE_SIZE):
         self.portnumber = portnumber
         self.my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.executor = ThreadPoolExecutor(max_workers=10)
+        self.pool = WorkerPool(self.handle_client, min_workers, max_workers, queue_size,
+                               discard=self.drop_client)
+        register_stats('pool', self.pool.stats)
 
     def start(self):
         if not os.path.exists(UPLOAD_DIR):
@@ -21,22 +40,24 @@ class Server:
             logging.info(f"Created directory: {UPLOAD_DIR}")
 
         self.my_socket.bind(('0.0.0.0', self.portnumber))
-        self.my_socket.listen(5)
+        # deep enough that bursts reach our own queue, where they get a 503
+        # rather than a silent SYN drop
+        self.my_socket.listen(128)
         logging.warning(f"Server (Thread Pool) listening on port {self.portnumber}")
 
         while True:
             try:
                 conn, addr = self.my_socket.accept()
-                logging.warning(f"Connection from {addr}")
-                
-                self.executor.submit(self.handle_client, conn, addr)
-                
+
+                if not self.pool.submit(conn, addr):
+                    self.shed(conn, addr)
+
             except KeyboardInterrupt:
                 logging.warning("Server shutting down.")
                 break
             except Exception as e:
                 logging.error(f"Error accepting connections: {e}")
-        
+
         self.shutdown()
 
     def handle_client(self, conn, addr):
@@ -48,17 +69,43 @@ class Server:
         finally:
             conn.close()
 
+    def drop_client(self, conn, addr):
+        # still queued when the pool shut down
+        conn.close()
+
+    def shed(self, conn, addr):
+        # Runs on the accept thread, so it must not block: one non-blocking
+        # send() of the prebuilt 503 (a fresh socket's buffer always has
+        # room for it), without reading the request, then drop whatever the
+        # client already sent so the close doesn't turn into a reset that
+        # eats the 503. A client that can't take even that just loses it.
+        logging.warning(f"Queue full, rejecting {addr}")
+        try:
+            conn.setblocking(False)
+            conn.send(SHED_RESPONSE)
+            conn.shutdown(socket.SHUT_WR)
+            conn.recv(65536)
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
     def shutdown(self):
-        self.executor.shutdown(wait=True)
+        self.pool.shutdown(wait=True)
         self.my_socket.close()
         logging.warning("Server socket and thread pool closed.")
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.WARNING, format='%(levelname)s - %(message)s')
-    server = Server(8889)
+    portnumber = 8889
+    try:
+        portnumber = int(sys.argv[1])
+    except (IndexError, ValueError):
+        pass
+    server = Server(portnumber)
     try:
         server.start()
     except KeyboardInterrupt:
         server.shutdown()
-        print("\nServer stopped.")
\ No newline at end of file
+        print("\nServer stopped.")
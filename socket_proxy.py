@@ -3,64 +3,687 @@ import socket
 import threading
 import time
 import sys
+import os
 import logging
+import re
+import json
+import argparse
+import selectors
+from urllib.parse import parse_qs, unquote, unquote_plus
+from http import KEEPALIVE_TIMEOUT, etag_matches, parse_http_date
+from http_parser import HttpParser, ParseError, RequestLine, StatusLine, HeadersComplete, Data, EndOfMessage, NEED_DATA, CLOSED
+from backend_pool import BackendPool, STRATEGIES, HEALTH_INTERVAL, HEALTH_PATH
+from proxy_cache import ProxyCache, COALESCE_TIMEOUT, parse_cache_control, target_filename
 
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+#data yang boleh menunggu per arah sebelum sisi pengirim berhenti dibaca
+RELAY_BUFFER_SIZE = 256 * 1024
+#koneksi tanpa lalu lintas selama ini (detik) ditutup
+RELAY_IDLE_TIMEOUT = 300
+#splice() memindahkan data socket -> pipe -> socket tanpa menyalin ke Python
+USE_SPLICE = hasattr(os, 'splice')
+SPLICE_FLAGS = (os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK) if USE_SPLICE else 0
+#mode http: batas waktu menunggu backend dan ukuran blok body yang diteruskan
+BACKEND_TIMEOUT = 30
+PROXY_CHUNK_SIZE = 64 * 1024
+#header hop-by-hop, berlaku untuk satu koneksi saja dan tidak diteruskan
+HOP_BY_HOP = frozenset(['connection', 'keep-alive', 'proxy-connection', 'te', 'trailer',
+						'transfer-encoding', 'upgrade'])
+#header kondisional klien; dengan cache, proxy yang menjawabnya sendiri
+CONDITIONAL_HEADERS = frozenset(['if-none-match', 'if-modified-since', 'if-match',
+								 'if-unmodified-since', 'if-range'])
+#mode http: statistik pool dan cache dilayani proxy sendiri di path ini
+PROXY_STATS_PATH = '/proxy-stats'
+#nama file di body upload (multipart atau form urlencoded); cocok yang keliru
+#hanya membuang entri cache yang berlebih, jadi cukup dicari dengan regex
+UPLOAD_NAME_PATTERN = re.compile(rb'filename="([^"\r\n]*)"|(?:^|&)filename=([^&\s]*)')
+#cukup panjang untuk satu header Content-Disposition yang terpotong antar blok
+UPLOAD_SCAN_OVERLAP = 1024
+
+
+class Pipe:
+	"""One direction of the relay: bytes read from src not yet sent to dst.
+
+	With splice the bytes sit in a kernel pipe and never reach userspace;
+	otherwise they sit in a bytearray. Either way at most ``limit`` bytes are
+	held, and src is not read again until dst has taken some.
+	"""
+
+	def __init__(self, src, dst, limit=RELAY_BUFFER_SIZE):
+		self.src = src
+		self.dst = dst
+		self.limit = limit
+		self.pending = 0
+		self.total = 0
+		self.eof = False
+		self.shut = False
+		self.buffer = None
+		self.rfd = self.wfd = None
+		if USE_SPLICE:
+			self.rfd, self.wfd = os.pipe()
+			self.limit = min(limit, self.pipe_capacity(limit))
+		else:
+			self.buffer = bytearray()
+
+	def pipe_capacity(self, wanted):
+		try:
+			fcntl.fcntl(self.wfd, fcntl.F_SETPIPE_SZ, wanted)
+			return fcntl.fcntl(self.wfd, fcntl.F_GETPIPE_SZ)
+		except (AttributeError, OSError):
+			# Linux default
+			return 64 * 1024
+
+	def wants_read(self):
+		return not self.eof and self.pending < self.limit
+
+	def wants_write(self):
+		return self.pending > 0
+
+	def fill(self):
+		room = self.limit - self.pending
+		try:
+			if self.buffer is None:
+				got = os.splice(self.src.fileno(), self.wfd, room, flags=SPLICE_FLAGS)
+			else:
+				data = self.src.recv(room)
+				self.buffer += data
+				got = len(data)
+		except (BlockingIOError, InterruptedError):
+			return
+		if got == 0:
+			self.eof = True
+		self.pending += got
+		self.total += got
+
+	def flush(self):
+		try:
+			if self.buffer is None:
+				sent = os.splice(self.rfd, self.dst.fileno(), self.pending, flags=SPLICE_FLAGS)
+			else:
+				sent = self.dst.send(self.buffer)
+				del self.buffer[:sent]
+		except (BlockingIOError, InterruptedError):
+			return
+		self.pending -= sent
+
+	def finish(self):
+		# pass the half-close on once everything before it was delivered
+		if self.eof and not self.pending and not self.shut:
+			self.shut = True
+			try:
+				self.dst.shutdown(socket.SHUT_WR)
+			except OSError:
+				pass
+
+	def close(self):
+		for fd in (self.rfd, self.wfd):
+			if fd is not None:
+				os.close(fd)
+		self.rfd = self.wfd = None
 
 
 class ProcessTheClient(threading.Thread):
-	def __init__(self, connection, address, destination_sock_address):
-		self.destination_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.destination_sock.connect(destination_sock_address)
+	def __init__(self, connection, address, pool, mode='tcp', cache=None):
+		self.pool = pool
+		self.mode = mode
+		self.cache = cache
+		self.destination_sock = None
 		self.connection = connection
 		self.address = address
 		threading.Thread.__init__(self)
 
 	def run(self):
-		rcv=""
-		while True:
+		if self.mode == 'http':
+			self.run_http()
+		else:
+			self.run_tcp()
+
+	def run_tcp(self):
+		#tanpa parsing HTTP: satu koneksi backend per klien, dipilih sekali
+		backend = None
+		for attempt in range(len(self.pool.backends)):
+			backend = self.pool.choose(self.address[0])
 			try:
-				data = self.connection.recv(8192)
-				if data:
-					self.destination_sock.sendall(data)
-					data_balasan = self.destination_sock.recv(8192)
-					self.connection.sendall(data_balasan)
-					logging.warning(data)
-					logging.warning(data_balasan)
-
-				else:
+				#connect di thread ini, bukan di thread accept
+				self.destination_sock, _ = self.pool.connect(backend)
+				break
+			except OSError as e:
+				logging.error("cannot reach backend {}: {}".format(backend.name, e))
+				self.pool.done(backend)
+				backend = None
+		if backend is None:
+			self.connection.close()
+			return
+
+		up = Pipe(self.connection, self.destination_sock)
+		down = Pipe(self.destination_sock, self.connection)
+		try:
+			self.relay(up, down)
+			self.pool.report_success(backend)
+		except OSError as e:
+			logging.info("relay for {} ended: {}".format(self.address, e))
+		finally:
+			self.pool.done(backend)
+			up.close()
+			down.close()
+			self.connection.close()
+			self.destination_sock.close()
+		logging.info("closed {}: {} bytes up, {} bytes down".format(self.address, up.total, down.total))
+
+	def relay(self, up, down):
+		#kedua arah dipompa bersamaan; masing-masing berhenti sendiri saat EOF
+		for sock in (self.connection, self.destination_sock):
+			sock.setblocking(False)
+		selector = selectors.DefaultSelector()
+		registered = {}
+		try:
+			while not (up.shut and down.shut):
+				for sock in (self.connection, self.destination_sock):
+					events = 0
+					for pipe in (up, down):
+						if pipe.src is sock and pipe.wants_read():
+							events |= selectors.EVENT_READ
+						if pipe.dst is sock and pipe.wants_write():
+							events |= selectors.EVENT_WRITE
+					current = registered.get(sock, 0)
+					if events == current:
+						continue
+					if not events:
+						selector.unregister(sock)
+					elif not current:
+						selector.register(sock, events)
+					else:
+						selector.modify(sock, events)
+					registered[sock] = events
+
+				ready = selector.select(RELAY_IDLE_TIMEOUT)
+				if not ready:
+					logging.warning("idle timeout for {}".format(self.address))
+					return
+				for key, mask in ready:
+					for pipe in (up, down):
+						if mask & selectors.EVENT_READ and pipe.src is key.fileobj:
+							pipe.fill()
+						if mask & selectors.EVENT_WRITE and pipe.dst is key.fileobj:
+							pipe.flush()
+				up.finish()
+				down.finish()
+		finally:
+			selector.close()
+
+	def run_http(self):
+		#request dibaca satu per satu, sehingga tiap request bisa ke backend
+		#berbeda dan koneksi backend bisa dipakai ulang (keep-alive)
+		self.connection.settimeout(KEEPALIVE_TIMEOUT)
+		parser = HttpParser('request')
+		try:
+			while True:
+				event = next_event(parser, self.connection)
+				if event is CLOSED:
 					break
+				if not isinstance(event, RequestLine):
+					raise ParseError(400, "unexpected request data")
+				method, target, version = event
+				while not isinstance(event, HeadersComplete):
+					event = next_event(parser, self.connection)
+				if not self.proxy_request(parser, method, target, version, event.headers):
+					break
+		except ParseError as e:
+			self.send_error(e.status, e.message)
+		except (socket.timeout, ConnectionError):
+			pass
+		except OSError as e:
+			logging.error("error proxying for {}: {}".format(self.address, e))
+		finally:
+			self.connection.close()
+
+	def proxy_request(self, parser, method, target, version, headers):
+		"""Forward one request and its response; False closes the client."""
+		keep_alive = wants_keep_alive(version, headers)
+		has_body = parser.chunked or parser.body_remaining > 0
+		if not has_body:
+			#tanpa body parser langsung memberi EndOfMessage
+			next_event(parser, self.connection)
+		if target.partition('?')[0] == PROXY_STATS_PATH:
+			self.send_stats(keep_alive)
+			return keep_alive
+		written = written_files(method, target, headers) if self.cache is not None else None
+		if (written is None and self.cache is not None and method == 'GET' and not has_body
+				and 'range' not in headers):
+			return self.proxy_cached(target, version, headers, keep_alive)
+		if has_body and headers.get('expect', '').lower() == '100-continue':
+			#body langsung diteruskan, jadi 100 Continue dijawab di sini
+			self.connection.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+		if written is None:
+			return self.forward(parser, method, target, version, headers, keep_alive, has_body)
+		#upload/delete lewat proxy: versi lama file itu dibuang dari cache
+		#begitu backend menjawab sukses
+		keep_alive = self.forward(parser, method, target, version, headers, keep_alive, has_body,
+								  body_observer=written)
+		if self.response_status is not None and 200 <= self.response_status < 300 and written.names:
+			self.cache.invalidate(written.names)
+		return keep_alive
+
+	def forward(self, parser, method, target, version, headers, keep_alive, has_body, sink=None,
+				body_observer=None, conditional=None):
+		"""Send one request to a backend and relay its response.
+
+		``sink`` (a proxy_cache.CacheFill) sees the response on the way and
+		``body_observer`` (WrittenFiles) the request body. ``conditional``
+		holds the client's request headers when the proxy answers their
+		validators itself. The backend's status is left in
+		``self.response_status``.
+		"""
+		self.response_status = None
+		request_head = self.request_head(method, target, headers, has_body and parser.chunked)
+
+		backend = None
+		for attempt in range(len(self.pool.backends)):
+			backend = self.pool.choose(target.partition('?')[0])
+			try:
+				sock, reused = self.pool.connect(backend)
+				break
 			except OSError as e:
-				pass
-		self.connection.close()
+				#belum ada yang terkirim, jadi aman mencoba backend lain
+				logging.error("cannot reach backend {}: {}".format(backend.name, e))
+				self.pool.done(backend)
+				backend = None
+		if backend is None:
+			self.send_error(502, "Bad Gateway")
+			return False
+
+		try:
+			for attempt in (1, 2):
+				if attempt == 2:
+					try:
+						sock, reused = self.pool.connect(backend)
+					except OSError as e:
+						logging.error("cannot reach backend {}: {}".format(backend.name, e))
+						self.send_error(502, "Bad Gateway")
+						return False
+				try:
+					sock.settimeout(BACKEND_TIMEOUT)
+					sock.sendall(request_head)
+					if has_body:
+						send_body(parser, self.connection, sock, body_observer)
+					response = HttpParser('response')
+					response.request_method = method
+					first = next_event(response, sock)
+					if first is CLOSED:
+						raise ConnectionError("backend closed the connection")
+					break
+				except (OSError, ParseError) as e:
+					sock.close()
+					#koneksi keep-alive yang sudah ditutup backend: coba sekali lagi
+					if reused and not has_body and attempt == 1:
+						continue
+					self.pool.report_failure(backend)
+					logging.error("backend {} failed: {}".format(backend.name, e))
+					self.send_error(504 if isinstance(e, socket.timeout) else 502,
+									"Gateway Timeout" if isinstance(e, socket.timeout) else "Bad Gateway")
+					return False
+
+			try:
+				keep_alive, reusable = self.relay_response(response, sock, first, version, keep_alive, sink, conditional)
+			except (OSError, ParseError) as e:
+				#header sudah terkirim ke klien; satu-satunya cara memberi tahu adalah menutup
+				logging.error("backend {} failed mid-response: {}".format(backend.name, e))
+				if sink is not None:
+					sink.abort()
+				self.pool.report_failure(backend)
+				sock.close()
+				return False
+			self.pool.release(backend, sock, reusable)
+			self.response_status = response.status
+			if response.status is not None and response.status >= 500:
+				self.pool.report_failure(backend)
+			else:
+				self.pool.report_success(backend)
+			return keep_alive
+		finally:
+			self.pool.done(backend)
+
+	def request_head(self, method, target, headers, chunked):
+		drop = HOP_BY_HOP | connection_tokens(headers) | {'expect'}
+		if chunked:
+			#body dikirim ulang chunked; Content-Length lama tidak boleh ikut
+			drop |= {'content-length'}
+		lines = ["{} {} HTTP/1.1".format(method, target)]
+		for name, value in headers.items():
+			if name not in drop:
+				lines.append("{}: {}".format(name, value))
+		if 'host' not in headers:
+			lines.append("host: {}".format(self.pool.backends[0].name))
+		if chunked:
+			lines.append("transfer-encoding: chunked")
+		lines.append("x-forwarded-for: {}".format(self.address[0]))
+		lines.append("connection: keep-alive")
+		return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
+
+	def relay_response(self, response, sock, event, version, keep_alive, sink=None, conditional=None):
+		"""Stream the backend's response to the client.
+
+		Returns ``(keep_alive, reusable)``: whether the client connection and
+		the backend connection can each carry another request. When the sink
+		takes the response over (a 304 for the cache), nothing is sent; when
+		a 200 satisfies the client's ``conditional`` headers the client gets
+		a 304 while the body still goes to the sink.
+		"""
+		status_line = None
+		chunked_out = False
+		close_delimited = False
+		relay = True
+		while True:
+			if isinstance(event, StatusLine):
+				status_line = event
+			elif isinstance(event, HeadersComplete):
+				headers = event.headers
+				if status_line.status >= 200:
+					close_delimited = response.close_delimited
+					if sink is not None:
+						relay = sink.head(status_line.status, status_line.reason, headers)
+					if relay and conditional is not None and status_line.status == 200 and not_modified(
+							conditional, headers.get('etag'), headers.get('last-modified')):
+						#validator klien cocok: cukup 304, body hanya untuk cache
+						relay = False
+						self.connection.sendall(response_head(StatusLine(version, 304, 'Not Modified'),
+															  without_length(headers), False, keep_alive))
+					if relay:
+						chunked_out = response.chunked and version == 'HTTP/1.1'
+						if close_delimited or (response.chunked and not chunked_out):
+							keep_alive = False
+						self.connection.sendall(response_head(status_line, headers, chunked_out, keep_alive))
+				elif status_line.status != 100:
+					#respons interim lain (mis. 103) diteruskan apa adanya
+					self.connection.sendall(response_head(status_line, headers, False, None))
+			elif isinstance(event, Data):
+				if sink is not None:
+					sink.data(event.data)
+				if relay and chunked_out:
+					self.connection.sendall(b"%x\r\n%s\r\n" % (len(event.data), event.data))
+				elif relay:
+					self.connection.sendall(event.data)
+			elif isinstance(event, EndOfMessage):
+				if status_line.status >= 200:
+					break
+			event = next_event(response, sock, PROXY_CHUNK_SIZE)
+
+		if sink is not None:
+			sink.end()
+		if chunked_out:
+			self.connection.sendall(b"0\r\n\r\n")
+		reusable = (status_line.version == 'HTTP/1.1' and not close_delimited
+					and 'close' not in connection_tokens(headers))
+		return keep_alive, reusable
+
+	def proxy_cached(self, target, version, headers, keep_alive):
+		#GET lewat cache: hit segar dilayani langsung, yang basi divalidasi
+		#ulang dengan request kondisional, miss bersamaan digabung jadi satu
+		cache = self.cache
+		cache.count('requests')
+		request_cc = parse_cache_control(headers.get('cache-control', ''))
+		revalidate = 'no-cache' in request_cc or request_cc.get('max-age') == '0'
+		entry = cache.lookup(target, headers)
+		if entry is not None and entry.is_fresh() and not revalidate:
+			if self.serve_cached(entry, version, headers, keep_alive, 'HIT'):
+				cache.count('hits')
+				return keep_alive
+
+		leader, fetch = cache.begin_fetch(target)
+		try:
+			if not leader:
+				fetch.done.wait(COALESCE_TIMEOUT)
+				entry = cache.lookup(target, headers)
+				if entry is not None and entry.is_fresh():
+					if self.serve_cached(entry, version, headers, keep_alive, 'HIT'):
+						cache.count('coalesced')
+						return keep_alive
+
+			backend_headers = {k: v for k, v in headers.items() if k not in CONDITIONAL_HEADERS}
+			if entry is not None and (entry.etag or entry.last_modified):
+				if entry.etag:
+					backend_headers['if-none-match'] = entry.etag
+				if entry.last_modified:
+					backend_headers['if-modified-since'] = entry.last_modified
+			else:
+				entry = None
+			fill = cache.fill(target, headers, entry)
+			keep_alive = self.forward(None, 'GET', target, version, backend_headers, keep_alive, False, fill,
+									  conditional=headers)
+			if not fill.revalidated:
+				cache.count('misses')
+				return keep_alive
+			cache.count('revalidated')
+			if not self.serve_cached(entry, version, headers, keep_alive, 'REVALIDATED'):
+				self.send_error(502, "Bad Gateway")
+				return False
+			return keep_alive
+		finally:
+			if leader:
+				cache.end_fetch(target, fetch)
+
+	def serve_cached(self, entry, version, request_headers, keep_alive, outcome):
+		"""Answer from the cache; False if the body is gone (evicted from disk)."""
+		data, path = entry.data, entry.path
+		f = None
+		if data is None:
+			try:
+				f = open(path, 'rb')
+			except OSError:
+				return False
+		try:
+			headers = dict(entry.headers)
+			headers['age'] = str(entry.age)
+			headers['x-cache'] = outcome
+			if not_modified(request_headers, entry.etag, entry.last_modified):
+				self.connection.sendall(response_head(StatusLine(version, 304, 'Not Modified'),
+													  headers, False, keep_alive))
+				return True
+			headers['content-length'] = str(entry.size)
+			self.connection.sendall(response_head(StatusLine(version, entry.status, entry.reason),
+												  headers, False, keep_alive))
+			if f is None:
+				self.connection.sendall(data)
+			elif entry.size:
+				self.connection.sendfile(f)
+			self.cache.count('bytes_from_cache', entry.size)
+			return True
+		finally:
+			if f is not None:
+				f.close()
+
+	def send_stats(self, keep_alive):
+		stats = {'pool': self.pool.stats()}
+		if self.cache is not None:
+			stats['cache'] = self.cache.stats()
+		body = json.dumps(stats, indent=2).encode('utf-8')
+		self.connection.sendall(response_head(StatusLine('HTTP/1.1', 200, 'OK'), {
+			'content-type': 'application/json',
+			'content-length': str(len(body)),
+			'cache-control': 'no-store',
+		}, False, keep_alive) + body)
+
+	def send_error(self, status, message):
+		body = message.encode('utf-8')
+		try:
+			self.connection.sendall("HTTP/1.1 {}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+									"Content-Length: {}\r\nConnection: close\r\n\r\n".format(status, len(body)).encode()
+									+ body)
+		except OSError:
+			pass
+
+
+def next_event(parser, sock, max_data=None):
+	while True:
+		event = parser.next_event(max_data)
+		if event is not NEED_DATA:
+			return event
+		parser.recv_into(sock, PROXY_CHUNK_SIZE if parser.in_body else 4096)
+
+
+def send_body(parser, src, dst, observer=None):
+	#body request diteruskan per blok; chunked tetap chunked, trailer dibuang
+	chunked = parser.chunked
+	while True:
+		event = next_event(parser, src, PROXY_CHUNK_SIZE)
+		if isinstance(event, Data):
+			if observer is not None:
+				observer.feed(event.data)
+			if chunked:
+				dst.sendall(b"%x\r\n%s\r\n" % (len(event.data), event.data))
+			else:
+				dst.sendall(event.data)
+		elif isinstance(event, EndOfMessage):
+			break
+	if chunked:
+		dst.sendall(b"0\r\n\r\n")
+
+
+def connection_tokens(headers):
+	return {t.strip().lower() for t in headers.get('connection', '').split(',') if t.strip()}
+
+
+def wants_keep_alive(version, headers):
+	tokens = connection_tokens(headers)
+	if 'close' in tokens:
+		return False
+	return version == 'HTTP/1.1' or 'keep-alive' in tokens
+
+
+class WrittenFiles:
+	"""Files a request through the proxy uploads or deletes on the backend.
+
+	The backend's routes: PUT /files/<name>, GET /delete/<name>, and POST
+	/upload with the name in ?filename=, X-Filename, or the body. Names in
+	the body are picked up by feed() while the body is forwarded.
+	"""
+
+	def __init__(self, names=(), scan_body=False):
+		self.names = set(names)
+		self.scan_body = scan_body
+		self.tail = b""
+
+	def feed(self, data):
+		if not self.scan_body:
+			return
+		window = self.tail + data
+		for match in UPLOAD_NAME_PATTERN.finditer(window):
+			if match.group(1) is not None:
+				name = match.group(1).decode('utf-8', 'replace')
+			else:
+				name = unquote_plus(match.group(2).decode('latin-1'))
+			self.names.add(upload_filename(name))
+		self.tail = window[-UPLOAD_SCAN_OVERLAP:]
+
+
+def upload_filename(name):
+	#sama dengan safe_filename di http.py
+	return os.path.basename(unquote(name).replace('\\', '/'))
+
+
+def written_files(method, target, headers):
+	path, _, query = target.partition('?')
+	if method == 'PUT' and path.startswith('/files/'):
+		return WrittenFiles([upload_filename(path[len('/files/'):])])
+	if method == 'GET' and path.startswith('/delete/'):
+		return WrittenFiles([target_filename(path)])
+	if method == 'POST' and path == '/upload':
+		name = parse_qs(query).get('filename', [None])[0] or headers.get('x-filename')
+		if name:
+			return WrittenFiles([upload_filename(name)])
+		return WrittenFiles(scan_body=True)
+	return None
+
+
+def not_modified(request_headers, etag, last_modified):
+	#If-None-Match menang atas If-Modified-Since kalau keduanya ada
+	if_none_match = request_headers.get('if-none-match')
+	if if_none_match is not None:
+		return etag is not None and etag_matches(if_none_match, etag)
+	if_modified_since = request_headers.get('if-modified-since')
+	if if_modified_since is not None and last_modified is not None:
+		since = parse_http_date(if_modified_since)
+		modified = parse_http_date(last_modified)
+		return since is not None and modified is not None and modified <= since
+	return False
+
+
+def without_length(headers):
+	return {k: v for k, v in headers.items() if k != 'content-length'}
+
+
+def response_head(status_line, headers, chunked, keep_alive):
+	drop = HOP_BY_HOP | connection_tokens(headers)
+	if chunked:
+		drop |= {'content-length'}
+	lines = ["HTTP/1.1 {} {}".format(status_line.status, status_line.reason).rstrip()]
+	for name, value in headers.items():
+		if name not in drop:
+			lines.append("{}: {}".format(name, value))
+	if chunked:
+		lines.append("transfer-encoding: chunked")
+	if keep_alive is not None:
+		lines.append("connection: {}".format('keep-alive' if keep_alive else 'close'))
+	return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1')
 
 
 
 class Server(threading.Thread):
-	def __init__(self):
+	def __init__(self, portnumber=18000, backends=(('localhost', 8889),), strategy='round_robin',
+				 mode='tcp', health_interval=HEALTH_INTERVAL, cache=False, health_path=HEALTH_PATH):
 		self.the_clients = []
+		self.portnumber = portnumber
+		self.mode = mode
+		self.pool = BackendPool(list(backends), strategy, health_interval, health_path)
+		#cache butuh parsing HTTP, jadi hanya berlaku di mode http
+		self.cache = ProxyCache() if cache and mode == 'http' else None
 		self.my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-		self.destination_sock_address = ('localhost',8889)
 		threading.Thread.__init__(self)
 
 	def run(self):
-		self.my_socket.bind(('0.0.0.0', 18000))
-		self.my_socket.listen(1)
+		self.my_socket.bind(('0.0.0.0', self.portnumber))
+		self.my_socket.listen(128)
+		self.pool.start_health_checks()
+		logging.warning("proxy ({}, {}{}) on port {} -> {}".format(
+			self.mode, self.pool.strategy, ', cached' if self.cache else '', self.portnumber,
+			", ".join(b.name for b in self.pool.backends)))
 		while True:
 			self.connection, self.client_address = self.my_socket.accept()
 			logging.warning("connection from {}".format(self.client_address))
 
-			clt = ProcessTheClient(self.connection, self.client_address,self.destination_sock_address)
+			clt = ProcessTheClient(self.connection, self.client_address, self.pool, self.mode, self.cache)
 			clt.start()
+			self.the_clients = [c for c in self.the_clients if c.is_alive()]
 			self.the_clients.append(clt)
 
 
+def parse_backend(value):
+	host, _, port = value.rpartition(':')
+	return (host or 'localhost', int(port))
+
 
 def main():
-	svr = Server()
+	parser = argparse.ArgumentParser(description="TCP/HTTP proxy in front of one or more backends")
+	parser.add_argument('--port', type=int, default=18000)
+	parser.add_argument('--mode', choices=('tcp', 'http'), default='tcp')
+	parser.add_argument('--strategy', choices=STRATEGIES, default='round_robin')
+	parser.add_argument('--backend', type=parse_backend, action='append',
+						help="host:port, may be repeated (default localhost:8889)")
+	parser.add_argument('--health-interval', type=float, default=HEALTH_INTERVAL)
+	parser.add_argument('--health-path', default=HEALTH_PATH,
+						help="path probed with GET on each backend; only 2xx/3xx is healthy")
+	parser.add_argument('--cache', action='store_true', help="cache GET responses (implies --mode http)")
+	args = parser.parse_args()
+
+	mode = 'http' if args.cache else args.mode
+	svr = Server(args.port, args.backend or [('localhost', 8889)], args.strategy, mode,
+				 args.health_interval, args.cache, args.health_path)
 	svr.start()
 
 if __name__=="__main__":
 	main()
-
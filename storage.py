@@ -0,0 +1,195 @@
+import os
+import fcntl
+import hashlib
+import secrets
+import tempfile
+import threading
+
+# Inside the storage directory; FileIndex skips dot-entries, so neither
+# shows up in listings or can be fetched by name.
+OBJECTS_DIR = '.objects'
+REFS_DIR = '.refs'
+HASH_ALGORITHM = 'sha256'
+
+
+class ContentStore:
+    """Uploads stored once per content hash, published under their names.
+
+    Each blob lives at ``.objects/<ab>/<digest>`` and every name holding
+    that content is a hard link to it, so GET, sendfile and the file cache
+    keep working on plain paths. The blob's link count is its reference
+    count: a blob with no names left has one link and is removed. Each name
+    also gets ``.refs/<name>``, a symlink whose target is the digest.
+
+    The shared inode's mtime belongs to the content, not to any one name,
+    and is never touched: a name's validators are the digest (ETag) and the
+    ref's own mtime, i.e. when that name was last published
+    (Last-Modified), see validators().
+
+    Uploads are hashed as they stream into a temp file; a duplicate is
+    dropped instead of stored again. Names are switched with rename(), so
+    readers see the old content or the new, never a partial file. Changes
+    to links and refs hold an flock, because prefork and process-pool
+    workers share the directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.objects = os.path.join(directory, OBJECTS_DIR)
+        self.refs = os.path.join(directory, REFS_DIR)
+        self.stats_lock = threading.Lock()
+        self.uploads = 0
+        self.deduplicated = 0
+        self.bytes_written = 0
+        self.bytes_deduplicated = 0
+        self.objects_removed = 0
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def blob_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def digest(self, name):
+        """Content hash stored under ``name``, or None (legacy/unknown)."""
+        try:
+            return os.readlink(os.path.join(self.refs, name))
+        except OSError:
+            return None
+
+    def validators(self, name, ino):
+        """``(digest, published)`` for ``name`` if it still holds the
+        content whose inode is ``ino``, else None (legacy file, or the
+        name was republished since it was opened)."""
+        ref = os.path.join(self.refs, name)
+        try:
+            digest = os.readlink(ref)
+            published = os.lstat(ref).st_mtime
+            if os.stat(self.blob_path(digest)).st_ino != ino:
+                return None
+        except OSError:
+            return None
+        return digest, int(published)
+
+    def dir_mtime(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return None
+
+    def locked(self):
+        os.makedirs(self.objects, exist_ok=True)
+        lock = open(os.path.join(self.objects, 'lock'), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # closing the file releases the lock
+        return lock
+
+    def save(self, name, chunks):
+        """Store the chunks under ``name``; returns ``(size, digest, change)``.
+
+        ``change`` is the storage directory's mtime before and after the
+        name was published, both read under the lock, so FileIndex can tell
+        its own change from another worker's.
+        """
+        if name.startswith('.'):
+            # dot-names are the store's own (objects, refs, temp files)
+            raise ValueError(f"reserved file name {name!r}")
+        os.makedirs(self.objects, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.upload-', dir=self.objects)
+        hasher = hashlib.new(HASH_ALGORITHM)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in chunks:
+                    out.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+            os.chmod(tmp_path, 0o644)
+            digest = hasher.hexdigest()
+            with self.locked():
+                before = self.dir_mtime()
+                blob = self.blob_path(digest)
+                if os.path.exists(blob):
+                    os.unlink(tmp_path)
+                    duplicate = True
+                else:
+                    os.makedirs(os.path.dirname(blob), exist_ok=True)
+                    os.replace(tmp_path, blob)
+                    duplicate = False
+                self._publish(name, blob, digest)
+                change = (before, self.dir_mtime())
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        with self.stats_lock:
+            self.uploads += 1
+            if duplicate:
+                self.deduplicated += 1
+                self.bytes_deduplicated += size
+            else:
+                self.bytes_written += size
+        return size, digest, change
+
+    def _publish(self, name, blob, digest):
+        # caller holds the lock
+        previous = self.digest(name)
+        link_tmp = os.path.join(self.directory, f".link-{secrets.token_hex(8)}")
+        os.link(blob, link_tmp)
+        try:
+            os.replace(link_tmp, self.path(name))
+        finally:
+            # rename() between two links to the same inode (same content
+            # uploaded again under the same name) succeeds without doing
+            # anything, leaving the temp link behind
+            if os.path.lexists(link_tmp):
+                os.unlink(link_tmp)
+        os.makedirs(self.refs, exist_ok=True)
+        ref_tmp = os.path.join(self.refs, f".ref-{secrets.token_hex(8)}")
+        os.symlink(digest, ref_tmp)
+        os.replace(ref_tmp, os.path.join(self.refs, name))
+        if previous and previous != digest:
+            self._release(previous)
+
+    def _release(self, digest):
+        # caller holds the lock; only the store's own link left -> unreferenced
+        blob = self.blob_path(digest)
+        try:
+            if os.stat(blob).st_nlink > 1:
+                return
+            os.remove(blob)
+        except FileNotFoundError:
+            return
+        with self.stats_lock:
+            self.objects_removed += 1
+
+    def delete(self, name):
+        """Remove ``name``; returns the directory ``change`` as for save(),
+        or None if there is no such file."""
+        path = self.path(name)
+        with self.locked():
+            if not os.path.isfile(path):
+                return None
+            before = self.dir_mtime()
+            digest = self.digest(name)
+            os.remove(path)
+            if digest:
+                try:
+                    os.remove(os.path.join(self.refs, name))
+                except FileNotFoundError:
+                    pass
+                self._release(digest)
+            return before, self.dir_mtime()
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'uploads': self.uploads,
+                'deduplicated': self.deduplicated,
+                'bytes_written': self.bytes_written,
+                'bytes_deduplicated': self.bytes_deduplicated,
+                'objects_removed': self.objects_removed,
+            }
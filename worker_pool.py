@@ -0,0 +1,246 @@
+import time
+import queue
+import logging
+import threading
+
+POOL_MIN_WORKERS = 4
+POOL_MAX_WORKERS = 64
+# Connections accepted but not yet picked up by a worker. Past this the
+# server answers 503 straight away instead of letting latency pile up.
+POOL_QUEUE_SIZE = 128
+# Workers above the minimum exit after this long without work.
+POOL_IDLE_TIMEOUT = 30.0
+# Queue wait (seconds) past which another worker is started even if the
+# queue is short: the ones we have are not keeping up.
+POOL_TARGET_WAIT = 0.05
+# Upper bounds (seconds) of the queue-wait histogram buckets.
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+class WorkerPool:
+    """Thread pool with a bounded admission queue and an elastic size.
+
+    submit() never blocks: it returns False when the queue is full so the
+    caller can shed the work. Threads are added while queued work outnumbers
+    idle workers or waits longer than ``target_wait``, up to ``max_workers``,
+    and retire after ``idle_timeout`` seconds without work, down to
+    ``min_workers``. Work still queued at shutdown is passed to
+    ``discard(*args)`` instead of being run (e.g. to close a connection).
+    """
+
+    def __init__(self, handler, min_workers=POOL_MIN_WORKERS, max_workers=POOL_MAX_WORKERS,
+                 queue_size=POOL_QUEUE_SIZE, idle_timeout=POOL_IDLE_TIMEOUT,
+                 target_wait=POOL_TARGET_WAIT, name='pool', discard=None):
+        if not 0 < min_workers <= max_workers:
+            raise ValueError("need 0 < min_workers <= max_workers")
+        self.handler = handler
+        self.discard = discard
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.queue_size = queue_size
+        self.idle_timeout = idle_timeout
+        self.target_wait = target_wait
+        self.name = name
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.threads = set()
+        self.workers = 0
+        self.idle = 0
+        # queued items no worker has claimed yet; compared against idle
+        # under the lock, unlike queue.qsize() which races with get()
+        self.pending = 0
+        self.peak_workers = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self.wait_counts = [0] * (len(WAIT_BUCKETS) + 1)
+        self.running = True
+        with self.lock:
+            for _ in range(min_workers):
+                self._spawn()
+
+    def _spawn(self):
+        # caller holds self.lock
+        self.workers += 1
+        self.idle += 1
+        self.peak_workers = max(self.peak_workers, self.workers)
+        thread = threading.Thread(target=self._run, name=f"{self.name}-{self.workers}", daemon=True)
+        self.threads.add(thread)
+        thread.start()
+
+    def _retire(self):
+        # caller holds self.lock
+        self.workers -= 1
+        self.idle -= 1
+        self.threads.discard(threading.current_thread())
+
+    def submit(self, *args):
+        """Queue ``handler(*args)``; False if the pool is full or stopped."""
+        if not self.running:
+            return False
+        try:
+            self.queue.put_nowait((time.monotonic(), args))
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+        with self.lock:
+            self.submitted += 1
+            self.pending += 1
+            if self.pending > self.idle and self.workers < self.max_workers:
+                self._spawn()
+        return True
+
+    def _run(self):
+        while True:
+            if not self.running:
+                with self.lock:
+                    self._retire()
+                return
+            try:
+                item = self.queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self.lock:
+                    if self.workers > self.min_workers:
+                        self._retire()
+                        return
+                continue
+            if item is None:
+                continue
+            if not self.running:
+                # picked up after shutdown started: not ours to run any more
+                self._drop(item)
+                continue
+
+            queued_at, args = item
+            wait = time.monotonic() - queued_at
+            with self.lock:
+                self.pending -= 1
+                self.idle -= 1
+                self._record_wait(wait)
+                if (wait > self.target_wait and not self.queue.empty()
+                        and self.workers < self.max_workers):
+                    self._spawn()
+            try:
+                self.handler(*args)
+            except Exception as e:
+                logging.error(f"Unhandled error in {self.name} worker: {e}")
+                with self.lock:
+                    self.failed += 1
+            finally:
+                with self.lock:
+                    self.idle += 1
+                    self.completed += 1
+
+    def _drop(self, item):
+        with self.lock:
+            self.pending -= 1
+            self.dropped += 1
+        if self.discard is not None:
+            try:
+                self.discard(*item[1])
+            except Exception as e:
+                logging.error(f"Error discarding work in {self.name}: {e}")
+
+    def _drain(self):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None:
+                self._drop(item)
+
+    def _record_wait(self, wait):
+        # caller holds self.lock
+        self.wait_sum += wait
+        self.wait_max = max(self.wait_max, wait)
+        for i, bound in enumerate(WAIT_BUCKETS):
+            if wait <= bound:
+                self.wait_counts[i] += 1
+                break
+        else:
+            self.wait_counts[-1] += 1
+
+    def stats(self):
+        with self.lock:
+            started = sum(self.wait_counts)
+            buckets = {}
+            total = 0
+            for bound, count in zip(WAIT_BUCKETS + ('+Inf',), self.wait_counts):
+                total += count
+                buckets[str(bound)] = total
+            return {
+                'workers': self.workers,
+                'busy': self.workers - self.idle,
+                'min_workers': self.min_workers,
+                'max_workers': self.max_workers,
+                'peak_workers': self.peak_workers,
+                'queue_depth': self.queue.qsize(),
+                'queue_size': self.queue_size,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'wait_avg': self.wait_sum / started if started else 0.0,
+                'wait_max': self.wait_max,
+                'wait_sum': self.wait_sum,
+                'wait_buckets': buckets,
+            }
+
+    def shutdown(self, wait=True):
+        # Never blocks on a full queue (the overload case): the flag stops
+        # workers once their current item is done, queued work is dropped,
+        # and the None wake-ups only need to fit in the room that leaves.
+        self.running = False
+        self._drain()
+        with self.lock:
+            threads = list(self.threads)
+        for _ in threads:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                break
+        if wait:
+            for thread in threads:
+                thread.join()
+            # anything a racing submit() slipped in after the first drain
+            self._drain()
+
+
+class ExecutorLoad:
+    """Queue depth for a concurrent.futures executor, which doesn't expose it.
+
+    Call started() when work is submitted and finished() when it is done;
+    whatever is in flight beyond the worker count is waiting in the queue.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.inflight = 0
+        self.submitted = 0
+
+    def started(self):
+        with self.lock:
+            self.inflight += 1
+            self.submitted += 1
+
+    def finished(self, *args):
+        with self.lock:
+            self.inflight -= 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'workers': self.workers,
+                'inflight': self.inflight,
+                'busy': min(self.inflight, self.workers),
+                'queue_depth': max(0, self.inflight - self.workers),
+                'submitted': self.submitted,
+            }